@@ -0,0 +1,11 @@
+CUDA_VISIBLE_DEVICES=0, python main_classify.py \
+--image_dir data/mimic_cxr/images/ \
+--ann_path data/mimic_cxr/mimic_annotation_promptmrg.json \
+--dataset_name mimic_cxr \
+--batch_size 128 \
+--seed 456789 \
+--clip_k 21 \
+--calibrate \
+--calibration_path results/promptmrg/temperature.json \
+--output_path results/promptmrg/cls_probs.json \
+--load_pretrained results/promptmrg/model_best.pth
@@ -34,7 +34,7 @@ def create_dataset(dataset, tokenizer, args):
         test_dataset = generation_eval(transform_test, args.image_dir, args.ann_path, tokenizer, split='test', dataset='mimic_cxr', args=args)
         return train_dataset, val_dataset, test_dataset
     
-def create_dataset_test(dataset, tokenizer, args):
+def create_dataset_test(dataset, tokenizer, args, split='test'):
     transform_test = transforms.Compose([
         transforms.Resize(256),
         transforms.CenterCrop(args.image_size),
@@ -43,10 +43,10 @@ def create_dataset_test(dataset, tokenizer, args):
                              (0.229, 0.224, 0.225))])
 
     if dataset =='generation_iu_xray':
-        test_dataset = generation_eval(transform_test, args.image_dir, args.ann_path, tokenizer, split='test', dataset='iu_xray', args=args)
+        test_dataset = generation_eval(transform_test, args.image_dir, args.ann_path, tokenizer, split=split, dataset='iu_xray', args=args)
         return test_dataset
     elif dataset =='generation_mimic_cxr':
-        test_dataset = generation_eval(transform_test, args.image_dir, args.ann_path, tokenizer, split='test', dataset='mimic_cxr', args=args)
+        test_dataset = generation_eval(transform_test, args.image_dir, args.ann_path, tokenizer, split=split, dataset='mimic_cxr', args=args)
         return test_dataset
 
 def create_sampler(datasets, shuffles, num_tasks, global_rank):
@@ -38,6 +38,15 @@ SCORES = [
 ]
 
 
+def load_image(image_root, image_path, transform, args):
+    """the first view [3, H, W], or with args.multi_view all (at most args.max_views) views [V, 3, H, W]"""
+    if not getattr(args, 'multi_view', False):
+        return transform(Image.open(os.path.join(image_root, image_path[0])).convert('RGB'))
+    if getattr(args, 'max_views', 0) > 0:
+        image_path = image_path[:args.max_views]
+    return torch.stack([transform(Image.open(os.path.join(image_root, path)).convert('RGB')) for path in image_path], 0)
+
+
 class generation_train(Dataset):
     def __init__(self, transform, image_root, ann_root, tokenizer, max_words=100, dataset='mimic_cxr', args=None):
         
@@ -49,7 +58,7 @@ class generation_train(Dataset):
         self.max_words = max_words      
         self.dataset = dataset
         self.args = args
-        with open('./data/mimic_cxr/clip_text_features.json', 'r') as f:
+        with open(getattr(args, 'clip_features_path', './data/mimic_cxr/clip_text_features.json'), 'r') as f:
             self.clip_features = np.array(json.load(f))
         
     def __len__(self):
@@ -60,8 +69,7 @@ class generation_train(Dataset):
         ann = self.ann[index]
         
         image_path = ann['image_path']
-        image = Image.open(os.path.join(self.image_root, image_path[0])).convert('RGB')
-        image = self.transform(image)
+        image = load_image(self.image_root, image_path, self.transform, self.args)
         
         cls_labels = ann['labels']
         prompt = [SCORES[l] for l in cls_labels]
@@ -87,18 +95,29 @@ class generation_eval(Dataset):
         self.tokenizer = tokenizer
         self.dataset = dataset
         self.args = args
-        with open('./data/mimic_cxr/clip_text_features.json', 'r') as f:
+        with open(getattr(args, 'clip_features_path', './data/mimic_cxr/clip_text_features.json'), 'r') as f:
             self.clip_features = np.array(json.load(f))
         
     def __len__(self):
         return len(self.ann)
+
+    def fill_clip_indices(self, retriever, batch_size=64, overwrite=False):
+        """retrieve clip_indices (models/retrieval.py) for the studies that have none, e.g. new studies"""
+        todo = [i for i, ann in enumerate(self.ann) if overwrite or 'clip_indices' not in ann]
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            images = [Image.open(os.path.join(self.image_root, self.ann[i]['image_path'][0])).convert('RGB') for i in batch]
+            clip_scores, clip_indices = retriever.search(torch.stack([self.transform(image) for image in images], 0))
+            for i, indices, scores in zip(batch, clip_indices.tolist(), clip_scores.tolist()):
+                self.ann[i]['clip_indices'] = indices
+                self.ann[i]['clip_scores'] = scores
+        return len(todo)
     
     def __getitem__(self, index):    
         
         ann = self.ann[index]
         image_path = ann['image_path']
-        image = Image.open(os.path.join(self.image_root, image_path[0])).convert('RGB')
-        image = self.transform(image)
+        image = load_image(self.image_root, image_path, self.transform, self.args)
 
         caption = my_pre_caption(ann['report'], self.max_words)
         cls_labels = ann['labels']
@@ -107,4 +126,21 @@ class generation_eval(Dataset):
         clip_memory = self.clip_features[clip_indices]
         clip_memory = torch.from_numpy(clip_memory).float()
 
+        # study-to-report similarities of the retrieved reports for memory pruning, written by the retriever
+        # (fill_clip_indices); the precomputed clip_indices of the annotation have none, only 'k' works without
+        if getattr(self.args, 'memory_policy', 'none') != 'none':
+            if 'clip_scores' in ann:
+                clip_scores = torch.tensor(ann['clip_scores'][:self.args.clip_k]).float()
+            elif self.args.memory_policy == 'k':
+                # 'k' only keeps a prefix of the retrieval order, the scores are not read
+                clip_scores = torch.zeros(len(clip_indices))
+            else:
+                raise ValueError('--memory_policy {} needs the clip_scores of the retrieved reports, which study {} has not: '
+                                 'retrieve them with fill_clip_indices(retriever, overwrite=True) (main_test.py --retrieval '
+                                 '... --retrieval_overwrite) or use --memory_policy k'.format(self.args.memory_policy, ann.get('id', index)))
+            return image, caption, cls_labels, clip_memory, torch.from_numpy(np.array(clip_indices)).long(), clip_scores
+
+        # the retrieved reports themselves are needed by the retrieval draft model and the memory cache
+        if getattr(self.args, 'draft_type', 'none') == 'retrieval' or getattr(self.args, 'memory_cache_size', 0) > 0:
+            return image, caption, cls_labels, clip_memory, torch.from_numpy(np.array(clip_indices)).long()
         return image, caption, cls_labels, clip_memory
@@ -98,3 +98,35 @@ def save_result(result, result_dir, filename, remove_duplicate=''):
 
 
 
+
+
+class ViewBatch(object):
+    """
+    Ragged multi-view batch: all views of all studies as one flat [sum(num_views), 3, H, W] tensor, and the
+    number of views [N] of every study (in order). Behaves like the image tensor for .to() / pin_memory.
+    """
+
+    def __init__(self, images, num_views):
+        self.images = images
+        self.num_views = num_views
+
+    def to(self, device, non_blocking=False):
+        return ViewBatch(self.images.to(device, non_blocking=non_blocking), self.num_views.to(device, non_blocking=non_blocking))
+
+    def pin_memory(self):
+        return ViewBatch(self.images.pin_memory(), self.num_views.pin_memory())
+
+    @property
+    def device(self):
+        return self.images.device
+
+    def __len__(self):
+        return self.num_views.size(0)
+
+
+def collate_views(batch):
+    """collate_fn for studies whose first item is a [num_views, 3, H, W] tensor"""
+    views = [sample[0] for sample in batch]
+    images = ViewBatch(torch.cat(views, 0), torch.tensor([v.size(0) for v in views], dtype=torch.long))
+    rest = torch.utils.data.default_collate([sample[1:] for sample in batch])
+    return (images,) + tuple(rest)
@@ -0,0 +1,14 @@
+python main_cpu_infer.py \
+--image_dir data/mimic_cxr/images/ \
+--ann_path data/mimic_cxr/mimic_annotation_promptmrg.json \
+--dataset_name mimic_cxr \
+--gen_max_len 150 \
+--gen_min_len 100 \
+--beam_size 3 \
+--clip_k 21 \
+--batch_size 4 \
+--num_procs 8 \
+--interop_threads 1 \
+--compact_generation \
+--output_path results/promptmrg/cpu_reports.json \
+--load_pretrained results/promptmrg/model_best.safetensors
@@ -0,0 +1,160 @@
+import time
+import torch
+import argparse
+import numpy as np
+from models.blip import blip_decoder, encode_views
+from modules.tokenizers import build_tokenizer
+from dataset.utils import ViewBatch
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    # Data input settings
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+
+    # Model settings
+    parser.add_argument('--load_pretrained', type=str, default=None, help='pretrained path if any')
+    parser.add_argument('--tiny', action='store_true', help='random-init ResNet-18 and 2-layer BERT decoder (configs/bert_config_tiny.json), nothing downloaded.')
+    parser.add_argument('--bert_path', type=str, default='bert-base-uncased', help='the tokenizer: hub name or a local directory with vocab.txt.')
+
+    # Benchmark settings
+    parser.add_argument('--task', type=str, default='encoder', choices=['encoder', 'memory', 'views'], help='optimized encoder, memory transformer latency per number of kept reports, or ragged vs padded multi-view encoding.')
+    parser.add_argument('--memory_ks', type=int, nargs='+', default=[21, 14, 7, 3], help='memory: the numbers of retrieved reports to time.')
+    parser.add_argument('--max_views', type=int, default=4, help='views: studies have 1 to max_views views.')
+    parser.add_argument('--optimize', type=str, default='trace', choices=['compile', 'trace', 'fold', 'fuse'], help='torch.compile / frozen TorchScript trace of the encoder, or ResNet preparation: BN folding + channels-last (fold), plus conv+ReLU fusion (fuse).')
+    parser.add_argument('--compile_backend', type=str, default='inductor', help='the torch.compile backend.')
+    parser.add_argument('--compile_cache', type=str, default=None, help='where to cache the traced encoder.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16, 64], help='the batch sizes to time.')
+    parser.add_argument('--iters', type=int, default=10, help='timed iterations per batch size.')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default.')
+
+    # Others
+    parser.add_argument('--seed', type=int, default=9233, help='.')
+    parser.add_argument('--device', default='cpu')
+
+    # cls head
+    parser.add_argument('--clip_k', type=int, default=21, help='Number of retrieved reports from database.')
+
+    args = parser.parse_args()
+    return args
+
+
+def time_encoder(model, image, clip_memory, iters):
+    """mean latency of encode() in ms"""
+    with torch.no_grad():
+        model.encode(image, clip_memory)
+        if image.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            model.encode(image, clip_memory)
+        if image.is_cuda:
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def time_memory(model, batch_size, clip_k, k, iters, device):
+    """mean latency (ms) of the memory transformer keeping k of clip_k reports for every study"""
+    clip_memory = torch.randn(clip_k, batch_size, 512, device=device)
+    query = torch.randn(1, batch_size, 512, device=device)
+    with torch.no_grad():
+        model.memory(clip_memory[:k], None, query, None)
+        if clip_memory.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            model.memory(clip_memory[:k], None, query, None)
+        if clip_memory.is_cuda:
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def time_views(model, images, num_views, max_views, iters):
+    """studies/s of encoding the ragged flat batch, and of padding every study to max_views views"""
+    ragged = ViewBatch(images, num_views)
+    padded = torch.cat([images, images.new_zeros(num_views.size(0) * max_views - images.size(0), *images.shape[1:])], 0)
+    elapsed = []
+    with torch.no_grad():
+        for run in [lambda: encode_views(model.visual_encoder, ragged), lambda: model.visual_encoder(padded)]:
+            run()
+            if images.is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(iters):
+                run()
+            if images.is_cuda:
+                torch.cuda.synchronize()
+            elapsed.append((time.perf_counter() - start) / iters)
+    return num_views.size(0) / elapsed[0], num_views.size(0) / elapsed[1]
+
+
+def main():
+    # parse arguments
+    args = parse_agrs()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    # create tokenizer
+    tokenizer = build_tokenizer(args.bert_path)
+
+    # build model architecture
+    labels_temp = ['[BLA]'] * 18 # for calculate length only
+    prompt_temp = ' '.join(labels_temp)+' '
+    model = blip_decoder(args, tokenizer, image_size=args.image_size, prompt=prompt_temp, checkpoint=args.load_pretrained)
+    model = model.to(device)
+    model.eval()
+
+    if args.task == 'views':
+        print('\t{:>10s}  {:>6s}  {:>13s}  {:>13s}  {:>8s}'.format('batch_size', 'views', 'ragged_st/s', 'padded_st/s', 'speedup'))
+        for batch_size in args.batch_sizes:
+            num_views = torch.randint(1, args.max_views + 1, (batch_size,), device=device)
+            images = torch.randn(int(num_views.sum()), 3, args.image_size, args.image_size, device=device)
+            ragged, padded = time_views(model, images, num_views, args.max_views, args.iters)
+            print('\t{:10d}  {:6d}  {:13.2f}  {:13.2f}  {:8.2f}'.format(batch_size, images.size(0), ragged, padded, ragged / padded))
+        return
+
+    if args.task == 'memory':
+        print('\t{:>10s}  {:>6s}  {:>10s}  {:>8s}'.format('batch_size', 'k', 'memory_ms', 'speedup'))
+        for batch_size in args.batch_sizes:
+            full = time_memory(model, batch_size, args.clip_k, args.clip_k, args.iters, device)
+            for k in args.memory_ks:
+                elapsed = time_memory(model, batch_size, args.clip_k, min(k, args.clip_k), args.iters, device)
+                print('\t{:10d}  {:6d}  {:10.2f}  {:8.2f}'.format(batch_size, k, elapsed, full / elapsed))
+        return
+
+    inputs = {}
+    eager = {}
+    for batch_size in args.batch_sizes:
+        image = torch.randn(batch_size, 3, args.image_size, args.image_size, device=device)
+        clip_memory = torch.randn(batch_size, args.clip_k, 512, device=device)
+        inputs[batch_size] = (image, clip_memory)
+        eager[batch_size] = time_encoder(model, image, clip_memory, args.iters)
+        with torch.no_grad():
+            reference = model.encode(image, clip_memory)
+        inputs[batch_size] += (reference,)
+
+    start = time.perf_counter()
+    if args.optimize in ['fold', 'fuse']:
+        model.visual_encoder.prepare_for_inference(channels_last=True, fuse_relu=args.optimize == 'fuse')
+    else:
+        model.compile_encoder(args.optimize, backend=args.compile_backend, cache_path=args.compile_cache,
+                              example_inputs=inputs[args.batch_sizes[0]][:2])
+    model.warmup_encoder(args.batch_sizes, image_size=args.image_size, clip_k=args.clip_k)
+    print('{} + warm-up: {:.1f}s'.format(args.optimize, time.perf_counter() - start))
+
+    print('\t{:>10s}  {:>12s}  {:>12s}  {:>8s}  {:>10s}  {:>9s}'.format('batch_size', 'eager_ms', 'optimized_ms', 'speedup', 'max_diff', 'same_cls'))
+    for batch_size in args.batch_sizes:
+        image, clip_memory, reference = inputs[batch_size]
+        optimized = time_encoder(model, image, clip_memory, args.iters)
+        with torch.no_grad():
+            output = model.encode(image, clip_memory)
+        max_diff = (output[1] - reference[1]).abs().max().item()
+        same_cls = torch.equal(output[2], reference[2])
+        print('\t{:10d}  {:12.2f}  {:12.2f}  {:8.2f}  {:10.2e}  {:>9s}'.format(batch_size, eager[batch_size], optimized, eager[batch_size] / optimized, max_diff, str(same_cls)))
+
+if __name__ == '__main__':
+    main()
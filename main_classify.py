@@ -0,0 +1,138 @@
+import os, json
+import time
+import torch
+import argparse
+import numpy as np
+import torch.nn.functional as F
+from models.blip import blip_classifier, CONDITIONS
+from dataset import create_dataset_test
+from dataset import create_loader
+from modules import utils
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    # Data input settings
+    parser.add_argument('--image_dir', type=str, default='data/iu_xray/images/', help='the path to the directory containing the data.')
+    parser.add_argument('--ann_path', type=str, default='data/iu_xray/annotation.json', help='the path to the directory containing the data.')
+    parser.add_argument('--clip_features_path', type=str, default='./data/mimic_cxr/clip_text_features.json', help='the clip_text_features bank of the retrieved reports.')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+
+    # Data loader settings
+    parser.add_argument('--dataset_name', type=str, default='iu_xray', choices=['iu_xray', 'mimic_cxr'], help='the dataset to be used.')
+    parser.add_argument('--num_workers', type=int, default=4, help='the number of workers for dataloader.')
+    parser.add_argument('--batch_size', type=int, default=128, help='the number of samples for a batch')
+
+    # Model settings
+    parser.add_argument('--load_pretrained', type=str, default=None, help='pretrained path if any')
+    parser.add_argument('--tiny', action='store_true', help='random-init ResNet-18, nothing downloaded.')
+
+    # Calibration
+    parser.add_argument('--calibrate', action='store_true', help='fit per-condition temperatures on the val split before testing.')
+    parser.add_argument('--calibration_path', type=str, default=None, help='json file to save fitted temperatures to, or load them from.')
+    parser.add_argument('--output_path', type=str, default=None, help='json file to write the per-study probabilities to.')
+
+    # Others
+    parser.add_argument('--seed', type=int, default=9233, help='.')
+    parser.add_argument('--device', default='cuda')
+
+    # cls head
+    parser.add_argument('--clip_k', type=int, default=21, help='Number of retrieved reports from database.')
+
+    args = parser.parse_args()
+    return args
+
+
+def predict(model, dataloader, device):
+    """class logits (Nx4x18) and labels (Nx18, Nx14 for the val / test splits of MIMIC-CXR) over a split"""
+    all_logits, all_labels = [], []
+    with torch.no_grad():
+        for batch_idx, (images, captions, cls_labels, clip_memory) in enumerate(dataloader):
+            images = images.to(device)
+            clip_memory = clip_memory.to(device)
+            all_logits.append(model(images, clip_memory).float().cpu())
+            all_labels.append(cls_labels.long())
+            if batch_idx % 10 == 0:
+                print('{}/{}'.format(batch_idx, len(dataloader)))
+    return torch.cat(all_logits, 0), torch.cat(all_labels, 0)
+
+
+def classification_scores(probs, labels, n_bins=10):
+    """positive-class F1 and expected calibration error over the 14 conditions"""
+    probs = probs[:, :, :14]
+    labels = labels[:, :14]
+    preds = torch.argmax(probs, dim=1) == 1
+    gts = labels == 1
+    tp = (preds & gts).sum(0).float()
+    fp = (preds & ~gts).sum(0).float()
+    fn = (~preds & gts).sum(0).float()
+    f1 = 2 * tp / torch.clamp(2 * tp + fp + fn, min=1)
+
+    pos_probs = probs[:, 1].flatten()
+    gts = gts.flatten().float()
+    bins = torch.clamp((pos_probs * n_bins).long(), max=n_bins - 1)
+    ece = 0.
+    for b in range(n_bins):
+        in_bin = bins == b
+        if in_bin.any():
+            ece += in_bin.float().mean().item() * abs(pos_probs[in_bin].mean().item() - gts[in_bin].mean().item())
+    return {'cls_f1_macro': f1.mean().item(), 'cls_ece': ece}
+
+
+def main():
+    # parse arguments
+    args = parse_agrs()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    torch.backends.cudnn.benchmark = True
+
+    # the text decoder and tokenizer are never built
+    start = time.time()
+    model = blip_classifier(args, checkpoint=args.load_pretrained, image_size=args.image_size)
+    if args.load_pretrained:
+        print("load checkpoint from {}".format(args.load_pretrained))
+    model = model.to(device)
+    model.eval()
+    print('number of parameters: {}, startup: {:.1f}s'.format(utils.compute_n_params(model), time.time() - start))
+
+    if args.calibrate:
+        val_dataset = create_dataset_test('generation_%s'%args.dataset_name, None, args, split='val')
+        val_dataloader = create_loader([val_dataset], [None], batch_size=[args.batch_size], num_workers=[args.num_workers], is_trains=[False], collate_fns=[None])[0]
+        logits, labels = predict(model, val_dataloader, device)
+        nll_before, nll_after = model.calibrate(logits.to(device), labels.to(device))
+        print('calibration nll: {:.4f} -> {:.4f}'.format(nll_before, nll_after))
+        if args.calibration_path:
+            with open(args.calibration_path, 'w') as f:
+                json.dump(model.temperature.tolist(), f)
+    elif args.calibration_path and os.path.exists(args.calibration_path):
+        with open(args.calibration_path, 'r') as f:
+            model.temperature.copy_(torch.tensor(json.load(f)))
+        print("load temperatures from {}".format(args.calibration_path))
+
+    #### Dataset ####
+    test_dataset = create_dataset_test('generation_%s'%args.dataset_name, None, args)
+    print('number of testing samples: %d'%len(test_dataset))
+    test_dataloader = create_loader([test_dataset], [None], batch_size=[args.batch_size], num_workers=[args.num_workers], is_trains=[False], collate_fns=[None])[0]
+
+    start = time.time()
+    logits, labels = predict(model, test_dataloader, device)
+    elapsed = time.time() - start
+    probs = F.softmax(logits / model.temperature.cpu().view(1, 1, -1), dim=1)
+
+    log = classification_scores(probs, labels)
+    log['cls_nll'] = F.cross_entropy((logits / model.temperature.cpu().view(1, 1, -1))[:, :, :labels.size(1)], labels).item()
+    log['studies_per_sec'] = len(test_dataset) / max(elapsed, 1e-9)
+    for key, value in log.items():
+        print('\t{:15s}: {}'.format(str(key), value))
+
+    if args.output_path:
+        results = []
+        for i, prob in enumerate(probs[:, 1, :14].tolist()):
+            results.append({'index': i, 'probs': dict(zip(CONDITIONS, prob))})
+        with open(args.output_path, 'w') as f:
+            json.dump(results, f)
+
+if __name__ == '__main__':
+    main()
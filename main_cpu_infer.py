@@ -0,0 +1,140 @@
+import json
+import time
+import torch
+import argparse
+import numpy as np
+from models.blip import blip_decoder
+from models.quantization import quantize_blip
+from modules.cpu_runner import CPURunner, available_cores
+from modules.tokenizers import build_tokenizer, build_output_vocab
+from dataset import create_dataset_test
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    # Data input settings
+    parser.add_argument('--image_dir', type=str, default='data/iu_xray/images/', help='the path to the directory containing the data.')
+    parser.add_argument('--ann_path', type=str, default=None, help='annotation of the studies to run, random studies if not given.')
+    parser.add_argument('--clip_features_path', type=str, default='./data/mimic_cxr/clip_text_features.json', help='the clip_text_features bank of the retrieved reports.')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--dataset_name', type=str, default='iu_xray', choices=['iu_xray', 'mimic_cxr'], help='the dataset to be used.')
+    parser.add_argument('--batch_size', type=int, default=4, help='the number of studies per work item.')
+    parser.add_argument('--num_studies', type=int, default=64, help='the number of random studies when no annotation is given.')
+    parser.add_argument('--output_path', type=str, default=None, help='json file to write the generated reports to.')
+
+    # Model settings
+    parser.add_argument('--load_pretrained', type=str, default=None, help='pretrained path if any')
+    parser.add_argument('--tiny', action='store_true', help='random-init ResNet-18 and 2-layer BERT decoder (configs/bert_config_tiny.json), nothing downloaded.')
+    parser.add_argument('--bert_path', type=str, default='bert-base-uncased', help='the tokenizer: hub name or a local directory with vocab.txt.')
+
+    # Sample related
+    parser.add_argument('--beam_size', type=int, default=3, help='the beam size when beam searching.')
+    parser.add_argument('--gen_max_len', type=int, default=150, help='the maximum token length for text generation.')
+    parser.add_argument('--gen_min_len', type=int, default=100, help='the minimum token length for text generation.')
+    parser.add_argument('--compact_generation', action='store_true', help='drop finished samples from the running batch during generation.')
+    parser.add_argument('--output_vocab', type=str, default=None, help='json of the token ids the decoder may emit, built from the training reports of --ann_path if missing.')
+    parser.add_argument('--prepare_encoder', type=str, default='none', choices=['none', 'fold', 'fuse'], help='fold BatchNorm and run the ResNet channels-last, fuse also fuses conv+ReLU.')
+    parser.add_argument('--quantize', type=str, default='none', choices=['none', 'dynamic', 'static'], help='int8 inference, static needs --quant_encoder_path from main_quantize.py.')
+    parser.add_argument('--quant_encoder_path', type=str, default=None, help='the calibrated static int8 image encoder.')
+
+    # Worker settings
+    parser.add_argument('--num_procs', type=int, default=4, help='the number of worker processes.')
+    parser.add_argument('--threads_per_proc', type=int, default=0, help='intra-op threads per worker, 0 uses all cores assigned to it.')
+    parser.add_argument('--interop_threads', type=int, default=1, help='inter-op threads per worker.')
+    parser.add_argument('--no_pin', action='store_true', help='do not pin workers to disjoint cores.')
+    parser.add_argument('--scaling', action='store_true', help='also run with 1, 2, 4, ... workers and report the scaling efficiency.')
+
+    # Others
+    parser.add_argument('--seed', type=int, default=9233, help='.')
+
+    # cls head
+    parser.add_argument('--clip_k', type=int, default=21, help='Number of retrieved reports from database.')
+
+    args = parser.parse_args()
+    return args
+
+
+class StudyBatches(object):
+    """
+    Batch i of the test split of --ann_path, or of --num_studies random studies, built on access: CPURunner
+    workers load only the batches they take, the parent never holds the split.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.dataset = None
+        num_studies = args.num_studies
+        if args.ann_path is not None:
+            self.dataset = create_dataset_test('generation_%s'%args.dataset_name, None, args)
+            num_studies = len(self.dataset)
+            print('number of testing samples: %d'%num_studies)
+        self.starts = list(range(0, num_studies, args.batch_size)) + [num_studies]
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, index):
+        start, stop = self.starts[index], self.starts[index + 1]
+        if self.dataset is None:
+            # seeded per batch, so the random studies do not depend on which worker builds them
+            generator = torch.Generator().manual_seed(self.args.seed + index)
+            return (torch.randn(stop - start, 3, self.args.image_size, self.args.image_size, generator=generator),
+                    torch.randn(stop - start, self.args.clip_k, 512, generator=generator))
+        items = [self.dataset[i] for i in range(start, stop)]
+        return torch.stack([item[0] for item in items], 0), torch.stack([item[3] for item in items], 0)
+
+
+def main():
+    # parse arguments
+    args = parse_agrs()
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    # create tokenizer
+    tokenizer = build_tokenizer(args.bert_path)
+
+    # build model architecture, loaded once and shared with the forked workers
+    labels_temp = ['[BLA]'] * 18 # for calculate length only
+    prompt_temp = ' '.join(labels_temp)+' '
+    start = time.time()
+    model = blip_decoder(args, tokenizer, image_size=args.image_size, prompt=prompt_temp, checkpoint=args.load_pretrained)
+    if args.load_pretrained:
+        print("load checkpoint from {} in {:.1f}s".format(args.load_pretrained, time.time() - start))
+    model.eval()
+    if args.output_vocab is not None:
+        model.restrict_vocab(build_output_vocab(args.ann_path, tokenizer, cache_path=args.output_vocab))
+    if args.prepare_encoder != 'none':
+        model.visual_encoder.prepare_for_inference(channels_last=True, fuse_relu=args.prepare_encoder == 'fuse')
+    if args.quantize != 'none':
+        model = quantize_blip(model, args.quantize, args.quant_encoder_path)
+
+    batches = StudyBatches(args)
+
+    num_procs = [args.num_procs]
+    if args.scaling:
+        num_procs = sorted(set([2 ** i for i in range(int(np.log2(args.num_procs)) + 1)] + [args.num_procs]))
+        # keep the cores per worker fixed so that throughput is compared per core
+        if args.threads_per_proc <= 0:
+            args.threads_per_proc = max(len(available_cores()) // args.num_procs, 1)
+    base_throughput = None
+    for n in num_procs:
+        runner = CPURunner(model, num_workers=n, num_threads=args.threads_per_proc, num_interop_threads=args.interop_threads,
+                           pin_cores=not args.no_pin, num_beams=args.beam_size, max_length=args.gen_max_len, min_length=args.gen_min_len)
+        outputs, stats = runner.run(batches)
+        if base_throughput is None:
+            base_throughput = stats['throughput'] / n
+        stats['efficiency'] = stats['throughput'] / (n * base_throughput)
+        for key, value in stats.items():
+            print('\t{:15s}: {}'.format(str(key), value))
+
+    if args.output_path:
+        results = []
+        for reports, cls_preds, cls_preds_logits in outputs:
+            for report, pred in zip(reports, cls_preds):
+                results.append({'report': report, 'cls_preds': pred})
+        with open(args.output_path, 'w') as f:
+            json.dump(results, f)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import argparse
+from models.checkpoint import load_checkpoint, save_checkpoint
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--load_pretrained', type=str, required=True, help='the checkpoint to convert, .pth or .safetensors.')
+    parser.add_argument('--output_path', type=str, required=True, help='the converted checkpoint, the format follows the extension.')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_agrs()
+    state_dict = load_checkpoint(args.load_pretrained)
+    save_checkpoint(state_dict, args.output_path)
+    print('saved {} tensors to {}'.format(len(state_dict), args.output_path))
+
+if __name__ == '__main__':
+    main()
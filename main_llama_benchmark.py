@@ -0,0 +1,147 @@
+import time
+import torch
+import argparse
+import numpy as np
+from transformers import LlamaConfig, LlamaForCausalLM
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    # Model settings (a random-init LLaMA, no weights needed)
+    parser.add_argument('--hidden_size', type=int, default=256, help='hidden size of the random LLaMA.')
+    parser.add_argument('--intermediate_size', type=int, default=688, help='MLP size of the random LLaMA.')
+    parser.add_argument('--num_layers', type=int, default=4, help='number of decoder layers.')
+    parser.add_argument('--num_heads', type=int, default=8, help='number of attention heads.')
+    parser.add_argument('--vocab_size', type=int, default=32000, help='vocabulary size.')
+
+    # Benchmark settings
+    parser.add_argument('--task', type=str, default='decode', choices=['decode', 'packing'], help='KV-cache decoding or packed training steps.')
+    parser.add_argument('--prefix_len', type=int, default=80, help='visual + prompt prefix length fed as inputs_embeds.')
+    parser.add_argument('--new_tokens', type=int, nargs='+', default=[32, 64, 128, 256], help='report lengths to time.')
+    parser.add_argument('--batch_size', type=int, default=1, help='the number of studies per call.')
+    parser.add_argument('--num_visual', type=int, default=49, help='packing: visual prefix tokens per study.')
+    parser.add_argument('--max_prompt_len', type=int, default=75, help='packing: prompt lengths are drawn from [30, max_prompt_len].')
+    parser.add_argument('--max_caption_len', type=int, default=384, help='packing: caption lengths are drawn from [20, max_caption_len].')
+    parser.add_argument('--train_batch_size', type=int, default=8, help='packing: studies per training step.')
+    parser.add_argument('--pack_budget', type=int, default=0, help='packing: tokens per packed row, 0 uses the longest study.')
+    parser.add_argument('--steps', type=int, default=3, help='packing: timed training steps.')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default.')
+
+    # Others
+    parser.add_argument('--seed', type=int, default=9233, help='.')
+    parser.add_argument('--device', default='cpu')
+
+    args = parser.parse_args()
+    return args
+
+
+def greedy_decode(llama, inputs_embeds, new_tokens, use_cache):
+    """
+    greedy decoding after an inputs_embeds prefix. Without the cache every step re-runs the prefix and all
+    generated tokens (llama.generate cannot do that from inputs_embeds, it only feeds the prefix again).
+    """
+    embed_tokens = llama.get_input_embeddings()
+    tokens = []
+    past = None
+    for _ in range(new_tokens):
+        if past is None or not use_cache:
+            embeds = inputs_embeds if len(tokens) == 0 else torch.cat([inputs_embeds, embed_tokens(torch.stack(tokens, 1))], 1)
+            output = llama(inputs_embeds=embeds, use_cache=use_cache, return_dict=True)
+        else:
+            output = llama(input_ids=tokens[-1].unsqueeze(1), past_key_values=past, use_cache=True, return_dict=True)
+        past = output.past_key_values if use_cache else None
+        tokens.append(output.logits[:, -1].argmax(-1))
+    return torch.stack(tokens, 1)
+
+
+def time_decode(llama, inputs_embeds, new_tokens, use_cache):
+    """ms per generated token, and the generated tokens"""
+    with torch.no_grad():
+        greedy_decode(llama, inputs_embeds, 2, use_cache)
+        if inputs_embeds.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        tokens = greedy_decode(llama, inputs_embeds, new_tokens, use_cache)
+        if inputs_embeds.is_cuda:
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / new_tokens * 1000., tokens
+
+
+def random_batch(args, device):
+    """[visual | right-padded prompt | right-padded caption] like BLIP_Decoder.forward of models/blip_llama.py"""
+    prompt_lens = np.random.randint(30, args.max_prompt_len + 1, args.train_batch_size)
+    caption_lens = np.random.randint(20, args.max_caption_len + 1, args.train_batch_size)
+    prompt_max, caption_max = prompt_lens.max(), caption_lens.max()
+    seq_len = args.num_visual + prompt_max + caption_max
+    attention_mask = torch.zeros(args.train_batch_size, seq_len, dtype=torch.long, device=device)
+    labels = torch.full((args.train_batch_size, seq_len), -100, dtype=torch.long, device=device)
+    for i in range(args.train_batch_size):
+        caption_start = args.num_visual + prompt_max
+        attention_mask[i, :args.num_visual + prompt_lens[i]] = 1
+        attention_mask[i, caption_start:caption_start + caption_lens[i]] = 1
+        labels[i, caption_start:caption_start + caption_lens[i]] = torch.randint(0, args.vocab_size, (caption_lens[i],), device=device)
+    inputs_embeds = torch.randn(args.train_batch_size, seq_len, args.hidden_size, device=device) * 0.02
+    return inputs_embeds, attention_mask, labels
+
+
+def time_training(llama, args, device, packed):
+    """real (non-pad) tokens per second of forward + backward, and the padding efficiency"""
+    from models.packing import pack_batch, packed_llama_forward, packed_lm_loss
+    tokens, slots, elapsed = 0, 0, 0.
+    for step in range(args.steps + 1):
+        inputs_embeds, attention_mask, labels = random_batch(args, device)
+        start = time.perf_counter()
+        if packed:
+            batch = pack_batch(inputs_embeds, attention_mask, labels, budget=args.pack_budget)
+            hidden = packed_llama_forward(llama, batch['inputs_embeds'], batch['position_ids'], batch['seq_ids'])
+            loss = packed_lm_loss(llama, hidden, batch['labels'])
+            slots_step = batch['packed_slots']
+        else:
+            loss = llama(inputs_embeds=inputs_embeds, attention_mask=attention_mask, labels=labels, return_dict=True).loss
+            slots_step = attention_mask.numel()
+        loss.backward()
+        llama.zero_grad(set_to_none=True)
+        if inputs_embeds.is_cuda:
+            torch.cuda.synchronize()
+        # the first step is warm-up
+        if step > 0:
+            elapsed += time.perf_counter() - start
+            tokens += int(attention_mask.sum())
+            slots += slots_step
+    return tokens / elapsed, tokens / slots
+
+
+def main():
+    # parse arguments
+    args = parse_agrs()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    config = LlamaConfig(vocab_size=args.vocab_size, hidden_size=args.hidden_size, intermediate_size=args.intermediate_size,
+                         num_hidden_layers=args.num_layers, num_attention_heads=args.num_heads,
+                         max_position_embeddings=max(args.prefix_len + max(args.new_tokens), args.num_visual + args.max_prompt_len + args.max_caption_len) + 8)
+    llama = LlamaForCausalLM(config).to(device).eval()
+
+    if args.task == 'packing':
+        llama.train()
+        for name, packed in [('padded', False), ('packed', True)]:
+            np.random.seed(args.seed)
+            tokens_per_sec, efficiency = time_training(llama, args, device, packed)
+            print('\t{:15s}: {:.1f} tokens/s, padding efficiency {:.3f}'.format(name, tokens_per_sec, efficiency))
+        return
+
+    inputs_embeds = torch.randn(args.batch_size, args.prefix_len, args.hidden_size, device=device) * 0.02
+
+    print('\t{:>10s}  {:>15s}  {:>12s}  {:>8s}  {:>11s}'.format('new_tokens', 'no_cache_ms/tok', 'cache_ms/tok', 'speedup', 'same_tokens'))
+    for new_tokens in args.new_tokens:
+        no_cache, no_cache_tokens = time_decode(llama, inputs_embeds, new_tokens, use_cache=False)
+        cache, cache_tokens = time_decode(llama, inputs_embeds, new_tokens, use_cache=True)
+        same_tokens = torch.equal(no_cache_tokens, cache_tokens)
+        print('\t{:10d}  {:15.2f}  {:12.2f}  {:8.2f}  {:>11s}'.format(new_tokens, no_cache, cache, no_cache / cache, str(same_tokens)))
+
+if __name__ == '__main__':
+    main()
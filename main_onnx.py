@@ -0,0 +1,96 @@
+import time
+import torch
+import argparse
+import numpy as np
+from models.blip import blip_decoder
+from modules.tokenizers import build_tokenizer
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    # Data input settings
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+
+    # Model settings
+    parser.add_argument('--load_pretrained', type=str, default=None, help='pretrained path if any')
+    parser.add_argument('--tiny', action='store_true', help='random-init ResNet-18 and 2-layer BERT decoder (configs/bert_config_tiny.json), nothing downloaded.')
+    parser.add_argument('--bert_path', type=str, default='bert-base-uncased', help='the tokenizer: hub name or a local directory with vocab.txt.')
+
+    # Sample related
+    parser.add_argument('--beam_size', type=int, default=3, help='the beam size when beam searching.')
+    parser.add_argument('--gen_max_len', type=int, default=150, help='the maximum token length for text generation.')
+    parser.add_argument('--gen_min_len', type=int, default=100, help='the minimum token length for text generation.')
+
+    # ONNX settings
+    parser.add_argument('--onnx_dir', type=str, default='results/promptmrg/onnx', help='where the onnx graphs are written to / read from.')
+    parser.add_argument('--opset', type=int, default=17, help='the onnx opset version.')
+    parser.add_argument('--skip_export', action='store_true', help='reuse the graphs already in --onnx_dir.')
+    parser.add_argument('--parity', action='store_true', help='compare ONNX Runtime against BLIP_Decoder.generate on random studies.')
+    parser.add_argument('--num_studies', type=int, default=8, help='the number of random studies for the parity check.')
+    parser.add_argument('--num_threads', type=int, default=0, help='intra-op threads of both runtimes, 0 keeps the default.')
+
+    # Others
+    parser.add_argument('--seed', type=int, default=9233, help='.')
+
+    # cls head
+    parser.add_argument('--clip_k', type=int, default=21, help='Number of retrieved reports from database.')
+
+    args = parser.parse_args()
+    return args
+
+
+def parity(model, args):
+    from models.onnx_generate import OnnxReportGenerator
+    generator = OnnxReportGenerator(args.onnx_dir, num_threads=args.num_threads, tokenizer=model.tokenizer)
+    image = torch.randn(args.num_studies, 3, args.image_size, args.image_size)
+    clip_memory = torch.randn(args.num_studies, args.clip_k, 512)
+    log = {}
+    for num_beams in sorted(set([1, args.beam_size])):
+        start = time.time()
+        with torch.no_grad():
+            reports, cls_preds, cls_preds_logits = model.generate(image, clip_memory, sample=False, num_beams=num_beams,
+                                                                  max_length=args.gen_max_len, min_length=args.gen_min_len)
+        torch_time = time.time() - start
+        start = time.time()
+        onnx_reports, onnx_cls_preds, onnx_cls_preds_logits = generator.generate(image.numpy(), clip_memory.numpy(), num_beams=num_beams,
+                                                                                 max_length=args.gen_max_len, min_length=args.gen_min_len)
+        onnx_time = time.time() - start
+        prefix = 'beam{}_'.format(num_beams)
+        log[prefix + 'same_reports'] = float(np.mean([r == o for r, o in zip(reports, onnx_reports)]))
+        log[prefix + 'same_cls'] = float(np.mean(np.array(cls_preds) == np.array(onnx_cls_preds)))
+        log[prefix + 'max_prob_diff'] = float(np.abs(cls_preds_logits.numpy() - onnx_cls_preds_logits).max())
+        log[prefix + 'torch_time'] = torch_time
+        log[prefix + 'onnx_time'] = onnx_time
+    return log
+
+
+def main():
+    # parse arguments
+    args = parse_agrs()
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    # create tokenizer
+    tokenizer = build_tokenizer(args.bert_path)
+
+    # build model architecture
+    labels_temp = ['[BLA]'] * 18 # for calculate length only
+    prompt_temp = ' '.join(labels_temp)+' '
+    model = blip_decoder(args, tokenizer, image_size=args.image_size, prompt=prompt_temp, checkpoint=args.load_pretrained)
+    model.eval()
+
+    if not args.skip_export:
+        from models.onnx_export import export_onnx
+        export_onnx(model, args.onnx_dir, image_size=args.image_size, clip_k=args.clip_k, opset=args.opset)
+        print('export onnx graphs to {}'.format(args.onnx_dir))
+
+    if args.parity:
+        log = parity(model, args)
+        for key, value in log.items():
+            print('\t{:15s}: {}'.format(str(key), value))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import os, json
+import copy
+import time
+import torch
+from torch import nn
+import argparse
+import numpy as np
+from modules.metrics import compute_scores
+from modules.tester import Tester
+from models.blip import blip_decoder
+from modules.tokenizers import build_tokenizer
+from models.quantization import quantize_blip, quantize_static_encoder, save_static_encoder
+from dataset import create_dataset_test
+from dataset import create_loader
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    # Data input settings
+    parser.add_argument('--image_dir', type=str, default='data/iu_xray/images/', help='the path to the directory containing the data.')
+    parser.add_argument('--ann_path', type=str, default='data/iu_xray/annotation.json', help='the path to the directory containing the data.')
+    parser.add_argument('--clip_features_path', type=str, default='./data/mimic_cxr/clip_text_features.json', help='the clip_text_features bank of the retrieved reports.')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+
+    # Data loader settings
+    parser.add_argument('--dataset_name', type=str, default='iu_xray', choices=['iu_xray', 'mimic_cxr'], help='the dataset to be used.')
+    parser.add_argument('--num_workers', type=int, default=4, help='the number of workers for dataloader.')
+    parser.add_argument('--batch_size', type=int, default=16, help='the number of samples for a batch')
+
+    # Model settings
+    parser.add_argument('--load_pretrained', type=str, default=None, help='pretrained path if any')
+    parser.add_argument('--tiny', action='store_true', help='random-init ResNet-18 and 2-layer BERT decoder (configs/bert_config_tiny.json), nothing downloaded.')
+    parser.add_argument('--bert_path', type=str, default='bert-base-uncased', help='the tokenizer: hub name or a local directory with vocab.txt.')
+    parser.add_argument('--chexbert_path', type=str, default='./checkpoints/stanford/chexbert/chexbert.pth', help='the CheXbert checkpoint for the clinical efficacy metrics.')
+    parser.add_argument('--chexbert_bert', type=str, default='bert-base-uncased', help='config and vocab of CheXbert: hub name or a local directory.')
+
+    # Sample related
+    parser.add_argument('--beam_size', type=int, default=3, help='the beam size when beam searching.')
+    parser.add_argument('--gen_max_len', type=int, default=150, help='the maximum token length for text generation.')
+    parser.add_argument('--gen_min_len', type=int, default=100, help='the minimum token length for text generation.')
+    parser.add_argument('--compact_generation', action='store_true', help='drop finished samples from the running batch during generation.')
+
+    # Quantization
+    parser.add_argument('--quantize', type=str, default='dynamic', choices=['dynamic', 'static'], help='dynamic int8 linears, static additionally quantizes the image encoder.')
+    parser.add_argument('--calib_batches', type=int, default=32, help='the number of val batches used to calibrate the static encoder.')
+    parser.add_argument('--quant_encoder_path', type=str, default=None, help='where to save the calibrated static int8 encoder.')
+    parser.add_argument('--quant_backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'], help='the quantized kernel backend.')
+    parser.add_argument('--skip_fp32', action='store_true', help='only evaluate the quantized model.')
+
+    # Trainer settings
+    parser.add_argument('--epochs', type=int, default=100, help='the number of training epochs.')
+    parser.add_argument('--save_dir', type=str, default='results/iu_xray', help='the patch to save the models.')
+
+    # Others
+    parser.add_argument('--seed', type=int, default=9233, help='.')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default.')
+
+    # cls head
+    parser.add_argument('--clip_k', type=int, default=21, help='Number of retrieved reports from database.')
+
+    args = parser.parse_args()
+    return args
+
+
+def evaluate(tester, model):
+    tester.model = model
+    start = time.time()
+    log = tester.test_blip()
+    log['test_time'] = time.time() - start
+    return log
+
+
+def main():
+    # parse arguments
+    args = parse_agrs()
+    # quantized kernels only run on CPU
+    device = torch.device('cpu')
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    # create tokenizer
+    tokenizer = build_tokenizer(args.bert_path)
+
+    #### Dataset ####
+    test_dataset = create_dataset_test('generation_%s'%args.dataset_name, tokenizer, args)
+    print('number of testing samples: %d'%len(test_dataset))
+    test_dataloader = create_loader([test_dataset], [None], batch_size=[args.batch_size], num_workers=[args.num_workers], is_trains=[False], collate_fns=[None])[0]
+
+    # build model architecture
+    labels_temp = ['[BLA]'] * 18 # for calculate length only
+    prompt_temp = ' '.join(labels_temp)+' '
+    model = blip_decoder(args, tokenizer, image_size=args.image_size, prompt=prompt_temp, checkpoint=args.load_pretrained)
+    model.eval()
+
+    qmodel = copy.deepcopy(model)
+    if args.quantize == 'static':
+        # calibrate the encoder's activation ranges on the val split
+        val_dataset = create_dataset_test('generation_%s'%args.dataset_name, tokenizer, args, split='val')
+        val_dataloader = create_loader([val_dataset], [None], batch_size=[args.batch_size], num_workers=[args.num_workers], is_trains=[False], collate_fns=[None])[0]
+        calib_images = (images for batch_idx, (images, captions, cls_labels, clip_memory) in enumerate(val_dataloader) if batch_idx < args.calib_batches)
+        quantize_static_encoder(qmodel, calib_images, backend=args.quant_backend)
+        if args.quant_encoder_path:
+            save_static_encoder(qmodel, args.quant_encoder_path)
+            print('save calibrated encoder to {}'.format(args.quant_encoder_path))
+    quantize_blip(qmodel, 'dynamic', backend=args.quant_backend)
+
+    criterion_cls = nn.CrossEntropyLoss()
+    tester = Tester(model, criterion_cls, compute_scores, args, device, test_dataloader)
+
+    logs = {}
+    if not args.skip_fp32:
+        logs['fp32'] = evaluate(tester, model)
+    logs['int8'] = evaluate(tester, qmodel)
+
+    # side by side report of the accuracy / speed trade-off
+    print('\t{:15s}  {:>10s}  {:>10s}  {:>10s}'.format('metric', 'fp32', 'int8', 'delta'))
+    for key, value in logs['int8'].items():
+        if 'fp32' in logs:
+            print('\t{:15s}  {:10.4f}  {:10.4f}  {:+10.4f}'.format(key, logs['fp32'][key], value, value - logs['fp32'][key]))
+        else:
+            print('\t{:15s}  {:>10s}  {:10.4f}'.format(key, '-', value))
+    os.makedirs(args.save_dir, exist_ok=True)
+    with open(os.path.join(args.save_dir, 'quantization_report.json'), 'w') as f:
+        json.dump(logs, f, indent=2)
+
+if __name__ == '__main__':
+    main()
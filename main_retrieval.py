@@ -0,0 +1,97 @@
+import time
+import torch
+import argparse
+import numpy as np
+from models.retrieval import RetrievalIndex
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    # Bank settings
+    parser.add_argument('--features_path', type=str, default='./data/mimic_cxr/clip_text_features.json', help='the clip_text_features bank.')
+    parser.add_argument('--num_features', type=int, default=0, help='use a random clustered bank of this size instead of --features_path.')
+    parser.add_argument('--feature_dim', type=int, default=512, help='feature size of the random bank.')
+
+    # Index settings
+    parser.add_argument('--nlist', type=int, default=256, help='ivfpq: the number of k-means cells.')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32], help='ivfpq: cells scanned per query.')
+    parser.add_argument('--num_subspaces', type=int, default=32, help='ivfpq: one-byte codes per feature.')
+    parser.add_argument('--rerank', type=int, nargs='+', default=[0, 4], help='ivfpq: re-score rerank * clip_k candidates exactly.')
+    parser.add_argument('--retrieval_index', type=str, default=None, help='where to cache the trained IVF-PQ index.')
+
+    # Query settings
+    parser.add_argument('--clip_k', type=int, default=21, help='Number of retrieved reports from database.')
+    parser.add_argument('--num_queries', type=int, default=1000, help='the number of timed queries.')
+    parser.add_argument('--query_noise', type=float, default=0.5, help='queries are bank features plus this much relative gaussian noise.')
+    parser.add_argument('--batch_size', type=int, default=64, help='queries per search call.')
+
+    # Others
+    parser.add_argument('--seed', type=int, default=9233, help='.')
+    parser.add_argument('--device', default='cpu')
+
+    args = parser.parse_args()
+    return args
+
+
+def random_bank(num_features, dim, num_topics=512):
+    """unit features around num_topics directions, closer to a report bank than isotropic noise"""
+    topics = torch.nn.functional.normalize(torch.randn(num_topics, dim), dim=-1)
+    features = topics[torch.randint(0, num_topics, (num_features,))] + 0.5 * torch.randn(num_features, dim) / dim ** 0.5
+    return torch.nn.functional.normalize(features, dim=-1)
+
+
+def time_search(index, queries, k, batch_size):
+    """queries per second and the retrieved indices"""
+    index.search(queries[:batch_size], k)
+    if queries.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    indices = torch.cat([index.search(queries[i:i + batch_size], k)[1] for i in range(0, queries.size(0), batch_size)], 0)
+    if queries.is_cuda:
+        torch.cuda.synchronize()
+    return queries.size(0) / (time.perf_counter() - start), indices
+
+
+def recall(indices, exact):
+    """mean fraction of the exact top-k that is retrieved"""
+    hits = (indices.unsqueeze(2) == exact.unsqueeze(1)).any(1).float()
+    return hits.mean().item()
+
+
+def main():
+    # parse arguments
+    args = parse_agrs()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    if args.num_features > 0:
+        features = random_bank(args.num_features, args.feature_dim)
+        exact_index = RetrievalIndex(features, mode='exact')
+    else:
+        exact_index = RetrievalIndex.from_json(args.features_path, mode='exact')
+        features = exact_index.features
+    exact_index.to(device)
+    print('bank of {} features of size {}'.format(features.size(0), features.size(1)))
+
+    picks = torch.randint(0, features.size(0), (args.num_queries,))
+    queries = torch.nn.functional.normalize(features[picks], dim=-1)
+    queries = (queries + args.query_noise * torch.randn_like(queries) / queries.size(1) ** 0.5).to(device)
+
+    exact_qps, exact = time_search(exact_index, queries, args.clip_k, args.batch_size)
+
+    start = time.time()
+    index = RetrievalIndex(features, mode='ivfpq', nlist=args.nlist, num_subspaces=args.num_subspaces).to(device).build(args.retrieval_index)
+    print('ivfpq index ready in {:.1f}s'.format(time.time() - start))
+
+    print('\t{:>6s}  {:>6s}  {:>6s}  {:>10s}  {:>9s}'.format('mode', 'nprobe', 'rerank', 'recall@{}'.format(args.clip_k), 'qps'))
+    print('\t{:>6s}  {:>6s}  {:>6s}  {:10.4f}  {:9.1f}'.format('exact', '-', '-', 1.0, exact_qps))
+    for rerank in args.rerank:
+        for nprobe in args.nprobe:
+            index.nprobe, index.rerank = nprobe, rerank
+            qps, indices = time_search(index, queries, args.clip_k, args.batch_size)
+            print('\t{:>6s}  {:6d}  {:6d}  {:10.4f}  {:9.1f}'.format('ivfpq', nprobe, rerank, recall(indices, exact), qps))
+
+if __name__ == '__main__':
+    main()
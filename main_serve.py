@@ -0,0 +1,135 @@
+import asyncio
+import time
+import torch
+import argparse
+import numpy as np
+from models.blip import blip_decoder
+from modules.serving import ReportServer
+from models.retrieval import build_retriever
+from modules.tokenizers import build_tokenizer, build_output_vocab
+from modules import utils
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    # Data input settings
+    parser.add_argument('--ann_path', type=str, default=None, help='annotation whose training reports build --output_vocab if that json does not exist yet.')
+    parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--clip_features_path', type=str, default='./data/mimic_cxr/clip_text_features.json', help='the clip_text_features bank of the retrieved reports.')
+
+    # Model settings
+    parser.add_argument('--load_pretrained', type=str, default=None, help='pretrained path if any')
+    parser.add_argument('--tiny', action='store_true', help='random-init ResNet-18 and 2-layer BERT decoder (configs/bert_config_tiny.json), nothing downloaded.')
+    parser.add_argument('--bert_path', type=str, default='bert-base-uncased', help='the tokenizer: hub name or a local directory with vocab.txt.')
+
+    # Sample related
+    parser.add_argument('--beam_size', type=int, default=3, help='the beam size when beam searching.')
+    parser.add_argument('--gen_max_len', type=int, default=150, help='the maximum token length for text generation.')
+    parser.add_argument('--gen_min_len', type=int, default=100, help='the minimum token length for text generation.')
+    parser.add_argument('--compact_generation', action='store_true', help='drop finished samples from the running batch during generation.')
+    parser.add_argument('--output_vocab', type=str, default=None, help='json of the token ids the decoder may emit, built from the training reports of --ann_path if missing.')
+    parser.add_argument('--prepare_encoder', type=str, default='none', choices=['none', 'fold', 'fuse'], help='fold BatchNorm and run the ResNet channels-last, fuse also fuses conv+ReLU.')
+    parser.add_argument('--compile_encoder', type=str, default='none', choices=['none', 'compile', 'trace'], help='run the image encoder, memory and classification head as a compiled graph.')
+    parser.add_argument('--compile_cache', type=str, default=None, help='where to cache the traced encoder.')
+
+    # Serving settings
+    parser.add_argument('--max_batch_size', type=int, default=16, help='the maximum number of studies in a micro-batch.')
+    parser.add_argument('--max_wait_ms', type=float, default=50, help='how long the oldest queued study may wait for a batch to fill.')
+    parser.add_argument('--num_requests', type=int, default=64, help='the number of studies sent by the synthetic client.')
+    parser.add_argument('--request_rate', type=float, default=4, help='mean arrival rate (studies / s) of the synthetic client, 0 queues all of them at once.')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default.')
+
+    # Retrieval of clip_indices for new studies (models/retrieval.py)
+    parser.add_argument('--retrieval', type=str, default='none', choices=['none', 'exact', 'ivfpq'], help='retrieve the top clip_k reports for studies without clip_indices.')
+    parser.add_argument('--embed_fn', type=str, default=None, help='module:name of the callable embedding preprocessed images into the clip_text_features space.')
+    parser.add_argument('--retrieval_index', type=str, default=None, help='where to cache the trained IVF-PQ index.')
+    parser.add_argument('--nlist', type=int, default=256, help='ivfpq: the number of k-means cells.')
+    parser.add_argument('--nprobe', type=int, default=16, help='ivfpq: the number of cells scanned per query.')
+    parser.add_argument('--num_subspaces', type=int, default=32, help='ivfpq: one-byte codes per feature.')
+    parser.add_argument('--rerank', type=int, default=4, help='ivfpq: re-score rerank * clip_k candidates exactly, 0 disables it.')
+
+    # Others
+    parser.add_argument('--seed', type=int, default=9233, help='.')
+    parser.add_argument('--device', default='cpu')
+
+    # cls head
+    parser.add_argument('--clip_k', type=int, default=21, help='Number of retrieved reports from database.')
+
+    args = parser.parse_args()
+    return args
+
+
+async def synthetic_client(server, args):
+    """send random studies with Poisson arrivals and print results as they stream back"""
+    async def request(i):
+        image = torch.randn(3, args.image_size, args.image_size)
+        # with a retriever the server looks the reports up itself
+        clip_memory = torch.randn(args.clip_k, 512) if server.retriever is None else None
+        return i, await server.submit(image, clip_memory)
+
+    tasks = []
+    for i in range(args.num_requests):
+        tasks.append(asyncio.ensure_future(request(i)))
+        if args.request_rate > 0:
+            await asyncio.sleep(np.random.exponential(1.0 / args.request_rate))
+    for n, task in enumerate(asyncio.as_completed(tasks)):
+        i, result = await task
+        if n % 10 == 0:
+            print('{}/{} request {}: {}'.format(n, args.num_requests, i, result['report'][:80]))
+
+
+async def serve(model, device, args, retriever=None):
+    server = ReportServer(model, device, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                          num_beams=args.beam_size, max_length=args.gen_max_len, min_length=args.gen_min_len, retriever=retriever)
+    await server.start()
+    await synthetic_client(server, args)
+    await server.stop()
+    return server.stats
+
+
+def main():
+    # parse arguments
+    args = parse_agrs()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    # create tokenizer
+    tokenizer = build_tokenizer(args.bert_path)
+
+    # build model architecture
+    labels_temp = ['[BLA]'] * 18 # for calculate length only
+    prompt_temp = ' '.join(labels_temp)+' '
+    start = time.time()
+    model = blip_decoder(args, tokenizer, image_size=args.image_size, prompt=prompt_temp, checkpoint=args.load_pretrained)
+    if args.load_pretrained:
+        print("load checkpoint from {} in {:.1f}s".format(args.load_pretrained, time.time() - start))
+    model = model.to(device)
+    model.eval()
+    if args.output_vocab is not None:
+        model.restrict_vocab(build_output_vocab(args.ann_path, tokenizer, cache_path=args.output_vocab))
+    if args.prepare_encoder != 'none':
+        model.visual_encoder.prepare_for_inference(channels_last=True, fuse_relu=args.prepare_encoder == 'fuse')
+    if args.compile_encoder != 'none':
+        example_inputs = (torch.randn(1, 3, args.image_size, args.image_size, device=device), torch.randn(1, args.clip_k, 512, device=device))
+        model.eval().compile_encoder(args.compile_encoder, cache_path=args.compile_cache, example_inputs=example_inputs)
+        model.warmup_encoder([1, args.max_batch_size], image_size=args.image_size, clip_k=args.clip_k)
+    print('number of parameters: {}'.format(utils.compute_n_params(model)))
+    retriever = None
+    if args.retrieval != 'none':
+        assert args.embed_fn is not None, '--retrieval needs --embed_fn'
+        retriever = build_retriever(args.retrieval, args.embed_fn, clip_k=args.clip_k, device=device, features_path=args.clip_features_path,
+                                    cache_path=args.retrieval_index, nlist=args.nlist, nprobe=args.nprobe, num_subspaces=args.num_subspaces, rerank=args.rerank)
+
+    stats = asyncio.run(serve(model, device, args, retriever))
+    for key, value in stats.summary().items():
+        print('\t{:15s}: {}'.format(str(key), value))
+    for name, hist in stats.histograms().items():
+        print('\t{}:'.format(name))
+        print(hist)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import os, json
+import torch
+from torch import nn
+import argparse
+import numpy as np
+from PIL import Image
+from transformers import BertConfig, BertModel
+from transformers.models.bert.tokenization_bert import BasicTokenizer
+from dataset.utils import my_pre_caption
+from models.blip import CONDITIONS
+
+
+def parse_agrs():
+    parser = argparse.ArgumentParser()
+
+    # Output settings
+    parser.add_argument('--output_dir', type=str, default='data/synthetic', help='where to write the synthetic dataset and tiny models.')
+    parser.add_argument('--llama', action='store_true', help='also write a 2-layer random LLaMA with a SentencePiece tokenizer (needs sentencepiece).')
+    parser.add_argument('--llama_vocab_size', type=int, default=512, help='llama: SentencePiece vocabulary size.')
+
+    # Data settings
+    parser.add_argument('--num_train', type=int, default=64, help='the number of training studies (also the size of the retrieval bank).')
+    parser.add_argument('--num_val', type=int, default=16, help='the number of validation studies.')
+    parser.add_argument('--num_test', type=int, default=16, help='the number of testing studies.')
+    parser.add_argument('--max_views', type=int, default=2, help='studies have 1 to max_views images.')
+    parser.add_argument('--image_size', type=int, default=256, help='side of the written images.')
+    parser.add_argument('--feature_dim', type=int, default=512, help='size of the clip_text_features.')
+    parser.add_argument('--clip_k', type=int, default=21, help='retrieved reports per study.')
+
+    # Others
+    parser.add_argument('--seed', type=int, default=9233, help='.')
+
+    args = parser.parse_args()
+    return args
+
+
+# one finding sentence per condition and state (positive / negative / uncertain), blank conditions are not mentioned
+FINDINGS = {
+    1: 'there is {}.',
+    2: 'no {} is seen.',
+    3: 'possible {} cannot be excluded.',
+}
+NORMAL = ['the heart size is normal.', 'the lungs are clear.', 'no acute cardiopulmonary process.',
+          'the osseous structures are unremarkable.', 'the mediastinal contours are within normal limits.']
+
+
+def make_study(rng, labels):
+    """a report that mentions its labels, so that the classification head and the reports stay consistent"""
+    sentences = [FINDINGS[state].format(condition) for condition, state in zip(CONDITIONS, labels[:14]) if state > 0]
+    sentences += list(rng.choice(NORMAL, rng.randint(1, 4), replace=False))
+    rng.shuffle(sentences)
+    return ' '.join(sentences)
+
+
+def make_labels(rng):
+    """18 states in 0..3 (blank, positive, negative, uncertain), mostly blank like the real label distribution"""
+    return rng.choice(4, 18, p=[0.6, 0.15, 0.2, 0.05]).tolist()
+
+
+def write_image(rng, path, size):
+    """a smooth random grayscale image, cheap to decode and to resize like a radiograph"""
+    coarse = rng.randint(0, 256, (size // 16, size // 16)).astype(np.uint8)
+    Image.fromarray(coarse).resize((size, size), Image.BILINEAR).save(path)
+
+
+def label_features(rng, annotations, feature_dim):
+    """a text feature per study: the sum of one random direction per (condition, state) plus noise, unit norm"""
+    directions = rng.randn(14 * 4, feature_dim)
+    features = []
+    for ann in annotations:
+        feature = directions[np.arange(14) * 4 + np.array(ann['labels'][:14])].sum(0) + rng.randn(feature_dim)
+        features.append(feature / np.linalg.norm(feature))
+    return np.array(features, dtype=np.float32)
+
+
+def write_vocab(path, reports):
+    """BERT vocab.txt with the special tokens and every word / punctuation mark of the reports"""
+    basic = BasicTokenizer(do_lower_case=True)
+    words = set()
+    for report in reports:
+        words.update(basic.tokenize(report))
+        words.update(basic.tokenize(my_pre_caption(report)))
+    with open(path, 'w') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(words)) + '\n')
+    return len(words) + 5
+
+
+def write_chexbert(output_dir, vocab_path, vocab_size):
+    """random-init CheXbert (configs/chexbert_config_tiny.json) saved like chexbert.pth, with its config and vocab"""
+    os.makedirs(output_dir, exist_ok=True)
+    config = BertConfig.from_json_file('configs/chexbert_config_tiny.json')
+    config.vocab_size = vocab_size
+    config.save_pretrained(output_dir)
+    with open(vocab_path, 'r') as f, open(os.path.join(output_dir, 'vocab.txt'), 'w') as g:
+        g.write(f.read())
+    bert = BertModel(config)
+    heads = nn.ModuleList([nn.Linear(config.hidden_size, 4) for _ in range(13)] + [nn.Linear(config.hidden_size, 2)])
+    state_dict = {'module.bert.' + k: v for k, v in bert.state_dict().items()}
+    state_dict.update({'module.linear_heads.' + k: v for k, v in heads.state_dict().items()})
+    torch.save({'model_state_dict': state_dict}, os.path.join(output_dir, 'chexbert.pth'))
+
+
+def write_llama(output_dir, reports, vocab_size):
+    """2-layer random LLaMA (configs/llama_config_tiny.json) and a SentencePiece tokenizer trained on the reports"""
+    import sentencepiece as spm
+    from transformers import LlamaConfig, LlamaForCausalLM, LlamaTokenizer
+    os.makedirs(output_dir, exist_ok=True)
+    spm.SentencePieceTrainer.train(sentence_iterator=iter(reports), model_prefix=os.path.join(output_dir, 'tokenizer'),
+                                   vocab_size=vocab_size, model_type='bpe', byte_fallback=True, hard_vocab_limit=False,
+                                   unk_id=0, bos_id=1, eos_id=2, pad_id=-1, minloglevel=2)
+    tokenizer = LlamaTokenizer(vocab_file=os.path.join(output_dir, 'tokenizer.model'))
+    tokenizer.save_pretrained(output_dir)
+    config = LlamaConfig.from_json_file('configs/llama_config_tiny.json')
+    config.vocab_size = len(tokenizer)
+    LlamaForCausalLM(config).save_pretrained(output_dir)
+
+
+def main():
+    # parse arguments
+    args = parse_agrs()
+    assert args.num_train >= args.clip_k, 'the retrieval bank (the training studies) needs at least clip_k reports'
+    rng = np.random.RandomState(args.seed)
+    torch.manual_seed(args.seed)
+
+    image_dir = os.path.join(args.output_dir, 'images')
+    os.makedirs(image_dir, exist_ok=True)
+
+    # studies: images, labels and reports
+    annotation = {}
+    for split, num in [('train', args.num_train), ('val', args.num_val), ('test', args.num_test)]:
+        annotation[split] = []
+        for i in range(num):
+            study_id = '{}_{:05d}'.format(split, i)
+            os.makedirs(os.path.join(image_dir, study_id), exist_ok=True)
+            image_path = [os.path.join(study_id, '{}.png'.format(v)) for v in range(rng.randint(1, args.max_views + 1))]
+            for path in image_path:
+                write_image(rng, os.path.join(image_dir, path), args.image_size)
+            labels = make_labels(rng)
+            # like the real annotation: 18 labels (14 CheXpert + 4 auxiliary) for training, the 14 CheXpert ones otherwise
+            annotation[split].append({'id': study_id, 'image_path': image_path, 'report': make_study(rng, labels),
+                                      'labels': labels if split == 'train' else labels[:14], 'split': split})
+
+    # retrieval bank: one text feature per training report, clip_indices are the clip_k most similar ones
+    features = label_features(rng, sum(annotation.values(), []), args.feature_dim)
+    bank = features[:args.num_train]
+    for ann, feature in zip(sum(annotation.values(), []), features):
+        similarity = bank @ feature
+        clip_indices = np.argsort(-similarity)[:args.clip_k]
+        ann['clip_indices'] = clip_indices.tolist()
+        ann['clip_scores'] = similarity[clip_indices].tolist()
+
+    # the positive rate of the 14 conditions in the training set, like data/mimic_cxr/base_probs.json
+    labels = np.array([ann['labels'][:14] for ann in annotation['train']])
+    base_probs = (labels == 1).mean(0) + 1e-3
+
+    with open(os.path.join(args.output_dir, 'annotation.json'), 'w') as f:
+        json.dump(annotation, f)
+    with open(os.path.join(args.output_dir, 'clip_text_features.json'), 'w') as f:
+        json.dump(bank.tolist(), f)
+    with open(os.path.join(args.output_dir, 'base_probs.json'), 'w') as f:
+        json.dump(base_probs.tolist(), f)
+
+    # tokenizer vocab and the tiny CheXbert
+    reports = [ann['report'] for ann in sum(annotation.values(), [])]
+    os.makedirs(os.path.join(args.output_dir, 'bert'), exist_ok=True)
+    vocab_path = os.path.join(args.output_dir, 'bert', 'vocab.txt')
+    vocab_size = write_vocab(vocab_path, reports)
+    write_chexbert(os.path.join(args.output_dir, 'chexbert'), vocab_path, vocab_size)
+    if args.llama:
+        write_llama(os.path.join(args.output_dir, 'llama'), reports, args.llama_vocab_size)
+
+    print('wrote {} train / {} val / {} test studies and a vocab of {} tokens to {}'.format(
+        args.num_train, args.num_val, args.num_test, vocab_size, args.output_dir))
+    print('use: --tiny --dataset_name mimic_cxr --image_dir {0}/images/ --ann_path {0}/annotation.json --clip_features_path '
+          '{0}/clip_text_features.json --base_probs_path {0}/base_probs.json --bert_path {0}/bert --chexbert_path '
+          '{0}/chexbert/chexbert.pth --chexbert_bert {0}/chexbert'.format(args.output_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,22 @@
 import os, json
+import time
 import torch
 from torch import nn
 import argparse
 import numpy as np
 from modules.metrics import compute_scores
 from modules.tester import Tester
+from modules.tokenizers import build_tokenizer, build_output_vocab
 from models.blip import blip_decoder
+from models.quantization import quantize_blip
+from models.draft import NgramDrafter, DecoderDrafter, RetrievalDrafter, build_draft_decoder
+from models.memory_cache import MemoryCache
+from models.retrieval import build_retriever
 from dataset import create_dataset_test 
 from dataset import create_sampler 
 from dataset import create_loader 
+from dataset.utils import collate_views
 from modules import utils
-from transformers import BertTokenizer 
 
 
 def parse_agrs():
@@ -19,7 +25,10 @@ def parse_agrs():
     # Data input settings
     parser.add_argument('--image_dir', type=str, default='data/iu_xray/images/', help='the path to the directory containing the data.')
     parser.add_argument('--ann_path', type=str, default='data/iu_xray/annotation.json', help='the path to the directory containing the data.')
+    parser.add_argument('--clip_features_path', type=str, default='./data/mimic_cxr/clip_text_features.json', help='the clip_text_features bank of the retrieved reports.')
     parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--multi_view', action='store_true', help='encode every view of a study (ragged batches) instead of the first one.')
+    parser.add_argument('--max_views', type=int, default=0, help='multi_view: at most this many views per study, 0 keeps all.')
 
     # Data loader settings
     parser.add_argument('--dataset_name', type=str, default='iu_xray', choices=['iu_xray', 'mimic_cxr'], help='the dataset to be used.')
@@ -29,11 +38,45 @@ def parse_agrs():
 
     # Model settings 
     parser.add_argument('--load_pretrained', type=str, default=None, help='pretrained path if any')
+    parser.add_argument('--tiny', action='store_true', help='random-init ResNet-18 and 2-layer BERT decoder (configs/bert_config_tiny.json), nothing downloaded.')
+    parser.add_argument('--bert_path', type=str, default='bert-base-uncased', help='the tokenizer: hub name or a local directory with vocab.txt.')
+    parser.add_argument('--chexbert_path', type=str, default='./checkpoints/stanford/chexbert/chexbert.pth', help='the CheXbert checkpoint for the clinical efficacy metrics.')
+    parser.add_argument('--chexbert_bert', type=str, default='bert-base-uncased', help='config and vocab of CheXbert: hub name or a local directory.')
 
     # Sample related
     parser.add_argument('--beam_size', type=int, default=3, help='the beam size when beam searching.')
     parser.add_argument('--gen_max_len', type=int, default=150, help='the maximum token length for text generation.')
     parser.add_argument('--gen_min_len', type=int, default=100, help='the minimum token length for text generation.')
+    parser.add_argument('--compact_generation', action='store_true', help='drop finished samples from the running batch during generation.')
+    parser.add_argument('--output_vocab', type=str, default=None, help='json of the token ids the decoder may emit, built from the training reports of --ann_path if missing.')
+    parser.add_argument('--prepare_encoder', type=str, default='none', choices=['none', 'fold', 'fuse'], help='fold BatchNorm and run the ResNet channels-last, fuse also fuses conv+ReLU.')
+    parser.add_argument('--compile_encoder', type=str, default='none', choices=['none', 'compile', 'trace'], help='run the image encoder, memory and classification head as a compiled graph.')
+    parser.add_argument('--compile_cache', type=str, default=None, help='where to cache the traced encoder.')
+    parser.add_argument('--memory_cache_size', type=int, default=0, help='LRU cache of memory encoder outputs keyed by the retrieved clip indices, 0 disables it.')
+    parser.add_argument('--memory_policy', type=str, default='none', choices=['none', 'topp', 'threshold', 'k'], help='how many retrieved reports the memory keeps per study.')
+    parser.add_argument('--memory_policy_value', type=float, default=0.9, help='the similarity mass (topp), minimum similarity (threshold) or number of reports (k).')
+    parser.add_argument('--quantize', type=str, default='none', choices=['none', 'dynamic', 'static'], help='int8 inference on CPU, static needs --quant_encoder_path from main_quantize.py.')
+    parser.add_argument('--quant_encoder_path', type=str, default=None, help='the calibrated static int8 image encoder.')
+
+    # Speculative decoding (greedy only, i.e. --beam_size 1)
+    parser.add_argument('--draft_type', type=str, default='none', choices=['none', 'ngram', 'decoder', 'retrieval'], help='the draft model for speculative decoding.')
+    parser.add_argument('--num_draft_tokens', type=int, default=4, help='the number of tokens proposed per verification step.')
+    parser.add_argument('--draft_layers', type=int, default=2, help='the number of layers of the truncated draft decoder.')
+    parser.add_argument('--draft_checkpoint', type=str, default=None, help='trained weights of the draft decoder if any.')
+    parser.add_argument('--ngram_n', type=int, default=4, help='the n of the n-gram draft model.')
+    parser.add_argument('--ngram_path', type=str, default=None, help='where to cache the n-gram table (ngram) or the tokenized training reports (retrieval).')
+    parser.add_argument('--lookup_max_ngram', type=int, default=3, help='the longest suffix matched against the retrieved reports.')
+    parser.add_argument('--draft_trie', action='store_true', help='fall back to a trie of frequent training sentences when retrieval finds no match.')
+
+    # Retrieval of clip_indices for new studies (models/retrieval.py)
+    parser.add_argument('--retrieval', type=str, default='none', choices=['none', 'exact', 'ivfpq'], help='retrieve the top clip_k reports for studies without clip_indices.')
+    parser.add_argument('--embed_fn', type=str, default=None, help='module:name of the callable embedding preprocessed images into the clip_text_features space.')
+    parser.add_argument('--retrieval_index', type=str, default=None, help='where to cache the trained IVF-PQ index.')
+    parser.add_argument('--retrieval_overwrite', action='store_true', help='also re-retrieve the studies that have clip_indices, e.g. for the clip_scores of --memory_policy topp / threshold.')
+    parser.add_argument('--nlist', type=int, default=256, help='ivfpq: the number of k-means cells.')
+    parser.add_argument('--nprobe', type=int, default=16, help='ivfpq: the number of cells scanned per query.')
+    parser.add_argument('--num_subspaces', type=int, default=32, help='ivfpq: one-byte codes per feature.')
+    parser.add_argument('--rerank', type=int, default=4, help='ivfpq: re-score rerank * clip_k candidates exactly, 0 disables it.')
 
     # Trainer settings
     parser.add_argument('--n_gpu', type=int, default=1, help='the number of gpus to be used.')
@@ -77,33 +120,67 @@ def main():
     torch.backends.cudnn.deterministic = True
 
     # create tokenizer
-    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-    tokenizer.add_special_tokens({'bos_token': '[DEC]'})
-    tokenizer.add_tokens(['[BLA]', '[POS]', '[NEG]', '[UNC]'])
+    tokenizer = build_tokenizer(args.bert_path)
 
     #### Dataset #### 
     print("Creating dataset...")
     test_dataset = create_dataset_test('generation_%s'%args.dataset_name, tokenizer, args)
     print('number of testing samples: %d'%len(test_dataset))
+    if args.retrieval != 'none':
+        assert args.embed_fn is not None, '--retrieval needs --embed_fn'
+        retriever = build_retriever(args.retrieval, args.embed_fn, clip_k=args.clip_k, device=device, features_path=args.clip_features_path,
+                                    cache_path=args.retrieval_index, nlist=args.nlist, nprobe=args.nprobe, num_subspaces=args.num_subspaces, rerank=args.rerank)
+        print('retrieved clip_indices for {} studies'.format(test_dataset.fill_clip_indices(retriever, batch_size=args.batch_size, overwrite=args.retrieval_overwrite)))
+    if args.memory_policy in ['topp', 'threshold'] and any('clip_scores' not in ann for ann in test_dataset.ann):
+        raise ValueError('--memory_policy {} needs the clip_scores of the retrieved reports: run with --retrieval ... '
+                         '--retrieval_overwrite, or use --memory_policy k'.format(args.memory_policy))
     
     samplers = [None]
 
-    test_dataloader = create_loader([test_dataset], samplers, batch_size=[args.batch_size], num_workers=[4], is_trains=[False], collate_fns=[None])[0] 
+    collate_fn = collate_views if args.multi_view else None
+    test_dataloader = create_loader([test_dataset], samplers, batch_size=[args.batch_size], num_workers=[4], is_trains=[False], collate_fns=[collate_fn])[0] 
 
     # build model architecture
     labels_temp = ['[BLA]'] * 18 # for calculate length only
     prompt_temp = ' '.join(labels_temp)+' '
-    model = blip_decoder(args, tokenizer, image_size=args.image_size, prompt=prompt_temp)
+    start = time.time()
+    model = blip_decoder(args, tokenizer, image_size=args.image_size, prompt=prompt_temp, checkpoint=args.load_pretrained)
     if args.load_pretrained:
-        state_dict = torch.load(args.load_pretrained, map_location="cpu")
-        model.load_state_dict(state_dict)
-        print("load checkpoint from {}".format(args.load_pretrained))
+        print("load checkpoint from {} in {:.1f}s".format(args.load_pretrained, time.time() - start))
 
     # get function handles of loss and metrics
     criterion_cls = nn.CrossEntropyLoss()
     metrics = compute_scores
 
+    if args.output_vocab is not None:
+        model.restrict_vocab(build_output_vocab(args.ann_path, tokenizer, cache_path=args.output_vocab))
+    if args.prepare_encoder != 'none':
+        model.visual_encoder.prepare_for_inference(channels_last=True, fuse_relu=args.prepare_encoder == 'fuse')
+    if args.quantize != 'none':
+        # quantized kernels only run on CPU
+        device = torch.device('cpu')
+        model = quantize_blip(model, args.quantize, args.quant_encoder_path)
     model = model.to(device)   
+    if args.compile_encoder != 'none':
+        example_inputs = (torch.randn(1, 3, args.image_size, args.image_size, device=device), torch.randn(1, args.clip_k, 512, device=device))
+        model.eval().compile_encoder(args.compile_encoder, cache_path=args.compile_cache, example_inputs=example_inputs)
+        model.warmup_encoder([args.batch_size], image_size=args.image_size, clip_k=args.clip_k)
+
+    if args.memory_cache_size > 0:
+        if args.compile_encoder != 'none':
+            print('the compiled encoder runs the memory transformer as a whole, --memory_cache_size is ignored')
+        model.memory_cache = MemoryCache(args.memory_cache_size)
+
+    # draft model for speculative decoding
+    if args.draft_type == 'ngram':
+        model.drafter = NgramDrafter.from_annotation(args.ann_path, tokenizer, n=args.ngram_n, cache_path=args.ngram_path)
+    elif args.draft_type == 'decoder':
+        model.drafter = DecoderDrafter(build_draft_decoder(model.text_decoder, args.draft_layers, args.draft_checkpoint))
+    elif args.draft_type == 'retrieval':
+        model.drafter = RetrievalDrafter.from_annotation(args.ann_path, tokenizer, max_ngram=args.lookup_max_ngram, use_trie=args.draft_trie, cache_path=args.ngram_path)
+    if model.drafter is not None and args.beam_size > 1:
+        print('speculative decoding only applies to greedy decoding, beam search runs unchanged')
+
     model_without_ddp = model
     if args.distributed:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True)
@@ -112,7 +189,10 @@ def main():
     # build trainer and start to train
     tester = Tester(model, criterion_cls, metrics, args, device, test_dataloader)
 
-    log = tester.test_blip()
+    if model_without_ddp.drafter is not None:
+        log = tester.test_speculative()
+    else:
+        log = tester.test_blip()
     for key, value in log.items():
         print('\t{:15s}: {}'.format(str(key), value))
     
@@ -6,12 +6,13 @@ import numpy as np
 from modules.metrics import compute_scores
 from modules.trainer import Trainer
 from models.blip import blip_decoder
+from modules.tokenizers import build_tokenizer
 import torch.distributed as dist
 from dataset import create_dataset 
 from dataset import create_sampler 
 from dataset import create_loader 
+from dataset.utils import collate_views
 from modules import utils
-from transformers import BertTokenizer 
 
 os.environ['TOKENIZERS_PARALLELISM'] = 'True'
 
@@ -21,7 +22,11 @@ def parse_agrs():
     # Data input settings
     parser.add_argument('--image_dir', type=str, default='data/mimic_cxr/images/', help='the path to the directory containing the data.')
     parser.add_argument('--ann_path', type=str, default='data/mimic_cxr/mimic_annotation_promptmrg.json', help='the path to the directory containing the data.')
+    parser.add_argument('--base_probs_path', type=str, default='./data/mimic_cxr/base_probs.json', help='the class distribution of the training set.')
+    parser.add_argument('--clip_features_path', type=str, default='./data/mimic_cxr/clip_text_features.json', help='the clip_text_features bank of the retrieved reports.')
     parser.add_argument('--image_size', type=int, default=224, help='input image size')
+    parser.add_argument('--multi_view', action='store_true', help='encode every view of a study (ragged batches) instead of the first one.')
+    parser.add_argument('--max_views', type=int, default=0, help='multi_view: at most this many views per study, 0 keeps all.')
 
     # Data loader settings
     parser.add_argument('--dataset_name', type=str, default='mimic_cxr', choices=['iu_xray', 'mimic_cxr'], help='the dataset to be used.')
@@ -31,11 +36,17 @@ def parse_agrs():
 
     # Model settings 
     parser.add_argument('--load_pretrained', type=str, default=None, help='pretrained path if any')
+    parser.add_argument('--tiny', action='store_true', help='random-init ResNet-18 and 2-layer BERT decoder (configs/bert_config_tiny.json), nothing downloaded.')
+    parser.add_argument('--bert_path', type=str, default='bert-base-uncased', help='the tokenizer: hub name or a local directory with vocab.txt.')
+    parser.add_argument('--chexbert_path', type=str, default='./checkpoints/stanford/chexbert/chexbert.pth', help='the CheXbert checkpoint for the clinical efficacy metrics.')
+    parser.add_argument('--chexbert_bert', type=str, default='bert-base-uncased', help='config and vocab of CheXbert: hub name or a local directory.')
 
     # Sample related
     parser.add_argument('--beam_size', type=int, default=3, help='the beam size when beam searching.')
     parser.add_argument('--gen_max_len', type=int, default=150, help='the maximum token length for text generation.')
     parser.add_argument('--gen_min_len', type=int, default=100, help='the minimum token length for text generation.')
+    parser.add_argument('--compact_generation', action='store_true', help='drop finished samples from the running batch during generation.')
+    parser.add_argument('--loss_chunk_size', type=int, default=0, help='if > 0, compute the LM loss on label positions only, in chunks of this many tokens.')
 
     # Trainer settings
     parser.add_argument('--n_gpu', type=int, default=1, help='the number of gpus to be used.')
@@ -78,9 +89,7 @@ def main():
     torch.backends.cudnn.deterministic = True
 
     # create tokenizer
-    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-    tokenizer.add_special_tokens({'bos_token': '[DEC]'})
-    tokenizer.add_tokens(['[BLA]', '[POS]', '[NEG]', '[UNC]'])
+    tokenizer = build_tokenizer(args.bert_path)
 
     #### Dataset #### 
     print("Creating dataset...")
@@ -90,7 +99,7 @@ def main():
     print('number of testing samples: %d'%len(test_dataset))
 
     # distribution of diseases
-    with open('./data/mimic_cxr/base_probs.json', 'r') as f:
+    with open(args.base_probs_path, 'r') as f:
         base_probs = json.load(f)
     # normalize
     base_probs = np.array(base_probs) / np.max(base_probs)
@@ -105,7 +114,8 @@ def main():
     else:
         samplers = [None, None, None]
 
-    train_dataloader, val_dataloader, test_dataloader = create_loader([train_dataset, val_dataset, test_dataset], samplers, batch_size=[args.batch_size]*3, num_workers=[4,4,4], is_trains=[True, False, False], collate_fns=[None, None, None]) 
+    collate_fn = collate_views if args.multi_view else None
+    train_dataloader, val_dataloader, test_dataloader = create_loader([train_dataset, val_dataset, test_dataset], samplers, batch_size=[args.batch_size]*3, num_workers=[4,4,4], is_trains=[True, False, False], collate_fns=[collate_fn]*3) 
 
     # build model architecture
     labels_temp = ['[BLA]'] * 18 # for calculate length only
@@ -1,4 +1,6 @@
 import os
+import json
+import hashlib
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -11,6 +13,10 @@ from torch import nn
 import torch.nn.functional as F
 
 from models.transformer import Transformer
+from models.generation import compact_generate, speculative_generate
+from models.checkpoint import load_checkpoint
+from models.retrieval import select_memory
+from dataset.utils import ViewBatch
 
 CONDITIONS = [
     'enlarged cardiomediastinum',
@@ -42,12 +48,15 @@ class BLIP_Decoder(nn.Module):
                  tokenizer=None,
                  image_size = 224,
                  prompt = '',
+                 pretrained = True,
                  ):
         super().__init__()
         self.args = args
+        # args.tiny never downloads weights, see main_synthetic.py
+        pretrained = pretrained and not getattr(args, 'tiny', False)
         
-        vision_width = 2048
-        self.visual_encoder = blip_resnet(args)
+        self.visual_encoder = blip_resnet(args, pretrained=pretrained)
+        vision_width = self.visual_encoder.feature_dim
         
         self.cls_head = nn.Linear(vision_width+512, 18*4)
         nn.init.normal_(self.cls_head.weight, std=0.001)
@@ -58,31 +67,49 @@ class BLIP_Decoder(nn.Module):
 
         self.tokenizer = tokenizer   
         
-        decoder_config = BertConfig.from_json_file('configs/bert_config.json')
+        decoder_config = BertConfig.from_json_file('configs/bert_config_tiny.json' if getattr(args, 'tiny', False) else 'configs/bert_config.json')
         decoder_config.encoder_width = vision_width
         decoder_config.add_cross_attention = True
         decoder_config.is_decoder = True
-        self.text_decoder = BertLMHeadModel.from_pretrained('bert-base-uncased',config=decoder_config)
+        if pretrained:
+            self.text_decoder = BertLMHeadModel.from_pretrained('bert-base-uncased',config=decoder_config)
+        else:
+            self.text_decoder = BertLMHeadModel(config=decoder_config)
         
         self.text_decoder.resize_token_embeddings(len(self.tokenizer))
         
         self.prompt = prompt
         self.prompt_length = len(self.tokenizer(self.prompt).input_ids)-1
 
+        # class state -> score token id, so generate builds the [DEC] + 18 score token prompt by indexing;
+        # explicitly on cpu so that meta-device construction (build_from_checkpoint) still creates it
+        score_ids = self.tokenizer(' '.join(SCORES), add_special_tokens=False).input_ids
+        assert len(score_ids) == len(SCORES), 'score tokens must be single tokens'
+        self.register_buffer('score_token_ids', torch.tensor(score_ids, dtype=torch.long, device='cpu'), persistent=False)
+
         self.memory = Transformer(d_model=512,
                                   num_encoder_layers=2,
                                   num_decoder_layers=2,
                                   num_queries=1)
+
+        # optional draft model for speculative greedy decoding, see models/draft.py
+        self.drafter = None
+        # optional LRU cache of memory encoder outputs keyed by clip_indices, see models/memory_cache.py
+        self.memory_cache = None
+        # studies and kept retrieved reports when generate prunes the memory (args.memory_policy)
+        self.memory_stats = {'studies': 0, 'kept': 0}
+        # optional compiled replacement of encode(), see compile_encoder
+        self.set_compiled_encoder(None)
         
-    def forward(self, image, caption, cls_labels, clip_memory, criterion_cls, base_probs):
-        image_embeds, avg_embeds = self.visual_encoder(image) 
+    def forward(self, image, caption, cls_labels, clip_memory, criterion_cls, base_probs, clip_padding_mask=None):
+        image_embeds, avg_embeds = encode_views(self.visual_encoder, image)
         image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)
 
         ##########################
         # NxKxC -> KxNxC
         clip_memory = torch.permute(clip_memory, (1, 0, 2))
         query_embed = self.vision_proj(avg_embeds)
-        hs = self.memory(clip_memory, None, query_embed.unsqueeze(0), None)
+        hs = self.memory(clip_memory, None, query_embed.unsqueeze(0), None, src_key_padding_mask=clip_padding_mask)
         # Nx512
         hs = hs.squeeze(0).squeeze(1)
         avg_embeds = torch.cat((avg_embeds, hs), 1)
@@ -106,18 +133,31 @@ class BLIP_Decoder(nn.Module):
                                            encoder_hidden_states = image_embeds,
                                            labels = decoder_targets,
                                            return_dict = True,   
+                                           loss_chunk_size = getattr(self.args, 'loss_chunk_size', 0),
                                           )   
           
         loss_lm = decoder_output.loss                
         return loss_lm, loss_cls
         
-    def generate(self, image, clip_memory, sample=False, num_beams=3, max_length=100, min_length=10, top_p=0.9, repetition_penalty=1.0):
-        image_embeds, avg_embeds = self.visual_encoder(image) 
+    def encode(self, image, clip_memory, clip_indices=None, clip_padding_mask=None):
+        """
+        static-shape front half of generate: patch features, class probabilities (Nx4x18) and predictions.
+        With a memory_cache and the NxK clip_indices of the batch, the memory encoder only runs for retrieved
+        sets that are not cached yet (the compiled encoder always runs the whole graph). clip_padding_mask
+        (NxK, True at padding) marks the padded items of a variable-length memory, it runs eagerly.
+        """
+        if self.compiled_encoder is not None and clip_padding_mask is None and not isinstance(image, ViewBatch):
+            return self.compiled_encoder(image, clip_memory)
+        image_embeds, avg_embeds = encode_views(self.visual_encoder, image)
         
         # NxKxC -> KxNxC
         clip_memory = torch.permute(clip_memory, (1, 0, 2))
         query_embed = self.vision_proj(avg_embeds)
-        hs = self.memory(clip_memory, None, query_embed.unsqueeze(0), None)
+        if self.memory_cache is not None and clip_indices is not None and not self.training:
+            memory = self.memory_cache.encode(lambda src, mask: self.memory.encode_memory(src, None, mask), clip_memory, clip_indices, clip_padding_mask)
+            hs = self.memory.decode(memory, None, query_embed.unsqueeze(0), None, memory_key_padding_mask=clip_padding_mask)
+        else:
+            hs = self.memory(clip_memory, None, query_embed.unsqueeze(0), None, src_key_padding_mask=clip_padding_mask)
         # Nx512
         hs = hs.squeeze(0).squeeze(1)
         avg_embeds = torch.cat((avg_embeds, hs), 1)
@@ -125,46 +165,321 @@ class BLIP_Decoder(nn.Module):
         # classification branch
         cls_preds = self.cls_head(avg_embeds)
         cls_preds = cls_preds.view(-1, 4, 18)
-        cls_preds = F.softmax(cls_preds, dim=1)
-        cls_preds_logits = cls_preds[:, 1, :14]
-        cls_preds = torch.argmax(cls_preds, dim=1).cpu().numpy().tolist()
+        cls_probs = F.softmax(cls_preds, dim=1)
+        return image_embeds, cls_probs, torch.argmax(cls_probs, dim=1)
 
-        prompts = []
-        for j in range(len(cls_preds)):
-            prompt = ' '.join([SCORES[c] for c in cls_preds[j]])+' '
-            prompts.append(prompt)
+    def compile_encoder(self, mode='compile', backend='inductor', cache_path=None, example_inputs=None):
+        """
+        Replaces encode() in generate with a compiled graph: torch.compile (mode='compile'), or a frozen
+        TorchScript trace (mode='trace') that is saved to / reused from cache_path. Tracing needs
+        example_inputs (image, clip_memory). The trace is saved with a fingerprint of the weights, the input
+        sizes and the device, and is traced again when the cached one does not match.
+        """
+        self.set_compiled_encoder(None)
+        encoder = StudyEncoder(self).eval()
+        if mode == 'compile':
+            compiled = torch.compile(encoder, backend=backend)
+        else:
+            assert example_inputs is not None, 'tracing needs example_inputs (image, clip_memory)'
+            device = next(self.parameters()).device
+            fingerprint = encoder_fingerprint(encoder, example_inputs)
+            compiled = None
+            if cache_path is not None and os.path.exists(cache_path):
+                extra_files = {'fingerprint.json': ''}
+                cached = torch.jit.load(cache_path, map_location=device, _extra_files=extra_files)
+                if extra_files['fingerprint.json'] in [fingerprint, fingerprint.encode()]:
+                    compiled = cached
+                else:
+                    print('{} was traced from other weights, input sizes or device, tracing again'.format(cache_path))
+            if compiled is None:
+                with torch.no_grad():
+                    compiled = torch.jit.freeze(torch.jit.trace(encoder, example_inputs))
+                if cache_path is not None:
+                    torch.jit.save(compiled, cache_path, _extra_files={'fingerprint.json': fingerprint})
+        self.set_compiled_encoder(compiled)
+        return compiled
 
-        if not sample:
-            image_embeds = image_embeds.repeat_interleave(num_beams,dim=0)
-            
-        image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)
-        model_kwargs = {"encoder_hidden_states": image_embeds, "encoder_attention_mask":image_atts}
-        
-        text = self.tokenizer(prompts, return_tensors="pt")
-        input_ids = text.input_ids.to(image.device)
-        attn_masks = text.attention_mask.to(image.device)
-        input_ids[:,0] = self.tokenizer.bos_token_id
-        input_ids = input_ids[:, :-1] 
-        attn_masks = attn_masks[:, :-1] 
-        
-        #beam search
-        outputs = self.text_decoder.generate(input_ids=input_ids,
-                                             min_length=min_length, # 4.25 Transformers
-                                             max_new_tokens=max_length,
-                                             num_beams=num_beams,
-                                             eos_token_id=self.tokenizer.sep_token_id,
-                                             pad_token_id=self.tokenizer.pad_token_id, 
-                                             repetition_penalty=repetition_penalty,
-                                             attention_mask = attn_masks,
-                                             **model_kwargs)            
+    def restrict_vocab(self, token_ids):
+        """
+        Inference only: decode over token_ids (e.g. modules.tokenizers.build_output_vocab) instead of the whole
+        BERT vocabulary. The special and score tokens are always kept. Call it before quantize_blip.
+        """
+        token_ids = set(token_ids)
+        token_ids.update(self.tokenizer.all_special_ids)
+        token_ids.update(self.score_token_ids.tolist())
+        self.text_decoder.restrict_output_vocab(token_ids)
+        return self
+
+    def set_compiled_encoder(self, compiled):
+        # kept out of the module tree so that state_dict and .to() are unaffected
+        object.__setattr__(self, 'compiled_encoder', compiled)
+
+    def warmup_encoder(self, batch_sizes, image_size=224, clip_k=21):
+        """run encode() once per batch size so that compilation / profiling happens before the first request"""
+        device = next(self.parameters()).device
+        with torch.no_grad():
+            for batch_size in batch_sizes:
+                image = torch.randn(batch_size, 3, image_size, image_size, device=device)
+                clip_memory = torch.randn(batch_size, clip_k, 512, device=device)
+                for _ in range(2):
+                    self.encode(image, clip_memory)
+
+    def prune_memory(self, clip_memory, clip_scores, clip_indices=None):
+        """
+        keeps the retrieved reports chosen by args.memory_policy (models/retrieval.py select_memory) from the
+        similarities clip_scores (NxK, best first); returns the memory and clip_indices cut to the longest kept
+        prefix of the batch and its padding mask
+        """
+        keep = select_memory(clip_scores.to(clip_memory.device), getattr(self.args, 'memory_policy', 'none'),
+                             getattr(self.args, 'memory_policy_value', 0.9))
+        width = int(keep.max())
+        clip_padding_mask = torch.arange(width, device=keep.device).unsqueeze(0) >= keep.unsqueeze(1)
+        self.memory_stats['studies'] += keep.size(0)
+        self.memory_stats['kept'] += int(keep.sum())
+        if clip_indices is not None:
+            clip_indices = clip_indices[:, :width]
+        return clip_memory[:, :width], clip_indices, clip_padding_mask
+
+    def generate(self, image, clip_memory, sample=False, num_beams=3, max_length=100, min_length=10, top_p=0.9, repetition_penalty=1.0, clip_indices=None, clip_scores=None):
+        memory_indices, clip_padding_mask = clip_indices, None
+        if clip_scores is not None and getattr(self.args, 'memory_policy', 'none') != 'none':
+            # the draft model keeps every retrieved report, only the memory is pruned
+            clip_memory, memory_indices, clip_padding_mask = self.prune_memory(clip_memory, clip_scores, clip_indices)
+        image_embeds, cls_probs, cls_preds = self.encode(image, clip_memory, memory_indices, clip_padding_mask)
+        cls_preds_logits = cls_probs[:, 1, :14]
+
+        # [DEC] followed by one score token per class, gathered on the device of cls_preds
+        bos_ids = cls_preds.new_full((cls_preds.size(0), 1), self.tokenizer.bos_token_id)
+        input_ids = torch.cat([bos_ids, self.score_token_ids[cls_preds]], dim=1)
+        attn_masks = torch.ones_like(input_ids)
+        prompt_length = input_ids.size(1)
+        eos_token_id, pad_token_id = self.tokenizer.sep_token_id, self.tokenizer.pad_token_id
+        output_vocab = self.text_decoder.output_vocab
+        if output_vocab is not None:
+            # restricted output vocabulary, the decoder reads and predicts positions in output_vocab
+            if self.drafter is not None:
+                raise ValueError('speculative decoding drafts full-vocabulary tokens, it cannot run with restrict_vocab')
+            input_ids = torch.searchsorted(output_vocab, input_ids)
+            eos_token_id, pad_token_id = torch.searchsorted(output_vocab, output_vocab.new_tensor([eos_token_id, pad_token_id])).tolist()
+
+        if not sample and num_beams == 1 and self.drafter is not None:
+            image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)
+            model_state = {"encoder_hidden_states": image_embeds, "encoder_attention_mask":image_atts}
+            if clip_indices is not None:
+                model_state["clip_indices"] = clip_indices.to(image.device)
+            outputs = speculative_generate(self._decoder_forward, self.drafter, input_ids, attn_masks, model_state,
+                                           max_new_tokens=max_length,
+                                           min_length=min_length,
+                                           eos_token_id=eos_token_id,
+                                           pad_token_id=pad_token_id,
+                                           repetition_penalty=repetition_penalty,
+                                           num_draft_tokens=getattr(self.args, 'num_draft_tokens', 4),
+                                           stats=self.drafter.stats)
+        elif not sample and getattr(self.args, 'compact_generation', False):
+            # finished samples leave the running batch, see models/generation.py
+            image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)
+            model_state = {"encoder_hidden_states": image_embeds, "encoder_attention_mask":image_atts}
+            outputs = compact_generate(self._decoder_step, input_ids, attn_masks, model_state,
+                                       num_beams=num_beams,
+                                       max_new_tokens=max_length,
+                                       min_length=min_length,
+                                       eos_token_id=eos_token_id,
+                                       pad_token_id=pad_token_id,
+                                       repetition_penalty=repetition_penalty)
+        else:
+            if not sample:
+                image_embeds = image_embeds.repeat_interleave(num_beams,dim=0)
+
+            image_atts = torch.ones(image_embeds.size()[:-1],dtype=torch.long).to(image.device)
+            model_kwargs = {"encoder_hidden_states": image_embeds, "encoder_attention_mask":image_atts}
+
+            #beam search
+            outputs = self.text_decoder.generate(input_ids=input_ids,
+                                                 min_length=min_length, # 4.25 Transformers
+                                                 max_new_tokens=max_length,
+                                                 num_beams=num_beams,
+                                                 eos_token_id=eos_token_id,
+                                                 pad_token_id=pad_token_id, 
+                                                 repetition_penalty=repetition_penalty,
+                                                 attention_mask = attn_masks,
+                                                 **model_kwargs)            
             
-        captions = []    
-        for i, output in enumerate(outputs):
-            caption = self.tokenizer.decode(output, skip_special_tokens=True)    
-            captions.append(caption[len(prompts[i]):])
-        return captions, cls_preds, cls_preds_logits
+        if output_vocab is not None:
+            outputs = output_vocab[outputs]
+        # every prompt has the same length, so the report is everything after it
+        captions = self.tokenizer.batch_decode(outputs[:, prompt_length:], skip_special_tokens=True)
+        return captions, cls_preds.tolist(), cls_preds_logits
+
+    def _decoder_step(self, input_ids, attention_mask, past, state):
+        # feed only the tokens that are not in the KV cache yet
+        past_len = past[0][0].size(2) if past is not None else 0
+        return self._decoder_forward(input_ids[:, past_len:], attention_mask, None, past, state)
+
+    def _decoder_forward(self, input_ids, attention_mask, position_ids, past, state):
+        decoder_output = self.text_decoder(input_ids,
+                                           attention_mask = attention_mask,
+                                           position_ids = position_ids,
+                                           past_key_values = past,
+                                           encoder_hidden_states = state["encoder_hidden_states"],
+                                           encoder_attention_mask = state["encoder_attention_mask"],
+                                           use_cache = True,
+                                           return_dict = True,
+                                          )
+        return decoder_output.logits, decoder_output.past_key_values
+
+def encoder_fingerprint(encoder, example_inputs):
+    """sha1 of the encoder's state_dict, and the per-study input sizes and device a trace is only valid for"""
+    digest = hashlib.sha1()
+    for name, value in encoder.state_dict().items():
+        digest.update(name.encode())
+        if torch.is_tensor(value) and not value.is_quantized:
+            digest.update(value.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            digest.update(repr(value).encode())
+    image, clip_memory = example_inputs
+    return json.dumps({'weights': digest.hexdigest(), 'image': list(image.shape[1:]), 'clip_memory': list(clip_memory.shape[1:]),
+                       'dtype': str(image.dtype), 'device': image.device.type})
+
+def encode_views(visual_encoder, image):
+    """
+    visual_encoder on an image batch, or on all views of a ViewBatch at once (one flat batch) with the patch and
+    average features then averaged over the views of every study, so no study is padded to a view count
+    """
+    if not isinstance(image, ViewBatch):
+        return visual_encoder(image)
+    image_embeds, avg_embeds = visual_encoder(image.images)
+    num_studies = image.num_views.size(0)
+    if image_embeds.size(0) == num_studies:
+        return image_embeds, avg_embeds
+    study_ids = torch.repeat_interleave(torch.arange(num_studies, device=image.device), image.num_views)
+    counts = image.num_views.to(image_embeds.dtype)
+    image_embeds = image_embeds.new_zeros((num_studies,) + image_embeds.shape[1:]).index_add_(0, study_ids, image_embeds)
+    avg_embeds = avg_embeds.new_zeros((num_studies,) + avg_embeds.shape[1:]).index_add_(0, study_ids, avg_embeds)
+    return image_embeds / counts.view(-1, 1, 1), avg_embeds / counts.view(-1, 1)
+
+class StudyEncoder(nn.Module):
+    """BLIP_Decoder.encode as a standalone module for tracing / compiling, sharing the decoder's submodules"""
+    def __init__(self, model):
+        super().__init__()
+        self.visual_encoder = model.visual_encoder
+        self.vision_proj = model.vision_proj
+        self.memory = model.memory
+        self.cls_head = model.cls_head
+        self.compiled_encoder = None
+        self.memory_cache = None
+
+    def forward(self, image, clip_memory):
+        return BLIP_Decoder.encode(self, image, clip_memory)
+
+class BLIP_Classifier(nn.Module):
+    """
+    Classification branch of BLIP_Decoder on its own: visual_encoder -> vision_proj -> memory -> cls_head.
+
+    Parameter names match BLIP_Decoder so its checkpoints load once the text_decoder.* entries are dropped;
+    neither the text decoder nor the tokenizer is built.
+    """
+    def __init__(self,
+                 args,
+                 image_size = 224,
+                 pretrained = True,
+                 ):
+        super().__init__()
+        self.args = args
+        pretrained = pretrained and not getattr(args, 'tiny', False)
 
-def blip_decoder(args, tokenizer, **kwargs):
+        self.visual_encoder = blip_resnet(args, pretrained=pretrained)
+        vision_width = self.visual_encoder.feature_dim
+
+        self.cls_head = nn.Linear(vision_width+512, 18*4)
+        nn.init.normal_(self.cls_head.weight, std=0.001)
+        if self.cls_head.bias is not None:
+            nn.init.constant_(self.cls_head.bias, 0)
+
+        self.vision_proj = nn.Linear(vision_width, 512)
+
+        self.memory = Transformer(d_model=512,
+                                  num_encoder_layers=2,
+                                  num_decoder_layers=2,
+                                  num_queries=1)
+
+        # per-condition softmax temperature, fitted on held-out data by calibrate()
+        self.register_buffer('temperature', torch.ones(18))
+
+    def forward(self, image, clip_memory):
+        """returns the class logits, Nx4x18"""
+        _, avg_embeds = self.visual_encoder(image)
+
+        # NxKxC -> KxNxC
+        clip_memory = torch.permute(clip_memory, (1, 0, 2))
+        query_embed = self.vision_proj(avg_embeds)
+        hs = self.memory(clip_memory, None, query_embed.unsqueeze(0), None)
+        # Nx512
+        hs = hs.squeeze(0).squeeze(1)
+        avg_embeds = torch.cat((avg_embeds, hs), 1)
+
+        cls_preds = self.cls_head(avg_embeds)
+        return cls_preds.view(-1, 4, 18)
+
+    def classify(self, image, clip_memory):
+        """same cls_preds / cls_preds_logits as BLIP_Decoder.generate, plus the full Nx4x18 probabilities"""
+        cls_probs = F.softmax(self(image, clip_memory) / self.temperature.view(1, 1, -1), dim=1)
+        cls_preds_logits = cls_probs[:, 1, :14]
+        cls_preds = torch.argmax(cls_probs, dim=1).cpu().numpy().tolist()
+        return cls_preds, cls_preds_logits, cls_probs
+
+    def calibrate(self, logits, labels, max_iter=100):
+        """
+        temperature scaling on held-out logits (Nx4x18) and labels (Nx18, or Nx14 like the val / test splits, the
+        4 auxiliary temperatures then stay 1), returns the nll before and after
+        """
+        num_labels = labels.size(1)
+        logits = logits[:, :, :num_labels]
+        log_t = torch.zeros(num_labels, device=logits.device, requires_grad=True)
+        optimizer = torch.optim.LBFGS([log_t], lr=0.1, max_iter=max_iter)
+        with torch.enable_grad():
+            def closure():
+                optimizer.zero_grad()
+                loss = F.cross_entropy(logits / log_t.exp().view(1, 1, -1), labels)
+                loss.backward()
+                return loss
+            nll_before = F.cross_entropy(logits, labels).item()
+            optimizer.step(closure)
+        self.temperature[:num_labels].copy_(log_t.detach().exp())
+        nll_after = F.cross_entropy(logits / self.temperature[:num_labels].view(1, 1, -1), labels).item()
+        return nll_before, nll_after
+
+def build_from_checkpoint(build_fn, checkpoint, state_dict_fn=None):
+    """
+    Checkpoint-first construction: build_fn() runs on the meta device, so no weights are allocated or
+    initialized, and the memory-mapped checkpoint tensors are then assigned to the parameters directly.
+    """
+    state_dict = load_checkpoint(checkpoint)
+    if state_dict_fn is not None:
+        state_dict = state_dict_fn(state_dict)
+    with torch.device('meta'):
+        model = build_fn()
+    model.load_state_dict(state_dict, assign=True)
+    for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+        if tensor.is_meta:
+            raise RuntimeError('{} was not restored from {}'.format(name, checkpoint))
+    return model
+
+def blip_decoder(args, tokenizer, checkpoint=None, **kwargs):
+    if checkpoint is not None:
+        # pretrained BERT / ResNet weights would be overwritten by the checkpoint anyway
+        model = build_from_checkpoint(lambda: BLIP_Decoder(args, tokenizer, pretrained=False, **kwargs), checkpoint)
+        # assigning the loaded tensors unties the LM head from the word embeddings
+        model.text_decoder.tie_weights()
+        return model
     model = BLIP_Decoder(args, tokenizer, **kwargs)
-    return model    
-    
+    return model
+
+def blip_classifier(args, checkpoint=None, **kwargs):
+    if checkpoint is not None:
+        def classifier_state_dict(state_dict):
+            state_dict = {k: v for k, v in state_dict.items() if not k.startswith('text_decoder.')}
+            state_dict.setdefault('temperature', torch.ones(18))
+            return state_dict
+        return build_from_checkpoint(lambda: BLIP_Classifier(args, pretrained=False, **kwargs), checkpoint, classifier_state_dict)
+    model = BLIP_Classifier(args, **kwargs)
+    return model
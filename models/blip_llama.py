@@ -5,9 +5,12 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 import time
-from transformers import LlamaForCausalLM, LlamaTokenizer
+from transformers import LlamaConfig, LlamaForCausalLM, LlamaTokenizer
 from models.resnet import blip_resnet
 from models.transformer import Transformer
+from models.generation import compact_generate
+from models.packing import pack_batch, packed_llama_forward, packed_lm_loss
+from models.lm_loss import chunked_lm_loss
 from peft import prepare_model_for_kbit_training, get_peft_model, LoraConfig
 from itertools import groupby
 
@@ -26,58 +29,113 @@ LABEL_MAP = {0: 'not mentioned', 1: 'positive', 2: 'negative', 3: 'uncertain'}
 
 # 根据分类预测构建 [INST] 提示
 # 输出示例: [INST] There is a positive finding of pneumonia. No evidence of edema. Please write a comprehensive and medically accurate radiology report. [/INST]
+INSTRUCTION_EN = 'Please write a comprehensive and medically accurate radiology report.'
+NO_FINDING_EN = 'No significant abnormalities are observed.'
+
+
+def build_prompt_fragments_en(labels):
+    """
+    单个样本的提示片段, 以空格拼接即为完整提示。
+    每个片段都从词边界开始、在词边界结束 (标点跟随前一个词), 便于逐片段分词。
+    """
+    # 根据 LABEL_MAP 映射状态
+    pos_list, neg_list, unc_list = [], [], []
+    for i, state in enumerate(labels):
+        label = CHEXPERT_LABELS_EN[i]
+        if state == 1:
+            pos_list.append(label)
+        elif state == 2:
+            neg_list.append(label)
+        elif state == 3:
+            unc_list.append(label)
+    # 构建英文自然语言短语: a / a and b / a, b, and c
+    def join_labels(lst, end=''):
+        if len(lst) == 1:
+            return [lst[0] + end]
+        if len(lst) == 2:
+            return [lst[0], 'and', lst[1] + end]
+        return [label + ',' for label in lst[:-1]] + ['and', lst[-1] + end]
+    fragments = ['[INST]']
+    if pos_list:
+        fragments += ['There is a positive finding of'] + join_labels(pos_list, '.')
+    if neg_list:
+        fragments += ['No evidence of'] + join_labels(neg_list, '.')
+    if unc_list:
+        fragments += ['The presence of'] + join_labels(unc_list) + ['is uncertain.']
+    if len(fragments) == 1:
+        fragments.append(NO_FINDING_EN)
+    # 最终拼接成指令格式
+    return fragments + [INSTRUCTION_EN, '[/INST]']
+
+
 def build_prompt_from_cls_preds_en(cls_preds):
     """
     根据分类预测构建诊断提示。
     输入: cls_preds: List[List[int]] 每个元素是长度为14的标签状态索引列表
     输出: prompts: List[str] 包含每个样本的 [INST] 提示
     """
-    prompts = []
-    for labels in cls_preds:
-        # 根据 LABEL_MAP 映射状态
-        pos_list, neg_list, unc_list = [], [], []
-        for i, state in enumerate(labels):
-            label = CHEXPERT_LABELS_EN[i]
-            status = LABEL_MAP[state]
-            if state == 1:
-                pos_list.append(label)
-            elif state == 2:
-                neg_list.append(label)
-            elif state == 3:
-                unc_list.append(label)
-        # 构建英文自然语言短语
-        def join_labels(lst):
-            if len(lst) == 1:
-                return lst[0]
-            if len(lst) == 2:
-                return f"{lst[0]} and {lst[1]}"
-            return ", ".join(lst[:-1]) + f", and {lst[-1]}"
-        sentences = []
-        if pos_list:
-            sentences.append(f"There is a positive finding of {join_labels(pos_list)}.")
-        if neg_list:
-            sentences.append(f"No evidence of {join_labels(neg_list)}.")
-        if unc_list:
-            sentences.append(f"The presence of {join_labels(unc_list)} is uncertain.")
-        findings = " ".join(sentences) if sentences else "No significant abnormalities are observed."
-        # 最终拼接成指令格式
-        prompt = (
-            f"[INST] {findings} "
-            f"Please write a comprehensive and medically accurate radiology report."
-            f" [/INST]"
-        )
-        prompts.append(prompt[:512])
-    return prompts
+    return [' '.join(build_prompt_fragments_en(labels))[:512] for labels in cls_preds]
+
+
+class PromptTokenCache(object):
+    """
+    片段级 token 缓存: 所有提示片段在构造时分词一次, 之后按 build_prompt_fragments_en 的顺序拼接 token id,
+    训练 / 生成时不再调用 tokenizer。SentencePiece 按空格切分后再分词, 所以从词边界开始的片段
+    单独分词的结果与在整句中一致; check() 用字符串路径验证这一点。
+    """
+    def __init__(self, tokenizer, max_length=128):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        fragments = ['[INST]', 'There is a positive finding of', 'No evidence of', 'The presence of', 'and',
+                     'is uncertain.', NO_FINDING_EN, INSTRUCTION_EN, '[/INST]']
+        fragments += [label + end for label in CHEXPERT_LABELS_EN for end in ['', ',', '.']]
+        self.fragment_ids = {fragment: tokenizer.encode(fragment, add_special_tokens=False) for fragment in fragments}
+
+    def encode(self, labels):
+        ids = [i for fragment in build_prompt_fragments_en(labels) for i in self.fragment_ids[fragment]]
+        # 与 tokenizer(..., truncation=True, max_length=128) 一致: 先加 bos, 再从右侧截断
+        # (提示最长约 300 个字符, 字符串路径的 [:512] 截断不会生效)
+        return self.tokenizer.build_inputs_with_special_tokens(ids)[:self.max_length]
+
+    def __call__(self, cls_preds, device=None):
+        """cls_preds: List[List[int]] -> input_ids / attention_mask [B, N_txt], 按 tokenizer.padding_side 补齐"""
+        ids = [self.encode(labels) for labels in cls_preds]
+        max_len = max(len(x) for x in ids)
+        input_ids = torch.full((len(ids), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros(len(ids), max_len, dtype=torch.long)
+        for i, x in enumerate(ids):
+            span = slice(max_len - len(x), max_len) if self.tokenizer.padding_side == 'left' else slice(0, len(x))
+            input_ids[i, span] = torch.tensor(x)
+            attention_mask[i, span] = 1
+        return input_ids.to(device), attention_mask.to(device)
+
+    def check(self, cls_preds):
+        """与字符串路径逐 token 比较"""
+        tokens = self.tokenizer(build_prompt_from_cls_preds_en(cls_preds), return_tensors='pt', padding=True,
+                                truncation=True, max_length=self.max_length)
+        input_ids, attention_mask = self(cls_preds)
+        return torch.equal(input_ids, tokens.input_ids) and torch.equal(attention_mask, tokens.attention_mask)
+
+
+# check() 覆盖的标签状态: 全部同一状态 (3 个以上标签的并列) 与 1 / 2 / 3 个标签的组合
+PROMPT_CHECK_STATES = [[state] * 14 for state in range(4)] + [
+    [1] + [2] * 2 + [3] * 3 + [0] * 8,
+    [3] + [1] * 2 + [0] * 8 + [2] * 3,
+    [2] + [3] * 2 + [1] * 3 + [0] * 8,
+]
 
 
 
 class BLIP_Decoder(nn.Module):
     def __init__(self, args):
         super().__init__()
+        self.args = args
         # 模型参数
         self.num_labels = 14
-        vision_width = 2048
-        llama_hidden = 4096
+        # 视觉宽度与 LLaMA 隐藏维度取自实际模型 (args.tiny: 随机初始化的 ResNet-18; main_synthetic.py --llama 写出的 2 层 LLaMA)
+        self.visual_encoder = blip_resnet(args, pretrained=not getattr(args, 'tiny', False))
+        vision_width = self.visual_encoder.feature_dim
+        llama_hidden = LlamaConfig.from_pretrained(args.llama_path).hidden_size
         
         # 1. 可学习的模态嵌入：0→图像前缀，1→文本
         self.modality_embed = nn.Embedding(2, llama_hidden)
@@ -88,7 +146,6 @@ class BLIP_Decoder(nn.Module):
         nn.init.normal_(self.vis_pos_embed, std=0.02)
 
         # 基础组件
-        self.visual_encoder = blip_resnet(args)
         self.vision_proj_lm = nn.Linear(vision_width, llama_hidden)
         self.vision_proj_mem = nn.Linear(vision_width, 512)
         self.memory = Transformer(d_model=512, num_encoder_layers=2, num_decoder_layers=2, num_queries=1)
@@ -99,20 +156,41 @@ class BLIP_Decoder(nn.Module):
         # LLaMA 加载
         self.tokenizer = LlamaTokenizer.from_pretrained(args.llama_path, use_fast=False)
         self.tokenizer.pad_token = self.tokenizer.eos_token
+        # 提示 token 缓存, 与字符串路径不一致时 (非常规 tokenizer) 退回逐批分词
+        self.prompt_cache = PromptTokenCache(self.tokenizer)
+        if not self.prompt_cache.check(PROMPT_CHECK_STATES):
+            warnings.warn('prompt token cache disagrees with the tokenizer, tokenizing prompts per batch')
+            self.prompt_cache = None
         self.llama = LlamaForCausalLM.from_pretrained(
             args.llama_path, device_map="auto", torch_dtype=torch.float16
         )
-        self.llama.gradient_checkpointing_enable()
-        self.llama.config.use_cache = False
         self.llama = prepare_model_for_kbit_training(self.llama)
         if getattr(args, 'use_lora', False):
             lora_cfg = LoraConfig(r=8, lora_alpha=16, target_modules=["q_proj","v_proj"], lora_dropout=0.05, bias="none", task_type="CAUSAL_LM")
             self.llama = get_peft_model(self.llama, lora_cfg)
+        # 梯度检查点 / KV cache 随 train() / eval() 切换
+        self.set_llama_mode(self.training)
         self.embed_tokens = self.llama.get_input_embeddings()
         # 设备/dtype
         self.device = next(self.llama.parameters()).device
         self.dtype = next(self.llama.parameters()).dtype
         self.base_probs = None
+        # packed_training 的累计统计: 真实 token 数 / 打包后的 slot 数 / 按 padding 拼 batch 的 slot 数
+        self.packing_stats = {'tokens': 0, 'packed_slots': 0, 'padded_slots': 0}
+
+    def set_llama_mode(self, training):
+        """训练: 梯度检查点开、KV cache 关; 推理: 梯度检查点关、KV cache 开 (逐 token 增量解码)"""
+        if training:
+            self.llama.gradient_checkpointing_enable()
+        else:
+            self.llama.gradient_checkpointing_disable()
+        self.llama.config.use_cache = not training
+        self.llama.train(training)
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.set_llama_mode(mode)
+        return self
 
     def encode_visual(self, image):
         """获取视觉特征与投影"""
@@ -126,21 +204,28 @@ class BLIP_Decoder(nn.Module):
         """
         img_feats, avg_feats = self.visual_encoder(image)
         proj_feats = self.vision_proj_lm(img_feats)
-    return img_feats, proj_feats, avg_feats
+        return img_feats, proj_feats, avg_feats
 
-    def construct_inputs(self, visual_embeds, prompts):
+    def tokenize_prompts(self, cls_preds):
+        """分类预测 → 提示的 input_ids / attention_mask, 优先使用片段缓存"""
+        if self.prompt_cache is not None:
+            return self.prompt_cache(cls_preds, self.device)
+        tokens = self.tokenizer(build_prompt_from_cls_preds_en(cls_preds),
+                                return_tensors='pt',
+                                padding=True,
+                                truncation=True,
+                                max_length=128).to(self.device)
+        return tokens.input_ids, tokens.attention_mask
+
+    def construct_inputs(self, visual_embeds, prompt_ids, prompt_mask):
         """
         visual_embeds: [B, N_vis, llama_hidden]
-        prompts      : List[str] → batch of text prompts
+        prompt_ids   : [B, N_txt] 提示 token, 见 tokenize_prompts
+        prompt_mask  : [B, N_txt]
         """
         B, N_vis, H = visual_embeds.size()
         # ——— 文本部分嵌入 ———
-        tokens = self.tokenizer(prompts,
-                                return_tensors='pt',
-                                padding=True,
-                                truncation=True,
-                                max_length=128).to(self.device)
-        txt_embeds = self.embed_tokens(tokens.input_ids)        # [B, N_txt, H]
+        txt_embeds = self.embed_tokens(prompt_ids)        # [B, N_txt, H]
         N_txt = txt_embeds.size(1)
 
         # ——— 位置 + 模态 嵌入叠加 ———
@@ -162,7 +247,7 @@ class BLIP_Decoder(nn.Module):
         # ——— attention mask 同你原来那样拼接 ———
         attn_mask = torch.cat([
             torch.ones(B, N_vis, device=self.device),
-            tokens.attention_mask
+            prompt_mask
         ], dim=1)                                                  # [B, N_vis+N_txt]
 
         return inputs_embeds, attn_mask
@@ -191,25 +276,52 @@ class BLIP_Decoder(nn.Module):
         loss_cls = criterion_cls(cls_logits.permute(0,2,1), cls_labels)
         cls_preds = torch.argmax(cls_logits, dim=1).tolist()
         # 构建 prompt
-        prompts = build_prompt_from_cls_preds_en(cls_preds)
+        prompt_ids, prompt_mask = self.tokenize_prompts(cls_preds)
         # 文本编码
         cap_tokens = self.tokenizer(caption, return_tensors='pt', padding=True, truncation=True, max_length=384).to(self.device)
         cap_embeds = self.embed_tokens(cap_tokens.input_ids)
         labels = cap_tokens.input_ids.masked_fill(cap_tokens.input_ids==self.tokenizer.pad_token_id, -100)
         # 拼接输入
-        inputs_embeds, attn_mask = self.construct_inputs(vis_proj, prompts)
+        inputs_embeds, attn_mask = self.construct_inputs(vis_proj, prompt_ids, prompt_mask)
         full_inputs = torch.cat([inputs_embeds, cap_embeds], dim=1)
         full_mask = torch.cat([attn_mask, cap_tokens.attention_mask], dim=1)
         prefix_len = inputs_embeds.size(1)
         label_pref = torch.full((image.size(0), prefix_len), -100, device=self.device)
         full_labels = torch.cat([label_pref, labels], dim=1)
         # 语言模型损失
+        loss_chunk_size = getattr(self.args, 'loss_chunk_size', 0)
+        if getattr(self.args, 'packed_training', False) and self.training:
+            # 去掉中间的 padding, 多个样本拼进固定 token 预算的行, 块对角因果 mask 隔开样本
+            packed = pack_batch(full_inputs, full_mask, full_labels, budget=getattr(self.args, 'pack_budget', 0))
+            for key in self.packing_stats:
+                self.packing_stats[key] += packed[key]
+            hidden = packed_llama_forward(self.llama, packed['inputs_embeds'], packed['position_ids'], packed['seq_ids'])
+            loss_lm = packed_lm_loss(self.llama, hidden, packed['labels'], chunk_size=loss_chunk_size)
+            return loss_lm, loss_cls
+        if loss_chunk_size > 0:
+            # 只在 caption 位置上分块计算 LM head 与交叉熵, 不生成 [B, T, 32k] 的 logits
+            base = self.llama.get_base_model() if hasattr(self.llama, 'get_base_model') else self.llama
+            hidden = base.model(inputs_embeds=full_inputs, attention_mask=full_mask, return_dict=True).last_hidden_state
+            loss_lm = chunked_lm_loss(base.lm_head, hidden[:, :-1], full_labels[:, 1:], chunk_size=loss_chunk_size)
+            return loss_lm, loss_cls
         outputs = self.llama(inputs_embeds=full_inputs, attention_mask=full_mask, labels=full_labels, return_dict=True)
         loss_lm = outputs.loss
         return loss_lm, loss_cls
 
     def generate(self, image, clip_memory, sample=False, num_beams=3, max_length=100, min_length=10, top_p=0.9, repetition_penalty=1.0, debug=False):
         """推理生成：返回报告, 分类预测, positive_probs"""
+        # 训练模式下调用 (如训练中的验证) 时 LLaMA 临时切到推理配置, 否则梯度检查点会关掉 KV cache
+        llama_training = self.llama.training
+        if llama_training:
+            self.set_llama_mode(False)
+        try:
+            return self._generate(image, clip_memory, sample=sample, num_beams=num_beams, max_length=max_length, min_length=min_length,
+                                  top_p=top_p, repetition_penalty=repetition_penalty)
+        finally:
+            if llama_training:
+                self.set_llama_mode(True)
+
+    def _generate(self, image, clip_memory, sample=False, num_beams=3, max_length=100, min_length=10, top_p=0.9, repetition_penalty=1.0):
         with torch.no_grad():
             image = image.to(self.dtype).to(self.device)
             clip_memory = clip_memory.to(self.dtype).to(self.device)
@@ -228,32 +340,64 @@ class BLIP_Decoder(nn.Module):
                 cls_logits[:,1,:] += torch.log(self.base_probs_tensor.view(1,-1))
             cls_preds = torch.argmax(cls_logits, dim=1).tolist()
             # 构建 prompt
-            prompts = build_prompt_from_cls_preds_en(cls_preds)
+            prompt_ids, prompt_mask = self.tokenize_prompts(cls_preds)
             # 构造模型输入
-            inputs_embeds, attn_mask = self.construct_inputs(vis_proj, prompts)
+            inputs_embeds, attn_mask = self.construct_inputs(vis_proj, prompt_ids, prompt_mask)
             # 文本生成
-            outputs = self.llama.generate(
-                inputs_embeds=inputs_embeds,
-                attention_mask=attn_mask,
-                max_new_tokens=max_length,
-                num_beams=num_beams,
-                do_sample=sample,
-                top_p=top_p,
-                repetition_penalty=repetition_penalty,
-                eos_token_id=self.tokenizer.eos_token_id,
-                pad_token_id=self.tokenizer.pad_token_id
-            )
+            # 束搜索默认共享前缀: 视觉+提示前缀每个样本只 prefill 一次, 之后把 KV cache 复制给各个 beam
+            shared_prefix = num_beams > 1 and getattr(self.args, 'shared_prefix', True)
+            if not sample and (getattr(self.args, 'compact_generation', False) or shared_prefix):
+                # 已结束的样本从 batch 和 KV cache 中移除
+                input_ids = torch.zeros(inputs_embeds.size(0), 0, dtype=torch.long, device=self.device)
+                outputs = compact_generate(
+                    self._llama_step, input_ids, attn_mask, {'inputs_embeds': inputs_embeds},
+                    num_beams=num_beams,
+                    max_new_tokens=max_length,
+                    repetition_penalty=repetition_penalty,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    shared_prefix=shared_prefix
+                )
+            else:
+                outputs = self.llama.generate(
+                    inputs_embeds=inputs_embeds,
+                    attention_mask=attn_mask,
+                    max_new_tokens=max_length,
+                    num_beams=num_beams,
+                    do_sample=sample,
+                    top_p=top_p,
+                    repetition_penalty=repetition_penalty,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    use_cache=True
+                )
             decoded = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
             # 后处理
             reports = []
-            for text,prompt in zip(decoded, prompts):
-                clean = text.split(prompt)[-1].strip()
+            # 以 inputs_embeds 生成时输出只包含新 token, 不含提示
+            for text in decoded:
+                clean = text.strip()
                 # 去重句子
                 rpt = '. '.join(x for x,_ in groupby(clean.split('. ')))
                 reports.append(rpt)
             # positive 概率
             positive_probs = torch.softmax(cls_logits, dim=1)[:,1,:]
             return reports, cls_preds, positive_probs
+
+    def _llama_step(self, input_ids, attention_mask, past, state):
+        """compact_generate 的单步前向：首步输入视觉+prompt 前缀，之后只输入 KV cache 之外的新 token"""
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        if past is None:
+            # 前缀只在首步使用, 取出后不再随每步的 beam 重排 / 样本移除一起 gather
+            outputs = self.llama(inputs_embeds=state.pop('inputs_embeds'), attention_mask=attention_mask,
+                                 position_ids=position_ids, use_cache=True, return_dict=True)
+        else:
+            new_len = attention_mask.size(1) - past[0][0].size(2)
+            outputs = self.llama(input_ids=input_ids[:, -new_len:], attention_mask=attention_mask,
+                                 position_ids=position_ids[:, -new_len:], past_key_values=past,
+                                 use_cache=True, return_dict=True)
+        return outputs.logits, outputs.past_key_values
             
 
 def blip_decoder(args):
@@ -0,0 +1,34 @@
+import torch
+
+
+def is_safetensors(path):
+    return path.endswith('.safetensors')
+
+
+def save_checkpoint(state_dict, path):
+    """torch.save for .pth, safetensors for .safetensors"""
+    if not is_safetensors(path):
+        torch.save(state_dict, path)
+        return
+    from safetensors.torch import save_file
+    # safetensors refuses tensors sharing memory (e.g. the tied LM head), store a copy of each alias
+    tensors, seen = {}, set()
+    for k, v in state_dict.items():
+        v = v.detach().cpu().contiguous()
+        key = (v.untyped_storage().data_ptr(), v.storage_offset())
+        tensors[k] = v.clone() if key in seen else v
+        seen.add(key)
+    save_file(tensors, path)
+
+
+def load_checkpoint(path):
+    """
+    Loads a state dict onto the CPU without reading it into private memory: the tensors are backed by a
+    copy-on-write memory map of the file, so processes loading the same checkpoint share its page cache.
+    Combine with load_state_dict(assign=True) to use them as parameters without a copy.
+    """
+    if is_safetensors(path):
+        from safetensors import safe_open
+        with safe_open(path, framework='pt', device='cpu') as f:
+            return {k: f.get_tensor(k) for k in f.keys()}
+    return torch.load(path, map_location="cpu", mmap=True)
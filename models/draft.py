@@ -0,0 +1,271 @@
+import copy
+import json
+import os
+from collections import Counter, defaultdict
+
+import torch
+
+from models.med import BertLMHeadModel
+from models.generation import IncrementalDecoder, new_draft_stats
+from models.checkpoint import load_checkpoint
+from dataset.utils import my_pre_caption
+
+
+def build_draft_decoder(text_decoder, num_layers=2, checkpoint=None):
+    """truncated copy of the report decoder: embeddings, LM head and the first num_layers layers"""
+    config = copy.deepcopy(text_decoder.config)
+    config.num_hidden_layers = num_layers
+    draft = BertLMHeadModel(config)
+    if checkpoint is not None:
+        state_dict = load_checkpoint(checkpoint)
+    else:
+        state_dict = text_decoder.state_dict()
+    draft.load_state_dict(state_dict, strict=False)
+    return draft.to(next(text_decoder.parameters()).device).eval()
+
+
+class DecoderDrafter(object):
+    """Greedy drafts from a small BertLMHeadModel that attends to the same image features."""
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.stats = new_draft_stats()
+        self.cache = None
+        self.fed = None
+
+    def _forward(self, input_ids, attention_mask, position_ids, past, state):
+        output = self.decoder(input_ids,
+                              attention_mask = attention_mask,
+                              position_ids = position_ids,
+                              past_key_values = past,
+                              encoder_hidden_states = state["encoder_hidden_states"],
+                              encoder_attention_mask = state["encoder_attention_mask"],
+                              use_cache = True,
+                              return_dict = True,
+                             )
+        return output.logits, output.past_key_values
+
+    def start(self, input_ids, attention_mask, state):
+        self.cache = IncrementalDecoder(self._forward, state)
+        self.cache.prefill(input_ids, attention_mask)
+        self.fed = input_ids.tolist()
+
+    def select(self, rows):
+        self.cache.select(torch.tensor(rows, dtype=torch.long, device=self.cache.mask.device))
+        self.fed = [self.fed[i] for i in rows]
+
+    def propose(self, seqs, k):
+        device = self.cache.mask.device
+        # roll the draft cache back to the part that agrees with the accepted sequence
+        valid = []
+        for fed, seq in zip(self.fed, seqs):
+            n = 0
+            while n < min(len(fed), len(seq) - 1) and fed[n] == seq[n]:
+                n += 1
+            valid.append(n)
+        self.cache.truncate(torch.tensor(valid, dtype=torch.long, device=device))
+        pending = [seq[n:] for seq, n in zip(seqs, valid)]
+        self.fed = [seq[:n] + p for seq, n, p in zip(seqs, valid, pending)]
+
+        width = max(len(p) for p in pending)
+        feed = torch.tensor([p + [0] * (width - len(p)) for p in pending], dtype=torch.long, device=device)
+        counts = torch.tensor([len(p) for p in pending], dtype=torch.long, device=device)
+        logits = self.cache.feed(feed, counts)
+        tokens = torch.argmax(logits[torch.arange(len(seqs), device=device), counts - 1], dim=-1)
+        drafts = [[t] for t in tokens.tolist()]
+        for _ in range(k - 1):
+            logits = self.cache.feed(tokens.unsqueeze(1), torch.ones_like(counts))
+            for fed, d in zip(self.fed, drafts):
+                fed.append(d[-1])
+            tokens = torch.argmax(logits[:, -1], dim=-1)
+            for d, t in zip(drafts, tokens.tolist()):
+                d.append(t)
+        return drafts
+
+
+class NgramDrafter(object):
+    """Drafts by chaining the most frequent next token after the last n-1 tokens, backing off to shorter contexts."""
+
+    def __init__(self, table, n=4):
+        self.table = table
+        self.n = n
+        self.stats = new_draft_stats()
+
+    @classmethod
+    def from_reports(cls, reports, tokenizer, n=4, min_count=2):
+        counts = defaultdict(Counter)
+        for report in reports:
+            ids = tokenizer(report, add_special_tokens=False).input_ids + [tokenizer.sep_token_id]
+            for i in range(1, len(ids)):
+                for m in range(1, n):
+                    if i - m < 0:
+                        break
+                    counts[tuple(ids[i - m:i])][ids[i]] += 1
+        table = {}
+        for context, counter in counts.items():
+            token, count = counter.most_common(1)[0]
+            if count >= min_count:
+                table[context] = token
+        return cls(table, n)
+
+    @classmethod
+    def from_annotation(cls, ann_path, tokenizer, n=4, cache_path=None, max_words=100):
+        if cache_path is not None and os.path.exists(cache_path):
+            return cls.load(cache_path)
+        annotation = json.load(open(ann_path, 'r'))
+        reports = [my_pre_caption(ann['report'], max_words) for ann in annotation['train']]
+        drafter = cls.from_reports(reports, tokenizer, n)
+        if cache_path is not None:
+            drafter.save(cache_path)
+        return drafter
+
+    def save(self, path):
+        torch.save({'n': self.n, 'table': self.table}, path)
+
+    @classmethod
+    def load(cls, path):
+        data = torch.load(path)
+        return cls(data['table'], data['n'])
+
+    def lookup(self, context):
+        for m in range(min(len(context), self.n - 1), 0, -1):
+            token = self.table.get(tuple(context[-m:]))
+            if token is not None:
+                return token
+        return None
+
+    def start(self, input_ids, attention_mask, state):
+        pass
+
+    def select(self, rows):
+        pass
+
+    def propose(self, seqs, k):
+        drafts = []
+        for seq in seqs:
+            context = list(seq[-(self.n - 1):])
+            draft = []
+            for _ in range(k):
+                token = self.lookup(context)
+                if token is None:
+                    break
+                draft.append(token)
+                context = context[1:] + [token] if len(context) == self.n - 1 else context + [token]
+            drafts.append(draft)
+        return drafts
+
+
+class SentenceTrie(object):
+    """Prefix tree over tokenized report sentences; a node is [count, children]."""
+
+    def __init__(self):
+        self.root = [0, {}]
+
+    def add(self, tokens, count=1):
+        node = self.root
+        for token in tokens:
+            child = node[1].get(token)
+            if child is None:
+                child = node[1][token] = [0, {}]
+            child[0] += count
+            node = child
+
+    def continuation(self, prefix, k):
+        node = self.root
+        for token in prefix:
+            node = node[1].get(token)
+            if node is None:
+                return []
+        tokens = []
+        while len(tokens) < k and node[1]:
+            token, node = max(node[1].items(), key=lambda x: x[1][0])
+            tokens.append(token)
+        return tokens
+
+
+class RetrievalDrafter(object):
+    """
+    Prompt-lookup drafts from the reports retrieved for each study.
+
+    The retrieved reports (clip_indices into annotation['train'], the database clip_text_features.json was
+    extracted from) are indexed by their n-grams; a draft continues the first retrieved occurrence of the
+    longest suffix of the generated text. When nothing matches, an optional trie over frequent training
+    sentences continues the current sentence.
+    """
+
+    def __init__(self, train_ids, period_token_id, sep_token_id, max_ngram=3, trie=None):
+        self.train_ids = train_ids
+        self.period_token_id = period_token_id
+        self.sep_token_id = sep_token_id
+        self.max_ngram = max_ngram
+        self.trie = trie
+        self.stats = new_draft_stats()
+        self.indices = []
+        self.prompt_len = 0
+
+    @classmethod
+    def from_annotation(cls, ann_path, tokenizer, max_ngram=3, use_trie=False, cache_path=None, max_words=100, min_count=2):
+        if cache_path is not None and os.path.exists(cache_path):
+            train_ids = torch.load(cache_path)
+        else:
+            annotation = json.load(open(ann_path, 'r'))
+            train_ids = [tokenizer(my_pre_caption(ann['report'], max_words), add_special_tokens=False).input_ids
+                         for ann in annotation['train']]
+            if cache_path is not None:
+                torch.save(train_ids, cache_path)
+        period_token_id = tokenizer.convert_tokens_to_ids('.')
+        trie = None
+        if use_trie:
+            sentences = Counter()
+            for ids in train_ids:
+                start = 0
+                for i, token in enumerate(ids):
+                    if token == period_token_id:
+                        sentences[tuple(ids[start:i + 1])] += 1
+                        start = i + 1
+            trie = SentenceTrie()
+            for sentence, count in sentences.items():
+                if count >= min_count:
+                    trie.add(sentence, count)
+        return cls(train_ids, period_token_id, tokenizer.sep_token_id, max_ngram, trie)
+
+    def _index(self, clip_indices):
+        reference = []
+        for i in clip_indices:
+            reference.extend(self.train_ids[i] + [self.sep_token_id])
+        ngrams = {}
+        for n in range(1, self.max_ngram + 1):
+            for i in range(len(reference) - n):
+                # the first occurrence comes from the most similar report
+                ngrams.setdefault(tuple(reference[i:i + n]), i + n)
+        return reference, ngrams
+
+    def start(self, input_ids, attention_mask, state):
+        self.prompt_len = input_ids.size(1)
+        clip_indices = state.get('clip_indices')
+        if clip_indices is None:
+            self.indices = [([], {})] * input_ids.size(0)
+        else:
+            self.indices = [self._index(row) for row in clip_indices.tolist()]
+
+    def select(self, rows):
+        self.indices = [self.indices[i] for i in rows]
+
+    def propose(self, seqs, k):
+        drafts = []
+        for seq, (reference, ngrams) in zip(seqs, self.indices):
+            generated = seq[self.prompt_len:]
+            draft = []
+            for n in range(min(self.max_ngram, len(generated)), 0, -1):
+                start = ngrams.get(tuple(generated[-n:]))
+                if start is not None:
+                    draft = reference[start:start + k]
+                    break
+            if not draft and self.trie is not None:
+                sentence_start = 0
+                for i, token in enumerate(generated):
+                    if token == self.period_token_id:
+                        sentence_start = i + 1
+                draft = self.trie.continuation(generated[sentence_start:], k)
+            drafts.append(draft)
+        return drafts
@@ -0,0 +1,397 @@
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+
+
+def index_select_nested(obj, index):
+    """index_select along dim 0 for every tensor in a (nested) tuple / list / dict, e.g. a KV cache"""
+    if obj is None:
+        return None
+    if torch.is_tensor(obj):
+        return obj.index_select(0, index)
+    if isinstance(obj, dict):
+        return {k: index_select_nested(v, index) for k, v in obj.items()}
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(index_select_nested(o, index) for o in obj)
+    return obj
+
+
+def repeat_interleave_nested(obj, repeats):
+    if obj is None:
+        return None
+    if torch.is_tensor(obj):
+        return obj.repeat_interleave(repeats, dim=0)
+    if isinstance(obj, dict):
+        return {k: repeat_interleave_nested(v, repeats) for k, v in obj.items()}
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(repeat_interleave_nested(o, repeats) for o in obj)
+    return obj
+
+
+class BeamHypotheses(object):
+    """Finished hypotheses of one sample, same scoring rule as transformers' BeamHypotheses."""
+
+    def __init__(self, num_beams, length_penalty=1.0):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.beams = []
+        self.worst_score = 1e9
+
+    def __len__(self):
+        return len(self.beams)
+
+    def add(self, hyp, sum_logprobs):
+        score = sum_logprobs / (max(hyp.shape[-1], 1) ** self.length_penalty)
+        if len(self) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hyp))
+            if len(self) > self.num_beams:
+                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
+                del self.beams[sorted_scores[0][1]]
+                self.worst_score = sorted_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs, cur_len):
+        if len(self) < self.num_beams:
+            return False
+        cur_score = best_sum_logprobs / (max(cur_len, 1) ** self.length_penalty)
+        return self.worst_score >= cur_score
+
+    def best(self):
+        return sorted(self.beams, key=lambda x: x[0])[-1][1]
+
+
+def process_scores(scores, input_ids, min_length, eos_token_id, repetition_penalty):
+    """repetition penalty + min length, same as the transformers logits processors"""
+    if repetition_penalty != 1.0 and input_ids.size(1) > 0:
+        score = torch.gather(scores, 1, input_ids)
+        score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+        scores.scatter_(1, input_ids, score)
+    if eos_token_id is not None and input_ids.size(1) < min_length:
+        scores[:, eos_token_id] = -float("inf")
+    return scores
+
+
+@torch.no_grad()
+def compact_generate(step_fn, input_ids, attention_mask, state, num_beams=3, max_new_tokens=100, min_length=0,
+                     eos_token_id=None, pad_token_id=0, repetition_penalty=1.0, length_penalty=1.0, shared_prefix=False):
+    """
+    Greedy / beam search decoding that removes finished samples from the running batch.
+
+    As soon as a sample is done (its eos is emitted for greedy, or its beam hypotheses can no longer
+    improve for beam search) its rows are dropped from input_ids, attention_mask, state and the KV cache,
+    so the per-step cost follows the number of live sequences. Results are returned in input order.
+
+    Args:
+        step_fn: callable(input_ids, attention_mask, past, state) -> (logits [N, T_new, V], past).
+            It must feed the tokens of input_ids that are not in past yet.
+        input_ids: [B, L] prompt tokens (L may be 0 when the prefix lives in state only)
+        attention_mask: [B, L_prefix] mask of everything fed to the model so far
+        state: dict of batch-first tensors (e.g. encoder states) forwarded to step_fn
+        shared_prefix: for beam search, run the first step (the prompt / prefix) once per sample and
+            fork its logits and KV cache to the beams afterwards instead of running it once per beam.
+            All beams of a sample start from the same prefix, so the results are unchanged.
+    Returns:
+        [B, L_out] tensor of prompt + generated tokens, padded with pad_token_id
+    """
+    batch_size = input_ids.size(0)
+    fork_prefix = shared_prefix and num_beams > 1
+    if num_beams > 1 and not fork_prefix:
+        input_ids = input_ids.repeat_interleave(num_beams, dim=0)
+        attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+        state = repeat_interleave_nested(state, num_beams)
+    max_length = input_ids.size(1) + max_new_tokens
+    device = input_ids.device
+
+    # active[i] is the original sample index of the i-th live sample
+    active = list(range(batch_size))
+    results = [None] * batch_size
+    beam_hyps = [BeamHypotheses(num_beams, length_penalty) for _ in range(batch_size)]
+    beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float, device=device)
+    beam_scores[:, 1:] = -1e9
+    beam_scores = beam_scores.view(-1)
+    past = None
+
+    while True:
+        cur_len = input_ids.size(1)
+        n_active = len(active)
+        logits, past = step_fn(input_ids, attention_mask, past, state)
+        if fork_prefix:
+            # the prefix ran once per sample, from here on every beam has its own rows
+            logits, past = logits[:, -1:].repeat_interleave(num_beams, dim=0), repeat_interleave_nested(past, num_beams)
+            input_ids = input_ids.repeat_interleave(num_beams, dim=0)
+            attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+            state = repeat_interleave_nested(state, num_beams)
+            fork_prefix = False
+        # greedy search processes raw logits, beam search log-probs (as transformers does)
+        scores = logits[:, -1, :] if num_beams == 1 else F.log_softmax(logits[:, -1, :], dim=-1)
+        scores = process_scores(scores, input_ids, min_length, eos_token_id, repetition_penalty)
+
+        if num_beams == 1:
+            next_tokens = torch.argmax(scores, dim=-1)
+            input_ids = torch.cat([input_ids, next_tokens.unsqueeze(-1)], dim=-1)
+            if eos_token_id is not None:
+                finished = (next_tokens == eos_token_id).tolist()
+            else:
+                finished = [False] * n_active
+            keep = []
+            for i in range(n_active):
+                if finished[i]:
+                    results[active[i]] = input_ids[i]
+                else:
+                    keep.append(i)
+            keep_rows = torch.tensor(keep, dtype=torch.long, device=device)
+            prev_rows = keep_rows
+        else:
+            vocab_size = scores.size(-1)
+            scores = scores + beam_scores[:, None].expand_as(scores)
+            scores = scores.view(n_active, num_beams * vocab_size)
+            top_scores, top_tokens = torch.topk(scores, 2 * num_beams, dim=1, largest=True, sorted=True)
+            top_beams = torch.div(top_tokens, vocab_size, rounding_mode='floor')
+            top_tokens = top_tokens % vocab_size
+
+            top_scores_l, top_tokens_l, top_beams_l = top_scores.tolist(), top_tokens.tolist(), top_beams.tolist()
+            next_scores, next_tokens, next_rows = [], [], []
+            keep = []
+            for i in range(n_active):
+                hyps = beam_hyps[active[i]]
+                beam_idx = 0
+                for rank, (token, score, beam) in enumerate(zip(top_tokens_l[i], top_scores_l[i], top_beams_l[i])):
+                    row = i * num_beams + beam
+                    if eos_token_id is not None and token == eos_token_id:
+                        if rank >= num_beams:
+                            continue
+                        hyps.add(input_ids[row].clone(), score)
+                    else:
+                        next_scores.append(score)
+                        next_tokens.append(token)
+                        next_rows.append(row)
+                        beam_idx += 1
+                    if beam_idx == num_beams:
+                        break
+                if not hyps.is_done(max(top_scores_l[i]), cur_len):
+                    keep.append(i)
+
+            next_scores = torch.tensor(next_scores, dtype=torch.float, device=device)
+            next_tokens = torch.tensor(next_tokens, dtype=torch.long, device=device)
+            next_rows = torch.tensor(next_rows, dtype=torch.long, device=device)
+            input_ids = torch.cat([input_ids[next_rows], next_tokens.unsqueeze(-1)], dim=-1)
+            beam_scores = next_scores
+
+            keep_rows = torch.tensor([i * num_beams + b for i in keep for b in range(num_beams)],
+                                     dtype=torch.long, device=device)
+            # beam reordering and compaction in a single gather over the previous layout
+            prev_rows = next_rows[keep_rows]
+            keep_set = set(keep)
+            for i in range(n_active):
+                if i not in keep_set:
+                    results[active[i]] = beam_hyps[active[i]].best()
+
+        active = [active[i] for i in keep]
+        if len(keep) < n_active or num_beams > 1:
+            input_ids = input_ids[keep_rows]
+            beam_scores = beam_scores[keep_rows] if num_beams > 1 else beam_scores
+            attention_mask = attention_mask[prev_rows]
+            state = index_select_nested(state, prev_rows)
+            past = index_select_nested(past, prev_rows)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.size(0), 1))], dim=-1)
+
+        if len(active) == 0:
+            break
+        if input_ids.size(1) >= max_length:
+            for i, idx in enumerate(active):
+                if num_beams == 1:
+                    results[idx] = input_ids[i]
+                else:
+                    for b in range(num_beams):
+                        row = i * num_beams + b
+                        beam_hyps[idx].add(input_ids[row], beam_scores[row].item())
+                    results[idx] = beam_hyps[idx].best()
+            break
+
+    if num_beams > 1 and eos_token_id is not None:
+        eos = torch.tensor([eos_token_id], dtype=torch.long, device=device)
+        results = [torch.cat([r, eos]) if r.size(0) < max_length else r for r in results]
+    return pad_sequence(results, batch_first=True, padding_value=pad_token_id)
+
+
+def slice_past(past, end):
+    """keep the first `end` cached positions of a [N, heads, L, head_dim] KV cache"""
+    if torch.is_tensor(past):
+        return past[:, :, :end]
+    return type(past)(slice_past(p, end) for p in past)
+
+
+class IncrementalDecoder(object):
+    """
+    KV cache of one decoder that accepts ragged feeds.
+
+    Every row may feed a different number of tokens per call: rows are right-padded and the pads, as well as
+    tokens removed later by truncate() (e.g. rejected draft tokens), stay in the cache as masked holes.
+    Position ids are passed explicitly so the holes do not shift the positions of the following tokens.
+
+    forward_fn: callable(input_ids, attention_mask, position_ids, past, state) -> (logits [N, T, V], past)
+    """
+
+    def __init__(self, forward_fn, state):
+        self.forward_fn = forward_fn
+        self.state = state
+        self.past = None
+        self.mask = None
+        self.col_pos = None
+        self.length = None
+
+    def prefill(self, input_ids, attention_mask):
+        n, l = input_ids.shape
+        position_ids = torch.arange(l, device=input_ids.device).unsqueeze(0).expand(n, -1)
+        logits, self.past = self.forward_fn(input_ids, attention_mask, position_ids, None, self.state)
+        self.mask = attention_mask
+        # logical position of every cached column, -1 for holes
+        self.col_pos = position_ids.masked_fill(attention_mask == 0, -1)
+        self.length = torch.full((n,), l, dtype=torch.long, device=input_ids.device)
+        return logits
+
+    def feed(self, input_ids, counts):
+        """input_ids: [N, P] right-padded, counts: [N] number of real tokens per row"""
+        steps = torch.arange(input_ids.size(1), device=input_ids.device).unsqueeze(0)
+        position_ids = self.length.unsqueeze(1) + steps
+        real = steps < counts.unsqueeze(1)
+        attention_mask = torch.cat([self.mask, real.to(self.mask.dtype)], dim=1)
+        logits, self.past = self.forward_fn(input_ids, attention_mask, position_ids, self.past, self.state)
+        self.mask = attention_mask
+        self.col_pos = torch.cat([self.col_pos, position_ids.masked_fill(~real, -1)], dim=1)
+        self.length = self.length + counts
+        return logits
+
+    def truncate(self, lengths):
+        """keep only the first lengths[i] logical tokens of row i"""
+        valid = (self.col_pos >= 0) & (self.col_pos < lengths.unsqueeze(1))
+        self.mask = self.mask * valid.to(self.mask.dtype)
+        self.length = torch.minimum(self.length, lengths)
+        # drop trailing columns that are holes in every row
+        used = (self.mask.sum(0) > 0).nonzero()
+        end = used[-1].item() + 1 if used.numel() > 0 else 0
+        if end < self.mask.size(1):
+            self.past = slice_past(self.past, end)
+            self.mask = self.mask[:, :end]
+            self.col_pos = self.col_pos[:, :end]
+
+    def select(self, rows):
+        self.past = index_select_nested(self.past, rows)
+        self.mask = self.mask.index_select(0, rows)
+        self.col_pos = self.col_pos.index_select(0, rows)
+        self.length = self.length.index_select(0, rows)
+        self.state = index_select_nested(self.state, rows)
+
+
+def verify_greedy(logits, seqs, drafts, min_length, eos_token_id, repetition_penalty):
+    """
+    Greedy token of every verified position.
+
+    logits: [N, K+1, V], column j predicts the token following seqs[i] + drafts[i][:j]
+    Returns a list of N lists with K+1 token ids.
+    """
+    device = logits.device
+    lengths = torch.tensor([len(s) for s in seqs], dtype=torch.long, device=device)
+    context = [s + d for s, d in zip(seqs, drafts)]
+    width = max(len(c) for c in context)
+    # pad with the first token of the row: duplicates leave the repetition penalty unchanged
+    context = torch.tensor([c + [c[0]] * (width - len(c)) for c in context], dtype=torch.long, device=device)
+    steps = torch.arange(width, device=device).unsqueeze(0)
+    preds = []
+    for j in range(logits.size(1)):
+        scores = logits[:, j, :].clone()
+        prefix_len = lengths + j
+        if repetition_penalty != 1.0:
+            ids = torch.where(steps < prefix_len.unsqueeze(1), context, context[:, :1])
+            score = torch.gather(scores, 1, ids)
+            score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+            scores.scatter_(1, ids, score)
+        if eos_token_id is not None:
+            scores[prefix_len < min_length, eos_token_id] = -float("inf")
+        preds.append(torch.argmax(scores, dim=-1))
+    return torch.stack(preds, dim=1).tolist()
+
+
+def new_draft_stats():
+    # rows counts the samples scored per forward, so tokens / rows is the tokens a sample gains per verification
+    return {'proposed': 0, 'accepted': 0, 'tokens': 0, 'forwards': 0, 'rows': 0}
+
+
+@torch.no_grad()
+def speculative_generate(forward_fn, drafter, input_ids, attention_mask, state, max_new_tokens=100, min_length=0,
+                         eos_token_id=None, pad_token_id=0, repetition_penalty=1.0, num_draft_tokens=4, stats=None):
+    """
+    Greedy decoding with draft tokens verified by the full decoder.
+
+    Each round the drafter proposes up to num_draft_tokens tokens per sample; the full decoder scores the last
+    generated token plus the drafts in one forward pass and keeps the longest prefix that matches its own greedy
+    choice, plus its own next token. The output is therefore the same as plain greedy decoding. Finished
+    samples are removed from the running batch as in compact_generate.
+
+    drafter: object with start(input_ids, attention_mask, state), propose(seqs, k) -> list of token lists,
+        and select(rows) called when finished samples are removed.
+    """
+    batch_size, prompt_len = input_ids.shape
+    device = input_ids.device
+    max_length = prompt_len + max_new_tokens
+    stats = stats if stats is not None else new_draft_stats()
+
+    target = IncrementalDecoder(forward_fn, state)
+    logits = target.prefill(input_ids, attention_mask)
+    drafter.start(input_ids, attention_mask, state)
+    stats['forwards'] += 1
+    stats['rows'] += batch_size
+
+    seqs = input_ids.tolist()
+    active = list(range(batch_size))
+    results = [None] * batch_size
+    new_tokens = [p[:1] for p in verify_greedy(logits[:, -1:], seqs, [[]] * batch_size,
+                                               min_length, eos_token_id, repetition_penalty)]
+    while True:
+        keep = []
+        for i, tokens in enumerate(new_tokens):
+            finished = False
+            for token in tokens:
+                seqs[i].append(token)
+                stats['tokens'] += 1
+                if token == eos_token_id or len(seqs[i]) >= max_length:
+                    finished = True
+                    break
+            if finished:
+                results[active[i]] = torch.tensor(seqs[i], dtype=torch.long, device=device)
+            else:
+                keep.append(i)
+        if len(keep) < len(active):
+            rows = torch.tensor(keep, dtype=torch.long, device=device)
+            target.select(rows)
+            drafter.select(keep)
+            seqs = [seqs[i] for i in keep]
+            active = [active[i] for i in keep]
+        if len(active) == 0:
+            break
+
+        drafts = drafter.propose(seqs, num_draft_tokens)
+        drafts = [d[:max(min(num_draft_tokens, max_length - len(s) - 1), 0)] for s, d in zip(seqs, drafts)]
+        width = 1 + max(len(d) for d in drafts)
+        feed = torch.tensor([[s[-1]] + d + [pad_token_id] * (width - 1 - len(d)) for s, d in zip(seqs, drafts)],
+                            dtype=torch.long, device=device)
+        counts = torch.tensor([1 + len(d) for d in drafts], dtype=torch.long, device=device)
+        logits = target.feed(feed, counts)
+        stats['forwards'] += 1
+        stats['rows'] += len(active)
+        preds = verify_greedy(logits, seqs, drafts, min_length, eos_token_id, repetition_penalty)
+
+        new_tokens, lengths = [], []
+        for s, d, p in zip(seqs, drafts, preds):
+            n_accept = 0
+            while n_accept < len(d) and p[n_accept] == d[n_accept]:
+                n_accept += 1
+            new_tokens.append(d[:n_accept] + [p[n_accept]])
+            # the cache keeps the last token and the accepted drafts, the new token is fed next round
+            lengths.append(len(s) + n_accept)
+            stats['proposed'] += len(d)
+            stats['accepted'] += n_accept
+        target.truncate(torch.tensor(lengths, dtype=torch.long, device=device))
+
+    return pad_sequence(results, batch_first=True, padding_value=pad_token_id)
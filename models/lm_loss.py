@@ -0,0 +1,39 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+
+def _chunk_loss(head, hidden_states, targets, label_smoothing):
+    logits = head(hidden_states)
+    return F.cross_entropy(logits.float(), targets, reduction='none', label_smoothing=label_smoothing)
+
+
+def chunked_lm_loss(head, hidden_states, labels, chunk_size=1024, label_smoothing=0.0, reduction='mean'):
+    """
+    Language modeling loss without the [B, T, V] logits tensor.
+
+    Only the hidden states at supervised positions (labels != -100) go through the LM head, `chunk_size`
+    tokens at a time; with autograd on, every chunk is checkpointed, so a single chunk of logits is alive
+    in the forward and in the backward pass.
+
+    Args:
+        head: module mapping hidden states to vocabulary logits (e.g. BertOnlyMLMHead, LLaMA lm_head)
+        hidden_states: [B, T, H], already aligned with labels (shifted for next-token prediction)
+        labels: [B, T] target ids, -100 where there is no loss
+        reduction: 'mean' over supervised tokens, or 'none' for the per-sample sum (as BertLMHeadModel)
+    """
+    supervised = labels != -100
+    hidden = hidden_states[supervised]
+    targets = labels[supervised]
+    losses = []
+    for start in range(0, targets.size(0), chunk_size):
+        chunk = (hidden[start:start + chunk_size], targets[start:start + chunk_size])
+        if torch.is_grad_enabled():
+            losses.append(checkpoint(_chunk_loss, head, *chunk, label_smoothing, use_reentrant=False))
+        else:
+            losses.append(_chunk_loss(head, *chunk, label_smoothing))
+    losses = torch.cat(losses) if len(losses) > 0 else hidden.new_zeros(0, dtype=torch.float)
+    if reduction == 'none':
+        sample_index = supervised.nonzero()[:, 0]
+        return losses.new_zeros(labels.size(0)).index_add(0, sample_index, losses)
+    return losses.sum() / max(targets.size(0), 1)
@@ -45,6 +45,8 @@ from transformers.modeling_utils import (
 from transformers.utils import logging
 from transformers.models.bert.configuration_bert import BertConfig
 
+from models.lm_loss import chunked_lm_loss
+
 
 logger = logging.get_logger(__name__)
 
@@ -818,9 +820,27 @@ class BertLMHeadModel(BertPreTrainedModel):
 
         self.bert = BertModel(config, add_pooling_layer=False)
         self.cls = BertOnlyMLMHead(config)
+        # full-vocabulary id of every output position once restrict_output_vocab has been called
+        self.register_buffer('output_vocab', None, persistent=False)
 
         self.init_weights()
 
+    def restrict_output_vocab(self, token_ids):
+        """
+        Inference only: the LM head projects onto token_ids instead of the whole vocabulary. The ids fed to
+        and predicted by the model are then positions in self.output_vocab (sorted token_ids); the input ids
+        are mapped back to the full vocabulary before the embeddings.
+        """
+        predictions = self.cls.predictions
+        weight = predictions.decoder.weight
+        index = torch.tensor(sorted(set(token_ids)), dtype=torch.long, device=weight.device)
+        decoder = nn.Linear(weight.size(1), index.numel(), bias=False, device=weight.device, dtype=weight.dtype)
+        decoder.weight = nn.Parameter(weight.detach()[index].clone())
+        predictions.bias = nn.Parameter(predictions.bias.detach()[index].clone())
+        decoder.bias = predictions.bias
+        predictions.decoder = decoder
+        self.output_vocab = index
+
     def get_output_embeddings(self):
         return self.cls.predictions.decoder
 
@@ -846,6 +866,7 @@ class BertLMHeadModel(BertPreTrainedModel):
         is_decoder=True,
         reduction='mean',
         mode='multimodal', 
+        loss_chunk_size=0,
     ):
         r"""
         encoder_hidden_states  (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`, `optional`):
@@ -868,6 +889,9 @@ class BertLMHeadModel(BertPreTrainedModel):
         use_cache (:obj:`bool`, `optional`):
             If set to :obj:`True`, :obj:`past_key_values` key value states are returned and can be used to speed up
             decoding (see :obj:`past_key_values`).
+        loss_chunk_size (:obj:`int`, `optional`):
+            If > 0 and :obj:`labels` are given, the loss only runs the LM head on the supervised positions, that
+            many tokens at a time (see models/lm_loss.py), and no logits are returned.
         Returns:
         Example::
             >>> from transformers import BertTokenizer, BertLMHeadModel, BertConfig
@@ -882,6 +906,8 @@ class BertLMHeadModel(BertPreTrainedModel):
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
         if labels is not None:
             use_cache = False
+        if self.output_vocab is not None and input_ids is not None:
+            input_ids = self.output_vocab[input_ids]
 
         outputs = self.bert(
             input_ids,
@@ -901,13 +927,19 @@ class BertLMHeadModel(BertPreTrainedModel):
         )
         
         sequence_output = outputs[0]
-        prediction_scores = self.cls(sequence_output)
+        lm_loss = None
+        if labels is not None and loss_chunk_size > 0 and not return_logits:
+            # label positions only, the [B, T, V] prediction scores are never built
+            prediction_scores = None
+            lm_loss = chunked_lm_loss(self.cls, sequence_output[:, :-1, :], labels[:, 1:], chunk_size=loss_chunk_size,
+                                      label_smoothing=0.1, reduction=reduction)
+        else:
+            prediction_scores = self.cls(sequence_output)
         
         if return_logits:
             return prediction_scores[:, :-1, :].contiguous()  
 
-        lm_loss = None
-        if labels is not None:
+        if labels is not None and prediction_scores is not None:
             # we are doing next-token prediction; shift prediction scores and input ids by one
             shifted_prediction_scores = prediction_scores[:, :-1, :].contiguous()
             labels = labels[:, 1:].contiguous()
@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+
+class MemoryCache(object):
+    """
+    LRU cache of the memory transformer's encoder output, keyed by the retrieved clip_indices of a study.
+
+    The encoder self-attends over the K retrieved report features only, so its output [K, C] is the same for
+    every study that retrieves the same reports; only the decoder, whose query comes from the image, has to
+    run per study. Entries are only valid for the weights they were computed with: call clear() after
+    loading or training the model.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'encode_time': 0.}
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def encode(self, encode_fn, clip_memory, clip_indices, padding_mask=None):
+        """
+        memory [K, N, C] for clip_memory [K, N, C] (K x N x C as the memory transformer takes it), running
+        encode_fn(src, key_padding_mask) only on the studies whose clip_indices [N, K] are not cached yet (as
+        one batch). With a padding_mask [N, K] (True at padded items) a study is keyed by its kept indices.
+        """
+        lengths = [clip_indices.size(1)] * clip_indices.size(0) if padding_mask is None else (~padding_mask).sum(1).tolist()
+        keys = [tuple(row[:n]) for row, n in zip(clip_indices.tolist(), lengths)]
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+            elif key not in keys[:i]:
+                missing.append(i)
+            else:
+                # same reports twice in one batch, encoded once
+                self.stats['hits'] += 1
+        self.stats['misses'] += len(missing)
+
+        computed = {}
+        if len(missing) > 0:
+            if clip_memory.is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            index = torch.tensor(missing, dtype=torch.long, device=clip_memory.device)
+            width = max(lengths[i] for i in missing)
+            mask = None if padding_mask is None else padding_mask.index_select(0, index)[:, :width]
+            memory = encode_fn(clip_memory[:width].index_select(1, index), mask)
+            if clip_memory.is_cuda:
+                torch.cuda.synchronize()
+            self.stats['encode_time'] += time.perf_counter() - start
+            for j, i in enumerate(missing):
+                # a copy, a view would keep the storage of the whole batch output alive in the cache
+                computed[keys[i]] = memory[:lengths[i], j].clone()
+
+        columns = []
+        for key in keys:
+            value = computed[key] if key in computed else self.entries[key]
+            # padded items are masked out of the attention, zeros are as good as anything
+            columns.append(F.pad(value, (0, 0, 0, clip_memory.size(0) - value.size(0))))
+        for key, value in computed.items():
+            self.entries[key] = value
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return torch.stack(columns, 1)
+
+    def summary(self):
+        """hit rate and the encoder time the hits saved, estimated from the mean cost of a miss"""
+        lookups = self.stats['hits'] + self.stats['misses']
+        miss_ms = self.stats['encode_time'] / max(self.stats['misses'], 1) * 1000.
+        return {
+            'memory_cache_hit_rate': self.stats['hits'] / max(lookups, 1),
+            'memory_cache_entries': len(self.entries),
+            'memory_cache_miss_ms': miss_ms,
+            'memory_cache_saved_ms': self.stats['hits'] * miss_ms,
+        }
@@ -0,0 +1,95 @@
+import os
+import json
+import inspect
+
+import torch
+from torch import nn
+
+from models.blip import StudyEncoder, SCORES
+
+# newer torch defaults to the dynamo exporter, the graphs below are written for the tracing one
+EXPORT_KWARGS = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+
+class DecoderStep(nn.Module):
+    """text decoder with flat past / present K/V tensors, returns the last-position logits"""
+    def __init__(self, text_decoder):
+        super().__init__()
+        self.text_decoder = text_decoder
+
+    def forward(self, input_ids, attention_mask, encoder_hidden_states, *past):
+        past_key_values = tuple((past[i], past[i + 1]) for i in range(0, len(past), 2)) if len(past) > 0 else None
+        output = self.text_decoder(input_ids,
+                                   attention_mask = attention_mask,
+                                   encoder_hidden_states = encoder_hidden_states,
+                                   past_key_values = past_key_values,
+                                   use_cache = True,
+                                   return_dict = True,
+                                  )
+        return (output.logits[:, -1, :],) + tuple(t for kv in output.past_key_values for t in kv)
+
+
+def export_onnx(model, onnx_dir, image_size=224, clip_k=21, opset=17):
+    """
+    Writes encoder.onnx (image encoder + memory + classification head), decoder_first.onnx (prompt step)
+    and decoder_step.onnx (one token with explicit past K/V), plus the tokenizer and generation.json that
+    models/onnx_generate.py needs to run without torch.
+    """
+    os.makedirs(onnx_dir, exist_ok=True)
+    model = model.eval().cpu()
+    num_layers = model.text_decoder.config.num_hidden_layers
+    batch_size = 2
+    image = torch.randn(batch_size, 3, image_size, image_size)
+    clip_memory = torch.randn(batch_size, clip_k, 512)
+
+    with torch.no_grad():
+        torch.onnx.export(StudyEncoder(model).eval(), (image, clip_memory), os.path.join(onnx_dir, 'encoder.onnx'),
+                          input_names=['image', 'clip_memory'],
+                          output_names=['image_embeds', 'cls_probs', 'cls_preds'],
+                          dynamic_axes={'image': {0: 'batch'}, 'clip_memory': {0: 'batch'}, 'image_embeds': {0: 'batch'},
+                                        'cls_probs': {0: 'batch'}, 'cls_preds': {0: 'batch'}},
+                          opset_version=opset, **EXPORT_KWARGS)
+        image_embeds, _, cls_preds = model.encode(image, clip_memory)
+
+        # the prompt is [DEC] followed by one score token per class
+        score_ids = model.score_token_ids.tolist()
+        input_ids = torch.tensor([[model.tokenizer.bos_token_id] + [score_ids[c] for c in row] for row in cls_preds.tolist()])
+        attention_mask = torch.ones_like(input_ids)
+        decoder = DecoderStep(model.text_decoder).eval()
+        past_names = ['past_{}_{}'.format(i, kv) for i in range(num_layers) for kv in ['key', 'value']]
+        present_names = ['present_{}_{}'.format(i, kv) for i in range(num_layers) for kv in ['key', 'value']]
+
+        dynamic_axes = {'input_ids': {0: 'batch', 1: 'seq'}, 'attention_mask': {0: 'batch', 1: 'total_seq'},
+                        'encoder_hidden_states': {0: 'batch'}, 'logits': {0: 'batch'}}
+        dynamic_axes.update({name: {0: 'batch', 2: 'total_seq'} for name in present_names})
+        torch.onnx.export(decoder, (input_ids, attention_mask, image_embeds), os.path.join(onnx_dir, 'decoder_first.onnx'),
+                          input_names=['input_ids', 'attention_mask', 'encoder_hidden_states'],
+                          output_names=['logits'] + present_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset, **EXPORT_KWARGS)
+
+        outputs = decoder(input_ids, attention_mask, image_embeds)
+        next_ids = torch.argmax(outputs[0], dim=-1, keepdim=True)
+        attention_mask = torch.ones(batch_size, input_ids.size(1) + 1, dtype=torch.long)
+        dynamic_axes = {'input_ids': {0: 'batch'}, 'attention_mask': {0: 'batch', 1: 'total_seq'},
+                        'encoder_hidden_states': {0: 'batch'}, 'logits': {0: 'batch'}}
+        dynamic_axes.update({name: {0: 'batch', 2: 'past_seq'} for name in past_names})
+        dynamic_axes.update({name: {0: 'batch', 2: 'total_seq'} for name in present_names})
+        torch.onnx.export(decoder, (next_ids, attention_mask, image_embeds) + tuple(outputs[1:]),
+                          os.path.join(onnx_dir, 'decoder_step.onnx'),
+                          input_names=['input_ids', 'attention_mask', 'encoder_hidden_states'] + past_names,
+                          output_names=['logits'] + present_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset, **EXPORT_KWARGS)
+
+    model.tokenizer.save_pretrained(os.path.join(onnx_dir, 'tokenizer'))
+    config = {
+        'num_layers': num_layers,
+        'bos_token_id': model.tokenizer.bos_token_id,
+        'eos_token_id': model.tokenizer.sep_token_id,
+        'pad_token_id': model.tokenizer.pad_token_id,
+        'scores': SCORES,
+        'score_token_ids': score_ids,
+        'image_size': image_size,
+        'clip_k': clip_k,
+    }
+    with open(os.path.join(onnx_dir, 'generation.json'), 'w') as f:
+        json.dump(config, f, indent=2)
@@ -0,0 +1,199 @@
+"""
+Report generation over the graphs written by models/onnx_export.py, with ONNX Runtime and numpy only.
+
+The search follows BLIP_Decoder.generate (transformers greedy / beam search with min_length and
+repetition_penalty); finished samples are dropped from the running batch as in models/generation.py.
+"""
+import os
+import json
+
+import numpy as np
+import onnxruntime as ort
+
+
+def log_softmax(x):
+    x = x - x.max(axis=-1, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis=-1, keepdims=True))
+
+
+class BeamHypotheses(object):
+    """numpy twin of models.generation.BeamHypotheses"""
+
+    def __init__(self, num_beams, length_penalty=1.0):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.beams = []
+        self.worst_score = 1e9
+
+    def __len__(self):
+        return len(self.beams)
+
+    def add(self, hyp, sum_logprobs):
+        score = sum_logprobs / (max(len(hyp), 1) ** self.length_penalty)
+        if len(self) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hyp))
+            if len(self) > self.num_beams:
+                sorted_scores = sorted([(s, idx) for idx, (s, _) in enumerate(self.beams)])
+                del self.beams[sorted_scores[0][1]]
+                self.worst_score = sorted_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs, cur_len):
+        if len(self) < self.num_beams:
+            return False
+        cur_score = best_sum_logprobs / (max(cur_len, 1) ** self.length_penalty)
+        return self.worst_score >= cur_score
+
+    def best(self):
+        return sorted(self.beams, key=lambda x: x[0])[-1][1]
+
+
+class OnnxReportGenerator(object):
+
+    def __init__(self, onnx_dir, num_threads=0, tokenizer=None):
+        options = ort.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        providers = ['CPUExecutionProvider']
+        self.encoder = ort.InferenceSession(os.path.join(onnx_dir, 'encoder.onnx'), options, providers=providers)
+        self.decoder_first = ort.InferenceSession(os.path.join(onnx_dir, 'decoder_first.onnx'), options, providers=providers)
+        self.decoder_step = ort.InferenceSession(os.path.join(onnx_dir, 'decoder_step.onnx'), options, providers=providers)
+        with open(os.path.join(onnx_dir, 'generation.json'), 'r') as f:
+            self.config = json.load(f)
+        self.num_layers = self.config['num_layers']
+        self.eos_token_id = self.config['eos_token_id']
+        self.past_names = ['past_{}_{}'.format(i, kv) for i in range(self.num_layers) for kv in ['key', 'value']]
+        if tokenizer is None:
+            # the tokenizer is pure python, no torch needed
+            from transformers import BertTokenizer
+            tokenizer = BertTokenizer.from_pretrained(os.path.join(onnx_dir, 'tokenizer'))
+        self.tokenizer = tokenizer
+
+    def _process_scores(self, scores, input_ids, min_length, repetition_penalty):
+        if repetition_penalty != 1.0:
+            score = np.take_along_axis(scores, input_ids, 1)
+            score = np.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+            np.put_along_axis(scores, input_ids, score, 1)
+        if input_ids.shape[1] < min_length:
+            scores[:, self.eos_token_id] = -np.inf
+        return scores
+
+    def _step(self, input_ids, attention_mask, image_embeds, past):
+        feed = {'input_ids': input_ids, 'attention_mask': attention_mask, 'encoder_hidden_states': image_embeds}
+        if past is None:
+            outputs = self.decoder_first.run(None, feed)
+        else:
+            feed.update(zip(self.past_names, past))
+            outputs = self.decoder_step.run(None, feed)
+        return outputs[0], outputs[1:]
+
+    def search(self, input_ids, image_embeds, num_beams=3, max_new_tokens=100, min_length=0, repetition_penalty=1.0, length_penalty=1.0):
+        """greedy / beam search from [B, L] prompts, returns a list of token id lists (prompt included)"""
+        batch_size = input_ids.shape[0]
+        input_ids = np.repeat(input_ids, num_beams, axis=0)
+        image_embeds = np.repeat(image_embeds, num_beams, axis=0)
+        max_length = input_ids.shape[1] + max_new_tokens
+
+        active = list(range(batch_size))
+        results = [None] * batch_size
+        beam_hyps = [BeamHypotheses(num_beams, length_penalty) for _ in range(batch_size)]
+        beam_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.reshape(-1)
+        past = None
+
+        while True:
+            cur_len = input_ids.shape[1]
+            n_active = len(active)
+            attention_mask = np.ones(input_ids.shape, dtype=np.int64)
+            logits, past = self._step(input_ids if past is None else input_ids[:, -1:], attention_mask, image_embeds, past)
+            # greedy search processes raw logits, beam search log-probs (as transformers does)
+            scores = logits.copy() if num_beams == 1 else log_softmax(logits)
+            scores = self._process_scores(scores, input_ids, min_length, repetition_penalty)
+
+            if num_beams == 1:
+                next_tokens = np.argmax(scores, axis=-1)
+                input_ids = np.concatenate([input_ids, next_tokens[:, None]], axis=1)
+                keep = []
+                for i in range(n_active):
+                    if next_tokens[i] == self.eos_token_id:
+                        results[active[i]] = input_ids[i].tolist()
+                    else:
+                        keep.append(i)
+                keep_rows = np.array(keep, dtype=np.int64)
+                prev_rows = keep_rows
+            else:
+                vocab_size = scores.shape[-1]
+                scores = scores + beam_scores[:, None]
+                scores = scores.reshape(n_active, num_beams * vocab_size)
+                top = np.argpartition(-scores, 2 * num_beams, axis=1)[:, :2 * num_beams]
+                top_scores = np.take_along_axis(scores, top, 1)
+                order = np.argsort(-top_scores, axis=1, kind='stable')
+                top = np.take_along_axis(top, order, 1)
+                top_scores = np.take_along_axis(top_scores, order, 1)
+                top_beams, top_tokens = top // vocab_size, top % vocab_size
+
+                next_scores, next_tokens, next_rows = [], [], []
+                keep = []
+                for i in range(n_active):
+                    hyps = beam_hyps[active[i]]
+                    beam_idx = 0
+                    for rank in range(2 * num_beams):
+                        token, score, beam = int(top_tokens[i, rank]), float(top_scores[i, rank]), int(top_beams[i, rank])
+                        row = i * num_beams + beam
+                        if token == self.eos_token_id:
+                            if rank >= num_beams:
+                                continue
+                            hyps.add(input_ids[row].tolist(), score)
+                        else:
+                            next_scores.append(score)
+                            next_tokens.append(token)
+                            next_rows.append(row)
+                            beam_idx += 1
+                        if beam_idx == num_beams:
+                            break
+                    if not hyps.is_done(float(top_scores[i].max()), cur_len):
+                        keep.append(i)
+
+                next_rows = np.array(next_rows, dtype=np.int64)
+                input_ids = np.concatenate([input_ids[next_rows], np.array(next_tokens, dtype=np.int64)[:, None]], axis=1)
+                beam_scores = np.array(next_scores, dtype=np.float32)
+                keep_rows = np.array([i * num_beams + b for i in keep for b in range(num_beams)], dtype=np.int64)
+                prev_rows = next_rows[keep_rows]
+                for i in range(n_active):
+                    if i not in keep:
+                        results[active[i]] = beam_hyps[active[i]].best()
+
+            active = [active[i] for i in keep]
+            if len(keep) < n_active or num_beams > 1:
+                input_ids = input_ids[keep_rows]
+                beam_scores = beam_scores[keep_rows] if num_beams > 1 else beam_scores
+                image_embeds = image_embeds[prev_rows]
+                past = [p[prev_rows] for p in past]
+
+            if len(active) == 0:
+                break
+            if input_ids.shape[1] >= max_length:
+                for i, idx in enumerate(active):
+                    if num_beams == 1:
+                        results[idx] = input_ids[i].tolist()
+                    else:
+                        for b in range(num_beams):
+                            row = i * num_beams + b
+                            beam_hyps[idx].add(input_ids[row].tolist(), float(beam_scores[row]))
+                        results[idx] = beam_hyps[idx].best()
+                break
+        return results
+
+    def generate(self, image, clip_memory, num_beams=3, max_length=100, min_length=10, repetition_penalty=1.0):
+        """numpy counterpart of BLIP_Decoder.generate(sample=False): reports, cls_preds, cls_preds_logits"""
+        image_embeds, cls_probs, cls_preds = self.encoder.run(None, {'image': image.astype(np.float32),
+                                                                     'clip_memory': clip_memory.astype(np.float32)})
+        score_ids = self.config['score_token_ids']
+        input_ids = np.array([[self.config['bos_token_id']] + [score_ids[c] for c in row] for row in cls_preds], dtype=np.int64)
+        outputs = self.search(input_ids, image_embeds, num_beams=num_beams, max_new_tokens=max_length,
+                              min_length=min_length, repetition_penalty=repetition_penalty)
+        prompt_length = input_ids.shape[1]
+        captions = self.tokenizer.batch_decode([output[prompt_length:] for output in outputs], skip_special_tokens=True)
+        return captions, cls_preds.tolist(), cls_probs[:, 1, :14]
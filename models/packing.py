@@ -0,0 +1,115 @@
+import torch
+import torch.nn.functional as F
+
+from models.lm_loss import chunked_lm_loss
+
+
+def pack_layout(lengths, budget):
+    """
+    First-fit decreasing assignment of sequences to rows of at most `budget` tokens.
+    Returns (row, offset) per sequence, in input order, and the number of rows.
+    """
+    fill = []
+    layout = [None] * len(lengths)
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for row in range(len(fill)):
+            if fill[row] + lengths[i] <= budget:
+                break
+        else:
+            row = len(fill)
+            fill.append(0)
+        layout[i] = (row, fill[row])
+        fill[row] += lengths[i]
+    return layout, len(fill)
+
+
+def pack_batch(inputs_embeds, attention_mask, labels, budget=0):
+    """
+    Packs the valid (attention_mask == 1) positions of a padded batch into rows of at most `budget`
+    tokens (at least the longest sequence), so that no row carries padding in the middle.
+
+    Labels are shifted inside every sequence before packing (the last position of a sequence gets -100),
+    so a sequence never learns to predict the first token of its neighbour.
+
+    Returns a dict with the packed inputs_embeds [R, T, H], position_ids [R, T] restarting at 0 for every
+    sequence, seq_ids [R, T] (sequence index, -1 for the trailing pads of a row), the shifted labels
+    [R, T] and the number of real tokens / packed slots / padded slots of the batch.
+    """
+    valid = attention_mask.bool()
+    lengths = valid.sum(1)
+    lengths_l = lengths.tolist()
+    budget = max(budget, max(lengths_l))
+    layout, num_rows = pack_layout(lengths_l, budget)
+    device = inputs_embeds.device
+
+    flat_embeds = inputs_embeds[valid]
+    flat_labels = labels[valid]
+    ends = lengths.cumsum(0)
+    flat_labels = torch.cat([flat_labels[1:], flat_labels.new_full((1,), -100)])
+    flat_labels[ends - 1] = -100
+    starts = torch.repeat_interleave(ends - lengths, lengths)
+    flat_pos = torch.arange(flat_embeds.size(0), device=device) - starts
+
+    rows = torch.tensor([r for r, _ in layout], device=device)
+    offsets = torch.tensor([o for _, o in layout], device=device)
+    dest_row = torch.repeat_interleave(rows, lengths)
+    dest_col = torch.repeat_interleave(offsets, lengths) + flat_pos
+    seq_len = int(dest_col.max()) + 1
+
+    packed = inputs_embeds.new_zeros(num_rows, seq_len, inputs_embeds.size(-1))
+    packed = packed.index_put((dest_row, dest_col), flat_embeds)
+    position_ids = torch.zeros(num_rows, seq_len, dtype=torch.long, device=device)
+    position_ids[dest_row, dest_col] = flat_pos
+    seq_ids = torch.full((num_rows, seq_len), -1, dtype=torch.long, device=device)
+    seq_ids[dest_row, dest_col] = torch.repeat_interleave(torch.arange(len(lengths_l), device=device), lengths)
+    packed_labels = torch.full((num_rows, seq_len), -100, dtype=labels.dtype, device=device)
+    packed_labels[dest_row, dest_col] = flat_labels
+
+    return {
+        'inputs_embeds': packed,
+        'position_ids': position_ids,
+        'seq_ids': seq_ids,
+        'labels': packed_labels,
+        'tokens': int(flat_embeds.size(0)),
+        'packed_slots': num_rows * seq_len,
+        'padded_slots': attention_mask.numel(),
+    }
+
+
+def packed_causal_mask(seq_ids, dtype):
+    """additive [R, 1, T, T] mask: causal inside a sequence, nothing across sequences (block diagonal)"""
+    seq_len = seq_ids.size(1)
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=seq_ids.device).tril()
+    allowed = (seq_ids[:, :, None] == seq_ids[:, None, :]) & causal & (seq_ids[:, None, :] >= 0)
+    # trailing pads attend to themselves only, which keeps their (unused) softmax finite
+    allowed |= torch.eye(seq_len, dtype=torch.bool, device=seq_ids.device)
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=seq_ids.device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min).unsqueeze(1)
+
+
+def packed_llama_forward(llama, inputs_embeds, position_ids, seq_ids):
+    """
+    Runs the decoder layers of a (peft wrapped) LlamaForCausalLM over packed rows with a block diagonal
+    causal mask, returns the final hidden states. LlamaModel.forward only builds causal masks from 2D
+    padding masks, so the layers are called directly (with gradient checkpointing when it is enabled).
+    """
+    base = llama.get_base_model() if hasattr(llama, 'get_base_model') else llama
+    decoder = base.model
+    attention_mask = packed_causal_mask(seq_ids, inputs_embeds.dtype)
+    hidden_states = inputs_embeds
+    for layer in decoder.layers:
+        if decoder.gradient_checkpointing and decoder.training:
+            hidden_states = decoder._gradient_checkpointing_func(layer.__call__, hidden_states, attention_mask, position_ids,
+                                                                 None, False, False)[0]
+        else:
+            hidden_states = layer(hidden_states, attention_mask=attention_mask, position_ids=position_ids)[0]
+    return decoder.norm(hidden_states)
+
+
+def packed_lm_loss(llama, hidden_states, labels, chunk_size=0):
+    """token-mean cross-entropy of already shifted labels, as LlamaForCausalLM computes it"""
+    base = llama.get_base_model() if hasattr(llama, 'get_base_model') else llama
+    if chunk_size > 0:
+        return chunked_lm_loss(base.lm_head, hidden_states, labels, chunk_size=chunk_size)
+    logits = base.lm_head(hidden_states).float()
+    return F.cross_entropy(logits.view(-1, logits.size(-1)), labels.view(-1), ignore_index=-100)
@@ -0,0 +1,45 @@
+import torch
+from torch import nn
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+# everything after the image encoder, the nn.Linear layers of these run as dynamic int8
+DYNAMIC_MODULES = ['text_decoder', 'memory', 'vision_proj', 'cls_head']
+
+
+def quantize_dynamic_blip(model):
+    """dynamic int8 (weights int8, activations quantized on the fly) for the nn.Linear layers, in place, CPU only"""
+    quantize_dynamic(model, {name: default_dynamic_qconfig for name in DYNAMIC_MODULES},
+                     mapping={nn.Linear: nnqd.Linear}, inplace=True)
+    return model
+
+
+def quantize_static_encoder(model, calib_images, backend='x86'):
+    """post-training static int8 of the ResNet-101 backbone, observers calibrated on an iterable of image batches"""
+    torch.backends.quantized.engine = backend
+    backbone = model.visual_encoder.model.eval()
+    calib_images = iter(calib_images)
+    images = next(calib_images)
+    prepared = prepare_fx(backbone, get_default_qconfig_mapping(backend), example_inputs=(images,))
+    with torch.no_grad():
+        prepared(images)
+        for images in calib_images:
+            prepared(images)
+    model.visual_encoder.model = convert_fx(prepared)
+    return model
+
+
+def save_static_encoder(model, path):
+    # the converted graph module does not survive pickling, store it as TorchScript
+    torch.jit.save(torch.jit.script(model.visual_encoder.model), path)
+
+
+def quantize_blip(model, mode='dynamic', encoder_path=None, backend='x86'):
+    """mode: dynamic, or static which additionally loads a backbone calibrated by main_quantize.py"""
+    model.eval()
+    quantize_dynamic_blip(model)
+    if mode == 'static':
+        torch.backends.quantized.engine = backend
+        model.visual_encoder.model = torch.jit.load(encoder_path, map_location='cpu')
+    return model
@@ -1,20 +1,68 @@
 import torch
 import torch.nn as nn
 import torchvision.models as models
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def fold_batchnorm(module):
+    """fold every BatchNorm2d registered right after a Conv2d into that convolution, eval mode only"""
+    names = list(module._modules.keys())
+    for prev, name in zip(names[:-1], names[1:]):
+        conv, bn = module._modules[prev], module._modules[name]
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            module._modules[prev] = fuse_conv_bn_eval(conv, bn)
+            module._modules[name] = nn.Identity()
+    for child in module.children():
+        fold_batchnorm(child)
+    return module
+
 
 class blip_resnet(nn.Module):
-    def __init__(self, args):
+    def __init__(self, args, pretrained=True):
         super(blip_resnet, self).__init__()
-        model = getattr(models, 'resnet101')(pretrained=True)
+        # args.tiny: a random-init ResNet-18 (512 features) for offline CPU benchmarks and CI
+        arch = 'resnet18' if getattr(args, 'tiny', False) else 'resnet101'
+        model = getattr(models, arch)(pretrained=pretrained)
+        self.feature_dim = model.fc.in_features
         modules = list(model.children())[:-2]
         self.model = nn.Sequential(*modules)
         map_size = int(args.image_size / 32)
         self.avg_fnt = torch.nn.AvgPool2d(kernel_size=map_size, stride=1, padding=0)
+        self.image_size = map_size * 32
+        self.channels_last = False
+        self.fused_pool = False
+
+    def prepare_for_inference(self, channels_last=True, fuse_relu=False):
+        """
+        Folds BatchNorm into the convolutions, switches to channels-last and pools over the flattened patch
+        view. fuse_relu additionally freezes the backbone as TorchScript with conv+ReLU fusion. The
+        parameters no longer match a checkpoint afterwards, so call it after loading.
+        """
+        self.eval()
+        fold_batchnorm(self.model)
+        self.channels_last = channels_last
+        if channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
+        if fuse_relu:
+            device = next(self.model.parameters()).device
+            example = torch.zeros(1, 3, self.image_size, self.image_size, device=device)
+            if channels_last:
+                example = example.contiguous(memory_format=torch.channels_last)
+            with torch.no_grad():
+                self.model = torch.jit.optimize_for_inference(torch.jit.trace(self.model, example))
+        self.fused_pool = True
+        return self
+
     def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         patch_feats = self.model(x)
-        avg_feats = self.avg_fnt(patch_feats).flatten(1)
         batch_size, feat_size, _, _ = patch_feats.shape
+        if self.fused_pool:
+            # NxLxD straight from the NHWC layout (a view for channels-last), average pooling over the same view
+            patch_feats = patch_feats.permute(0, 2, 3, 1).reshape(batch_size, -1, feat_size)
+            return patch_feats, patch_feats.mean(1)
+        avg_feats = self.avg_fnt(patch_feats).flatten(1)
         # NxLxD
         patch_feats = patch_feats.reshape(batch_size, feat_size, -1).permute(0, 2, 1)
         return patch_feats, avg_feats
-
@@ -0,0 +1,229 @@
+import importlib
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def kmeans(x, num_clusters, iters=20, seed=0):
+    """plain Lloyd k-means on the rows of x [M, D], returns the centroids [num_clusters, D]"""
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(x.size(0), generator=generator)[:num_clusters].to(x.device)].clone()
+    for _ in range(iters):
+        assign = torch.cdist(x, centroids).argmin(1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=num_clusters).unsqueeze(1)
+        # empty clusters keep their previous centroid
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids
+
+
+class RetrievalIndex(object):
+    """
+    Cosine nearest-neighbour search over the clip_text_features bank.
+
+    mode='exact' is brute force: batched matmul of the normalized queries against the normalized bank.
+    mode='ivfpq' is approximate: the bank is split into nlist k-means cells (IVF), the residual of every
+    feature to its cell centroid is product-quantized into num_subspaces one-byte codes, and a query only
+    scans the codes of its nprobe closest cells, with per-cell distance lookup tables. With rerank > 0 the
+    rerank * k best approximate candidates are re-scored exactly.
+    """
+
+    def __init__(self, features, mode='exact', nlist=256, nprobe=16, num_subspaces=32, num_codes=256, rerank=0,
+                 batch_size=1024, max_train=65536, seed=0):
+        assert mode in ['exact', 'ivfpq'], mode
+        self.features = torch.as_tensor(features).float()
+        self.normed = F.normalize(self.features, dim=-1)
+        self.mode = mode
+        self.nlist = min(nlist, self.features.size(0))
+        self.nprobe = nprobe
+        self.num_subspaces = num_subspaces
+        self.num_codes = num_codes
+        self.rerank = rerank
+        self.batch_size = batch_size
+        self.max_train = max_train
+        self.seed = seed
+        self.ivf = None
+
+    @classmethod
+    def from_json(cls, path='./data/mimic_cxr/clip_text_features.json', **kwargs):
+        with open(path, 'r') as f:
+            features = np.array(json.load(f), dtype=np.float32)
+        return cls(torch.from_numpy(features), **kwargs)
+
+    def to(self, device):
+        self.features = self.features.to(device)
+        self.normed = self.normed.to(device)
+        if self.ivf is not None:
+            self.ivf = {k: v.to(device) for k, v in self.ivf.items()}
+        return self
+
+    def build(self, cache_path=None):
+        """trains the IVF-PQ structures (nothing to do for mode='exact'), reusing cache_path if it exists"""
+        if self.mode == 'exact':
+            return self
+        if cache_path is not None and os.path.exists(cache_path):
+            self.ivf = {k: v.to(self.features.device) for k, v in torch.load(cache_path, map_location='cpu').items()}
+            assert self.ivf['order'].size(0) == self.features.size(0), 'the cached index was built on another bank'
+            return self
+        x = self.normed
+        dim = x.size(1)
+        assert dim % self.num_subspaces == 0, 'the feature size must be divisible by num_subspaces'
+        sub_dim = dim // self.num_subspaces
+        generator = torch.Generator().manual_seed(self.seed)
+        train = x[torch.randperm(x.size(0), generator=generator)[:self.max_train].to(x.device)]
+
+        coarse = kmeans(train, self.nlist, seed=self.seed)
+        assign = torch.cdist(x, coarse).argmin(1)
+        residuals = (x - coarse[assign]).view(-1, self.num_subspaces, sub_dim)
+        train_residuals = (train - coarse[torch.cdist(train, coarse).argmin(1)]).view(-1, self.num_subspaces, sub_dim)
+        codebooks, codes = [], []
+        for j in range(self.num_subspaces):
+            codebook = kmeans(train_residuals[:, j], min(self.num_codes, train.size(0)), seed=self.seed + j)
+            codebooks.append(codebook)
+            codes.append(torch.cdist(residuals[:, j], codebook).argmin(1))
+        codes = torch.stack(codes, 1).to(torch.uint8 if self.num_codes <= 256 else torch.int16)
+
+        # inverted lists as one array of feature ids sorted by cell, with the cell offsets
+        order = torch.argsort(assign, stable=True)
+        offsets = torch.zeros(self.nlist + 1, dtype=torch.long, device=x.device)
+        offsets[1:] = torch.bincount(assign, minlength=self.nlist).cumsum(0)
+        # codes [num_subspaces, M] in inverted list order, a probed cell is a contiguous slice
+        self.ivf = {'coarse': coarse, 'codebooks': torch.stack(codebooks, 0), 'cell_codes': codes[order].t().contiguous(),
+                    'order': order, 'offsets': offsets}
+        if cache_path is not None:
+            torch.save({k: v.cpu() for k, v in self.ivf.items()}, cache_path)
+        return self
+
+    def search(self, queries, k):
+        """top-k bank indices [Q, k] (best first) and their cosine similarity for query embeddings [Q, C]"""
+        queries = F.normalize(queries.float().to(self.features.device), dim=-1)
+        if self.mode == 'exact':
+            return self._search_exact(queries, k)
+        assert self.ivf is not None, 'call build() first'
+        return self._search_ivfpq(queries, k)
+
+    def _search_exact(self, queries, k):
+        scores, indices = [], []
+        for start in range(0, queries.size(0), self.batch_size):
+            s, i = torch.topk(queries[start:start + self.batch_size] @ self.normed.t(), k, dim=1)
+            scores.append(s)
+            indices.append(i)
+        return torch.cat(scores, 0), torch.cat(indices, 0)
+
+    def _search_ivfpq(self, queries, k):
+        scores, indices = [], []
+        for start in range(0, queries.size(0), self.batch_size):
+            s, i = self._search_ivfpq_batch(queries[start:start + self.batch_size], k)
+            scores.append(s)
+            indices.append(i)
+        return torch.cat(scores, 0), torch.cat(indices, 0)
+
+    def _search_ivfpq_batch(self, queries, k):
+        ivf = self.ivf
+        device = queries.device
+        num_queries = queries.size(0)
+        num_subspaces, num_codes, sub_dim = ivf['codebooks'].shape
+        cell_scores = queries @ ivf['coarse'].t()
+        probes = torch.topk(cell_scores, min(self.nprobe, self.nlist), dim=1).indices
+        # q . x ~ q . centroid + sum_j q_j . codebook_j[code_j], so the lookup tables [num_subspaces, Q * num_codes]
+        # depend on the query only and stay small enough for the cache
+        tables = torch.einsum('qmd,mcd->mqc', queries.view(num_queries, num_subspaces, sub_dim), ivf['codebooks'])
+        tables = tables.reshape(num_subspaces, -1)
+
+        # every (query, probe) pair expands to the members of its cell, laid out query by query
+        starts, lengths = ivf['offsets'][probes], ivf['offsets'][probes + 1] - ivf['offsets'][probes]
+        pair_lengths = lengths.view(-1)
+        pair_of = torch.repeat_interleave(torch.arange(pair_lengths.size(0), device=device), pair_lengths)
+        within = torch.arange(pair_of.size(0), device=device) - torch.repeat_interleave(pair_lengths.cumsum(0) - pair_lengths, pair_lengths)
+        slots = starts.view(-1)[pair_of] + within
+        candidates = ivf['order'][slots]
+        query_of = pair_of // probes.size(1)
+        # asymmetric scores: one table lookup per subspace and candidate
+        lookup = ivf['cell_codes'][:, slots].long() + (query_of * num_codes).unsqueeze(0)
+        approx = tables.gather(1, lookup).sum(0) + cell_scores.view(-1)[query_of * self.nlist + probes.view(-1)[pair_of]]
+
+        # [Q, max candidates] with -inf after the candidates of a query
+        query_lengths = lengths.sum(1)
+        column = torch.arange(pair_of.size(0), device=device) - torch.repeat_interleave(query_lengths.cumsum(0) - query_lengths, query_lengths)
+        width = max(int(query_lengths.max()), k)
+        padded = approx.new_full((num_queries, width), -float('inf'))
+        padded[query_of, column] = approx
+        ids = candidates.new_zeros(num_queries, width)
+        ids[query_of, column] = candidates
+
+        score, top = torch.topk(padded, min(max(k * self.rerank, k), width), dim=1)
+        found = ids.gather(1, top)
+        valid = torch.isfinite(score)
+        if self.rerank > 0:
+            exact = (self.normed[found] @ queries.unsqueeze(2)).squeeze(2).masked_fill(~valid, -float('inf'))
+            score, order = torch.topk(exact, k, dim=1)
+            found, valid = found.gather(1, order), valid.gather(1, order)
+        else:
+            found, score, valid = found[:, :k], score[:, :k], valid[:, :k]
+        # too few candidates in the probed cells: repeat the best one, with score -1
+        found = torch.where(valid, found, found[:, :1])
+        score = torch.where(valid, score, torch.full_like(score, -1.))
+        return score, found
+
+
+class Retriever(object):
+    """
+    Top-clip_k reports for new studies: embed_fn maps preprocessed images [N, 3, H, W] to query embeddings
+    [N, C] in the space of the clip_text_features bank (e.g. the image tower of the CLIP model that produced it).
+    """
+
+    def __init__(self, index, embed_fn, clip_k=21):
+        self.index = index
+        self.embed_fn = embed_fn
+        self.clip_k = clip_k
+
+    def __call__(self, images):
+        """clip_indices [N, clip_k]"""
+        return self.search(images)[1]
+
+    def search(self, images):
+        """cosine similarities and clip_indices [N, clip_k], best first"""
+        with torch.no_grad():
+            return self.index.search(self.embed_fn(images.to(self.index.features.device)), self.clip_k)
+
+    def memory(self, clip_indices):
+        """clip_memory [N, clip_k, C] of clip_indices, as generation_eval builds it"""
+        return self.index.features[clip_indices.to(self.index.features.device)]
+
+
+def select_memory(clip_scores, policy='none', value=0.0, min_k=1):
+    """
+    How many of the retrieved reports to keep per study [N], given their similarities [N, K] in retrieval
+    order (best first): 'topp' keeps the shortest prefix holding a `value` fraction of the (non-negative)
+    similarity mass, 'threshold' the reports with similarity >= `value`, 'k' the first `value` reports.
+    At least min_k reports are kept.
+    """
+    num_retrieved = clip_scores.size(1)
+    if policy == 'topp':
+        weights = clip_scores.clamp(min=0)
+        mass = weights.cumsum(1) / weights.sum(1, keepdim=True).clamp(min=1e-12)
+        keep = (mass < value).sum(1) + 1
+    elif policy == 'threshold':
+        keep = (clip_scores >= value).sum(1)
+    elif policy == 'k':
+        keep = torch.full_like(clip_scores[:, 0], int(value), dtype=torch.long)
+    else:
+        keep = torch.full_like(clip_scores[:, 0], num_retrieved, dtype=torch.long)
+    return keep.clamp(min=min(min_k, num_retrieved), max=num_retrieved)
+
+
+def load_embed_fn(spec):
+    """'package.module:name' -> the callable it names"""
+    module, _, name = spec.partition(':')
+    assert name, 'expected module:name, got {}'.format(spec)
+    return getattr(importlib.import_module(module), name)
+
+
+def build_retriever(mode, embed_fn, clip_k=21, device='cpu', features_path='./data/mimic_cxr/clip_text_features.json',
+                    cache_path=None, **kwargs):
+    """RetrievalIndex over features_path (built or loaded from cache_path) wrapped with the embed_fn spec"""
+    index = RetrievalIndex.from_json(features_path, mode=mode, **kwargs).to(device).build(cache_path)
+    return Retriever(index, load_embed_fn(embed_fn), clip_k=clip_k)
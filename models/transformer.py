@@ -50,11 +50,27 @@ class Transformer(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-    def forward(self, src, mask, query_embed, pos_embed, tgt=None):
+    def forward(self, src, mask, query_embed, pos_embed, tgt=None, need_weights=False, src_key_padding_mask=None):
+        memory = self.encode_memory(src, pos_embed, src_key_padding_mask)
+        return self.decode(memory, mask, query_embed, pos_embed, tgt, need_weights, src_key_padding_mask)
+
+    def encode_memory(self, src, pos_embed=None, src_key_padding_mask=None):
+        # query independent half, depends only on the retrieved items
+        return self.encoder(src, src_key_padding_mask=src_key_padding_mask, pos=pos_embed)
+
+    def decode(self, memory, mask, query_embed, pos_embed, tgt=None, need_weights=False, memory_key_padding_mask=None):
+        """
+        need_weights=False lets nn.MultiheadAttention run its fused scaled_dot_product_attention path;
+        need_weights=True (for analysis) also returns the per-layer cross / self attention weights.
+        memory_key_padding_mask [N, K] is True at padded memory items (variable number of retrieved reports).
+        """
         if tgt is None:
             tgt = torch.zeros_like(query_embed)
-        memory = self.encoder(src, pos=pos_embed)
-        hs, atten_weights_list, self_atten_weights_list = self.decoder(tgt, memory, tgt_mask=mask, pos=pos_embed, query_pos=query_embed)
+        hs, atten_weights_list, self_atten_weights_list = self.decoder(tgt, memory, tgt_mask=mask, pos=pos_embed, query_pos=query_embed,
+                                                                       memory_key_padding_mask=memory_key_padding_mask,
+                                                                       need_weights=need_weights)
+        if need_weights:
+            return hs.transpose(1, 2), atten_weights_list, self_atten_weights_list
         return hs.transpose(1, 2) 
 
 
@@ -97,21 +113,27 @@ class TransformerDecoder(nn.Module):
                 tgt_key_padding_mask: Optional[Tensor] = None,
                 memory_key_padding_mask: Optional[Tensor] = None,
                 pos: Optional[Tensor] = None,
-                query_pos: Optional[Tensor] = None):
+                query_pos: Optional[Tensor] = None,
+                need_weights: bool = False):
         output = tgt
 
         intermediate = []
         atten_weights_list = []
         self_atten_weights_list = []
 
+        # the cross-attention keys memory + pos are the same for every layer
+        memory_key = memory if pos is None else memory + pos
+
         for layer in self.layers:
             output, atten_weights, self_atten_weights = layer(output, memory, tgt_mask=tgt_mask,
                            memory_mask=memory_mask,
                            tgt_key_padding_mask=tgt_key_padding_mask,
                            memory_key_padding_mask=memory_key_padding_mask,
-                           pos=pos, query_pos=query_pos)
-            atten_weights_list.append(atten_weights)
-            self_atten_weights_list.append(self_atten_weights)
+                           pos=pos, query_pos=query_pos,
+                           memory_key=memory_key, need_weights=need_weights)
+            if need_weights:
+                atten_weights_list.append(atten_weights)
+                self_atten_weights_list.append(self_atten_weights)
             if self.return_intermediate:
                 intermediate.append(self.norm(output))
 
@@ -156,7 +178,7 @@ class TransformerEncoderLayer(nn.Module):
                      pos: Optional[Tensor] = None):
         q = k = self.with_pos_embed(src, pos)
         src2 = self.self_attn(q, k, value=src, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)[0]
+                              key_padding_mask=src_key_padding_mask, need_weights=False)[0]
 
         src = src + self.dropout1(src2)
         src = self.norm1(src)
@@ -172,7 +194,7 @@ class TransformerEncoderLayer(nn.Module):
         src2 = self.norm1(src)
         q = k = self.with_pos_embed(src2, pos)
         src2 = self.self_attn(q, k, value=src2, attn_mask=src_mask,
-                              key_padding_mask=src_key_padding_mask)[0]
+                              key_padding_mask=src_key_padding_mask, need_weights=False)[0]
         src = src + self.dropout1(src2)
         src2 = self.norm2(src)
         src2 = self.linear2(self.dropout(self.activation(self.linear1(src2))))
@@ -219,17 +241,21 @@ class TransformerDecoderLayer(nn.Module):
                      tgt_key_padding_mask: Optional[Tensor] = None,
                      memory_key_padding_mask: Optional[Tensor] = None,
                      pos: Optional[Tensor] = None,
-                     query_pos: Optional[Tensor] = None):
+                     query_pos: Optional[Tensor] = None,
+                     memory_key: Optional[Tensor] = None,
+                     need_weights: bool = False):
+        if memory_key is None:
+            memory_key = self.with_pos_embed(memory, pos)
         q = k = self.with_pos_embed(tgt, query_pos)
         tgt2, self_atten_weights = self.self_attn(q, k, value=tgt, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)
+                              key_padding_mask=tgt_key_padding_mask, need_weights=need_weights)
         tgt = tgt + self.dropout1(tgt2)
         tgt = self.norm1(tgt)
         tgt2, atten_weights = self.multihead_attn(query=self.with_pos_embed(tgt, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
+                                   key=memory_key,
                                    value=memory, attn_mask=memory_mask,
                                    #value=self.with_pos_embed(memory, pos), attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)
+                                   key_padding_mask=memory_key_padding_mask, need_weights=need_weights)
 
         tgt = tgt + self.dropout2(tgt2)
         tgt = self.norm2(tgt)
@@ -244,22 +270,26 @@ class TransformerDecoderLayer(nn.Module):
                     tgt_key_padding_mask: Optional[Tensor] = None,
                     memory_key_padding_mask: Optional[Tensor] = None,
                     pos: Optional[Tensor] = None,
-                    query_pos: Optional[Tensor] = None):
+                    query_pos: Optional[Tensor] = None,
+                    memory_key: Optional[Tensor] = None,
+                    need_weights: bool = False):
+        if memory_key is None:
+            memory_key = self.with_pos_embed(memory, pos)
         tgt2 = self.norm1(tgt)
         q = k = self.with_pos_embed(tgt2, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        tgt2, self_atten_weights = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
+                              key_padding_mask=tgt_key_padding_mask, need_weights=need_weights)
         tgt = tgt + self.dropout1(tgt2)
         tgt2 = self.norm2(tgt)
-        tgt2 = self.multihead_attn(query=self.with_pos_embed(tgt2, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
+        tgt2, atten_weights = self.multihead_attn(query=self.with_pos_embed(tgt2, query_pos),
+                                   key=memory_key,
                                    value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+                                   key_padding_mask=memory_key_padding_mask, need_weights=need_weights)
         tgt = tgt + self.dropout2(tgt2)
         tgt2 = self.norm3(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt2))))
         tgt = tgt + self.dropout3(tgt2)
-        return tgt
+        return tgt, atten_weights, self_atten_weights
 
     def forward(self, tgt, memory,
                 tgt_mask: Optional[Tensor] = None,
@@ -267,12 +297,14 @@ class TransformerDecoderLayer(nn.Module):
                 tgt_key_padding_mask: Optional[Tensor] = None,
                 memory_key_padding_mask: Optional[Tensor] = None,
                 pos: Optional[Tensor] = None,
-                query_pos: Optional[Tensor] = None):
+                query_pos: Optional[Tensor] = None,
+                memory_key: Optional[Tensor] = None,
+                need_weights: bool = False):
         if self.normalize_before:
             return self.forward_pre(tgt, memory, tgt_mask, memory_mask,
-                                    tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
+                                    tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos, memory_key, need_weights)
         return self.forward_post(tgt, memory, tgt_mask, memory_mask,
-                                 tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
+                                 tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos, memory_key, need_weights)
 
 
 def _get_clones(module, N):
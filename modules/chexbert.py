@@ -5,13 +5,15 @@ import torch
 import torch.nn as nn
 
 class CheXbert(nn.Module):
-    def __init__(self, checkpoint_path, device, p=0.1):
+    def __init__(self, checkpoint_path, device, p=0.1, bert_path='bert-base-uncased'):
         super(CheXbert, self).__init__()
 
         self.device = device
 
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-        config = BertConfig().from_pretrained('bert-base-uncased')
+        # bert_path: the hub name or a local directory with config.json and vocab.txt (e.g. the tiny CheXbert
+        # written by main_synthetic.py)
+        self.tokenizer = BertTokenizer.from_pretrained(bert_path)
+        config = BertConfig().from_pretrained(bert_path)
 
         with torch.no_grad():
 
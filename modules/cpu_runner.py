@@ -0,0 +1,116 @@
+import os
+import queue
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+
+def available_cores():
+    """the cores this process may run on (all of them where the affinity cannot be read)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def split_cores(num_workers, size=None):
+    """split the cores this process may run on into num_workers contiguous groups, evenly unless size is given"""
+    cores = available_cores()
+    if size is None:
+        size = max(len(cores) // num_workers, 1)
+    return [cores[(i * size) % len(cores):(i * size) % len(cores) + size] for i in range(num_workers)]
+
+
+def _worker(rank, model, batches, tasks, results, cores, num_threads, num_interop_threads, generate_kwargs):
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_interop_threads)
+    except RuntimeError:
+        # the inter-op pool was already started before the fork
+        pass
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        index = task
+        # loaded here, so only the batches in flight are resident and the parent never holds the split
+        images, clip_memory = batches[index]
+        start = time.perf_counter()
+        with torch.no_grad():
+            reports, cls_preds, cls_preds_logits = model.generate(images, clip_memory, sample=False, **generate_kwargs)
+        results.put((index, rank, reports, cls_preds, cls_preds_logits.float().tolist(), time.perf_counter() - start))
+
+
+class CPURunner(object):
+    """
+    Batch inference of BLIP_Decoder.generate over several forked CPU worker processes.
+
+    The model is loaded once in the parent; workers are forked and read its weights through copy-on-write
+    (or, with a memory-mapped checkpoint, the shared page cache), so the host keeps one copy. Each worker is
+    pinned to its own group of cores with matching intra-op threads and pulls batch indices from a shared
+    queue, loading each batch itself.
+    The parent must not run inference itself before run(), forking after OpenMP has started can hang.
+    """
+
+    def __init__(self, model, num_workers=4, num_threads=0, num_interop_threads=1, pin_cores=True, num_beams=3, max_length=150, min_length=100):
+        self.model = model.eval()
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.pin_cores = pin_cores
+        self.generate_kwargs = {'num_beams': num_beams, 'max_length': max_length, 'min_length': min_length}
+
+    def run(self, batches):
+        """
+        batches: indexable with len(), batches[i] -> (images, clip_memory), loaded lazily in the worker that
+        takes batch i (e.g. main_cpu_infer.StudyBatches). Returns the per-batch results in order and run stats.
+        """
+        ctx = mp.get_context('fork')
+        tasks, results = ctx.Queue(), ctx.Queue()
+        core_groups = split_cores(self.num_workers, self.num_threads if self.num_threads > 0 else None)
+
+        start = time.perf_counter()
+        workers = []
+        for rank in range(self.num_workers):
+            cores = core_groups[rank] if self.pin_cores else None
+            num_threads = self.num_threads if self.num_threads > 0 else len(core_groups[rank])
+            p = ctx.Process(target=_worker, args=(rank, self.model, batches, tasks, results, cores, num_threads,
+                                                  self.num_interop_threads, self.generate_kwargs), daemon=True)
+            p.start()
+            workers.append(p)
+
+        num_batches, num_studies = len(batches), 0
+        for index in range(num_batches):
+            tasks.put(index)
+        for _ in workers:
+            tasks.put(None)
+
+        outputs = [None] * num_batches
+        busy = [0.] * self.num_workers
+        received = 0
+        while received < num_batches:
+            try:
+                index, rank, reports, cls_preds, cls_preds_logits, elapsed = results.get(timeout=1.0)
+            except queue.Empty:
+                failed = [p.exitcode for p in workers if p.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError('cpu worker exited with code {}'.format(failed[0]))
+                continue
+            outputs[index] = (reports, cls_preds, cls_preds_logits)
+            num_studies += len(reports)
+            busy[rank] += elapsed
+            received += 1
+        for p in workers:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        stats = {
+            'workers': self.num_workers,
+            'studies': num_studies,
+            'elapsed': elapsed,
+            'throughput': num_studies / max(elapsed, 1e-9),
+            'utilization': sum(busy) / max(elapsed * self.num_workers, 1e-9),
+        }
+        return outputs, stats
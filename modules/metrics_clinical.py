@@ -27,11 +27,11 @@ CONDITIONS = [
 ]
 
 class CheXbertMetrics():
-    def __init__(self, checkpoint_path, mbatch_size, device):
+    def __init__(self, checkpoint_path, mbatch_size, device, bert_path='bert-base-uncased'):
         self.checkpoint_path = checkpoint_path
         self.mbatch_size = mbatch_size
         self.device = device
-        self.chexbert = CheXbert(self.checkpoint_path, self.device,).to(self.device)
+        self.chexbert = CheXbert(self.checkpoint_path, self.device, bert_path=bert_path).to(self.device)
 
     def mini_batch(self, gts, res, mbatch_size=16):
         length = len(gts)
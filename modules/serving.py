@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import time
+
+import numpy as np
+import torch
+
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+
+
+class Histogram(object):
+    """Fixed-bucket histogram, bucket i counts values <= buckets[i], the last one everything above."""
+
+    def __init__(self, buckets, unit=''):
+        self.buckets = buckets
+        self.unit = unit
+        self.counts = [0] * (len(buckets) + 1)
+        self.values = []
+
+    def update(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values.append(value)
+
+    def percentile(self, q):
+        if len(self.values) == 0:
+            return 0.0
+        return float(np.percentile(self.values, q))
+
+    def __str__(self):
+        lines = []
+        for i, count in enumerate(self.counts):
+            if i < len(self.buckets):
+                name = '<= {}{}'.format(self.buckets[i], self.unit)
+            else:
+                name = '>  {}{}'.format(self.buckets[-1], self.unit)
+            lines.append('\t\t{:12s}: {}'.format(name, count))
+        return '\n'.join(lines)
+
+
+class ServingStats(object):
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.latency = Histogram(LATENCY_BUCKETS_MS, 'ms')
+        self.queue_wait = Histogram(LATENCY_BUCKETS_MS, 'ms')
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_depth = []
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'requests': self.num_requests,
+            'batches': self.num_batches,
+            'throughput': self.num_requests / max(elapsed, 1e-9),
+            'mean_batch_size': self.num_requests / max(self.num_batches, 1),
+            'latency_p50_ms': self.latency.percentile(50),
+            'latency_p90_ms': self.latency.percentile(90),
+            'latency_p99_ms': self.latency.percentile(99),
+            'queue_wait_p50_ms': self.queue_wait.percentile(50),
+            'queue_depth_mean': float(np.mean(self.queue_depth)) if self.queue_depth else 0.0,
+            'queue_depth_max': max(self.queue_depth) if self.queue_depth else 0,
+        }
+
+    def histograms(self):
+        return {'latency': self.latency, 'queue_wait': self.queue_wait, 'batch_size': self.batch_size}
+
+
+class ReportServer(object):
+    """
+    Asyncio front end around BLIP_Decoder.generate.
+
+    Incoming studies are queued and grouped into micro-batches: a batch takes whatever is already queued, up
+    to max_batch_size, and only waits for new arrivals until its oldest request has waited max_wait_ms.
+    Generation runs in a worker thread so the event loop keeps accepting requests while a batch is decoded.
+
+    With a retriever (models/retrieval.py), studies may be submitted without clip_memory: their top clip_k
+    reports are retrieved for the whole micro-batch at once before generation.
+    """
+
+    def __init__(self, model, device, max_batch_size=16, max_wait_ms=50, num_beams=3, max_length=150, min_length=100, retriever=None):
+        self.model = model
+        self.retriever = retriever
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.num_beams = num_beams
+        self.max_length = max_length
+        self.min_length = min_length
+        self.stats = ServingStats()
+        self.queue = None
+        self._worker = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.stats = ServingStats()
+        self._worker = asyncio.ensure_future(self._batch_loop())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def submit(self, image, clip_memory=None):
+        """image: [3, H, W], clip_memory: [clip_k, 512] or None to retrieve it; returns a dict with report, cls_preds and probs"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, clip_memory, future, time.perf_counter()))
+        return await future
+
+    async def stream(self, requests):
+        """submit (image, clip_memory) pairs and yield (index, result) in completion order"""
+        async def indexed(i, image, clip_memory):
+            return i, await self.submit(image, clip_memory)
+        tasks = [asyncio.ensure_future(indexed(i, image, clip_memory)) for i, (image, clip_memory) in enumerate(requests)]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = batch[0][3] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # take the backlog first, only wait (up to the head request's deadline) when the queue is empty
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self.stats.queue_depth.append(self.queue.qsize())
+            start = time.perf_counter()
+            images = torch.stack([b[0] for b in batch], 0)
+            clip_memory = [b[1] for b in batch]
+            try:
+                results = await loop.run_in_executor(None, self._generate, images, clip_memory)
+            except Exception as e:
+                for b in batch:
+                    if not b[2].done():
+                        b[2].set_exception(e)
+                continue
+            end = time.perf_counter()
+            self.stats.num_batches += 1
+            self.stats.batch_size.update(len(batch))
+            for b, result in zip(batch, results):
+                self.stats.num_requests += 1
+                self.stats.queue_wait.update((start - b[3]) * 1000.)
+                self.stats.latency.update((end - b[3]) * 1000.)
+                if not b[2].done():
+                    b[2].set_result(result)
+
+    def _generate(self, images, clip_memory):
+        missing = [i for i, memory in enumerate(clip_memory) if memory is None]
+        if len(missing) > 0:
+            if self.retriever is None:
+                raise ValueError('studies without clip_memory need a retriever')
+            retrieved = self.retriever.memory(self.retriever(images[missing])).cpu()
+            for i, memory in zip(missing, retrieved):
+                clip_memory[i] = memory
+        images = images.to(self.device)
+        clip_memory = torch.stack(clip_memory, 0).to(self.device)
+        with torch.no_grad():
+            reports, cls_preds, cls_preds_logits = self.model.generate(images, clip_memory, sample=False, num_beams=self.num_beams,
+                                                                        max_length=self.max_length, min_length=self.min_length)
+        cls_preds_logits = cls_preds_logits.float().cpu().numpy().tolist()
+        return [{'report': report, 'cls_preds': pred, 'probs': prob}
+                for report, pred, prob in zip(reports, cls_preds, cls_preds_logits)]
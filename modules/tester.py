@@ -15,7 +15,8 @@ class BaseTester(object):
         self.model = model
         self.device = device
 
-        self.chexbert_metrics = CheXbertMetrics('./checkpoints/stanford/chexbert/chexbert.pth', args.batch_size, device)
+        self.chexbert_metrics = CheXbertMetrics(getattr(args, 'chexbert_path', './checkpoints/stanford/chexbert/chexbert.pth'), args.batch_size, device,
+                                                bert_path=getattr(args, 'chexbert_bert', 'bert-base-uncased'))
 
         logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                             datefmt='%m/%d/%Y %H:%M:%S', level=logging.INFO)
@@ -47,11 +48,19 @@ class Tester(BaseTester):
         self.model.eval()
         with torch.no_grad():
             test_gts, test_res = [], []
-            for batch_idx, (images, captions, cls_labels, clip_memory) in enumerate(self.test_dataloader):
+            gen_time = 0.
+            for batch_idx, batch in enumerate(self.test_dataloader):
+                images, captions, cls_labels, clip_memory = batch[:4]
+                clip_indices = batch[4] if len(batch) > 4 else None
+                clip_scores = batch[5] if len(batch) > 5 else None
                 images = images.to(self.device) 
                 clip_memory = clip_memory.to(self.device) 
                 ground_truths = captions
-                reports, _, _ = self.model.generate(images, clip_memory, sample=False, num_beams=self.args.beam_size, max_length=self.args.gen_max_len, min_length=self.args.gen_min_len)
+                start = time.time()
+                reports, _, _ = self.model.generate(images, clip_memory, sample=False, num_beams=self.args.beam_size, max_length=self.args.gen_max_len, min_length=self.args.gen_min_len, clip_indices=clip_indices, clip_scores=clip_scores)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                gen_time += time.time() - start
 
                 test_res.extend(reports)
                 test_gts.extend(ground_truths)
@@ -63,5 +72,60 @@ class Tester(BaseTester):
             
             log.update(**{'test_' + k: v for k, v in test_met.items()})
             log.update(**{'test_' + k: v for k, v in test_ce.items()})
+            log['gen_time'] = gen_time
+        model = getattr(self.model, 'module', self.model)
+        if model.memory_cache is not None:
+            log.update(**model.memory_cache.summary())
+        if model.memory_stats['studies'] > 0:
+            log['memory_mean_k'] = model.memory_stats['kept'] / model.memory_stats['studies']
+        return log
+
+    def test_speculative(self):
+        self.logger.info('Start to evaluate speculative decoding in the test set.')
+        log = dict()
+        self.model.eval()
+        drafter = self.model.drafter
+        base_time, spec_time, identical = 0., 0., 0
+        with torch.no_grad():
+            test_gts, test_res = [], []
+            for batch_idx, batch in enumerate(self.test_dataloader):
+                images, captions, cls_labels, clip_memory = batch[:4]
+                clip_indices = batch[4] if len(batch) > 4 else None
+                images = images.to(self.device) 
+                clip_memory = clip_memory.to(self.device) 
+                ground_truths = captions
+
+                # plain decoding as reference for speed and output equality
+                self.model.drafter = None
+                start = time.time()
+                base_reports, _, _ = self.model.generate(images, clip_memory, sample=False, num_beams=self.args.beam_size, max_length=self.args.gen_max_len, min_length=self.args.gen_min_len)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                base_time += time.time() - start
+
+                self.model.drafter = drafter
+                start = time.time()
+                reports, _, _ = self.model.generate(images, clip_memory, sample=False, num_beams=self.args.beam_size, max_length=self.args.gen_max_len, min_length=self.args.gen_min_len, clip_indices=clip_indices)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                spec_time += time.time() - start
+
+                identical += sum([r == b for r, b in zip(reports, base_reports)])
+                test_res.extend(reports)
+                test_gts.extend(ground_truths)
+                if batch_idx % 10 == 0:
+                    print('{}/{}'.format(batch_idx, len(self.test_dataloader)))
+            test_met = self.metric_ftns({i: [gt] for i, gt in enumerate(test_gts)},
+                                        {i: [re] for i, re in enumerate(test_res)})
+            test_ce = self.chexbert_metrics.compute(test_gts, test_res)
+            
+            log.update(**{'test_' + k: v for k, v in test_met.items()})
+            log.update(**{'test_' + k: v for k, v in test_ce.items()})
+
+        stats = drafter.stats
+        log['spec_acceptance_rate'] = stats['accepted'] / max(stats['proposed'], 1)
+        log['spec_tokens_per_forward'] = stats['tokens'] / max(stats['rows'], 1)
+        log['spec_speedup'] = base_time / max(spec_time, 1e-9)
+        log['spec_identical'] = identical / max(len(test_res), 1)
         return log
 
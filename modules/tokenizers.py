@@ -1,7 +1,12 @@
+import os
 import json
 import re
 from collections import Counter
 
+from transformers import BertTokenizer
+
+from dataset.utils import my_pre_caption
+
 
 class Tokenizer(object):
     def __init__(self, args):
@@ -93,3 +98,37 @@ class Tokenizer(object):
         for ids in ids_batch:
             out.append(self.decode(ids))
         return out
+
+
+def build_tokenizer(bert_path='bert-base-uncased'):
+    """
+    The report tokenizer: the BERT wordpieces of bert_path (the hub name or a local directory with vocab.txt,
+    e.g. the one main_synthetic.py writes) plus the [DEC] bos token and the four score tokens.
+    """
+    tokenizer = BertTokenizer.from_pretrained(bert_path)
+    tokenizer.add_special_tokens({'bos_token': '[DEC]'})
+    tokenizer.add_tokens(['[BLA]', '[POS]', '[NEG]', '[UNC]'])
+    return tokenizer
+
+
+def build_output_vocab(ann_path, tokenizer, min_count=1, cache_path=None, max_words=100):
+    """
+    Token ids the report decoder has to be able to emit: the wordpieces of the training reports seen at
+    least min_count times plus every special / added token (bos, score tokens, ...). Cached as a json list.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        return json.load(open(cache_path, 'r'))
+    if ann_path is None:
+        raise ValueError('building the output vocabulary needs the annotation of the training reports')
+    annotation = json.load(open(ann_path, 'r'))
+    counter = Counter()
+    for ann in annotation['train']:
+        counter.update(tokenizer(my_pre_caption(ann['report'], max_words), add_special_tokens=False).input_ids)
+    vocab = set(k for k, v in counter.items() if v >= min_count)
+    vocab.update(tokenizer.all_special_ids)
+    vocab.update(tokenizer.get_added_vocab().values())
+    vocab = sorted(vocab)
+    if cache_path is not None:
+        with open(cache_path, 'w') as f:
+            json.dump(vocab, f)
+    return vocab
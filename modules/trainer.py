@@ -16,10 +16,13 @@ class BaseTrainer(object):
     def __init__(self, model, criterion_cls, base_probs, metric_ftns, args, device, is_main_process):
         self.args = args
         self.model = model
+        # DDP wrapped when args.distributed, the plain model in a single process (e.g. CPU runs on synthetic data)
+        self.model_without_ddp = model.module if args.distributed else model
         self.device = device
         self.is_main_process = is_main_process
 
-        self.chexbert_metrics = CheXbertMetrics('./checkpoints/stanford/chexbert/chexbert.pth', args.batch_size, device)
+        self.chexbert_metrics = CheXbertMetrics(getattr(args, 'chexbert_path', './checkpoints/stanford/chexbert/chexbert.pth'), args.batch_size, device,
+                                                bert_path=getattr(args, 'chexbert_bert', 'bert-base-uncased'))
 
         self.criterion_cls = criterion_cls
         self.base_probs = base_probs
@@ -77,7 +80,8 @@ class BaseTrainer(object):
                 self.train_dataloader.sampler.set_epoch(epoch)
 
             result = self._train_epoch_blip(epoch)
-            dist.barrier()
+            if self.args.distributed:
+                dist.barrier()
             result = self.eval_blip(result)
 
             # save logged information 
@@ -90,7 +94,7 @@ class BaseTrainer(object):
                     self.mnt_best = log[self.mnt_metric]
                     self.log_best = copy.deepcopy(log)
                     best_path = os.path.join(self.checkpoint_dir, 'model_best.pth')
-                    torch.save(self.model.module.state_dict(), best_path)
+                    torch.save(self.model_without_ddp.state_dict(), best_path)
                     print("Saving current best to {}".format(best_path))
 
             # print logged information 
@@ -140,7 +144,7 @@ class Trainer(BaseTrainer):
         return log
 
     def eval_blip(self, log):
-        self.model.module.eval()
+        self.model_without_ddp.eval()
 
         logits = []
         counts = []
@@ -151,7 +155,7 @@ class Trainer(BaseTrainer):
                 cls_labels = cls_labels.to(self.device)
                 clip_memory = clip_memory.to(self.device)
                 ground_truths = captions
-                reports, cls_preds, cls_preds_logits = self.model.module.generate(images, clip_memory, sample=False, num_beams=self.args.beam_size, max_length=self.args.gen_max_len, min_length=self.args.gen_min_len)
+                reports, cls_preds, cls_preds_logits = self.model_without_ddp.generate(images, clip_memory, sample=False, num_beams=self.args.beam_size, max_length=self.args.gen_max_len, min_length=self.args.gen_min_len)
                 ## logit adjustment
                 cls_labels = (cls_labels==1).float()
                 logit = cls_preds_logits*cls_labels
@@ -184,7 +188,7 @@ class Trainer(BaseTrainer):
                 cls_labels = cls_labels.numpy().tolist()
                 clip_memory = clip_memory.to(self.device) 
                 ground_truths = captions
-                reports, _, _ = self.model.module.generate(images, clip_memory, sample=False, num_beams=self.args.beam_size, max_length=self.args.gen_max_len, min_length=self.args.gen_min_len)
+                reports, _, _ = self.model_without_ddp.generate(images, clip_memory, sample=False, num_beams=self.args.beam_size, max_length=self.args.gen_max_len, min_length=self.args.gen_min_len)
 
                 test_res.extend(reports)
                 test_gts.extend(ground_truths)
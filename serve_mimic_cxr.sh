@@ -0,0 +1,12 @@
+python main_serve.py \
+--device cpu \
+--gen_max_len 150 \
+--gen_min_len 100 \
+--beam_size 3 \
+--clip_k 21 \
+--max_batch_size 16 \
+--max_wait_ms 50 \
+--num_requests 64 \
+--request_rate 4 \
+--compact_generation \
+--load_pretrained results/promptmrg/model_best.pth
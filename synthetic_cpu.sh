@@ -0,0 +1,47 @@
+python main_synthetic.py --output_dir data/synthetic --seed 456789
+
+python main_train.py \
+--tiny \
+--device cpu \
+--image_dir data/synthetic/images/ \
+--ann_path data/synthetic/annotation.json \
+--clip_features_path data/synthetic/clip_text_features.json \
+--base_probs_path data/synthetic/base_probs.json \
+--bert_path data/synthetic/bert \
+--chexbert_path data/synthetic/chexbert/chexbert.pth \
+--chexbert_bert data/synthetic/chexbert \
+--dataset_name mimic_cxr \
+--gen_max_len 40 \
+--gen_min_len 10 \
+--batch_size 8 \
+--epochs 1 \
+--save_dir results/synthetic \
+--seed 456789 \
+--clip_k 21 \
+--beam_size 1
+
+python main_test.py \
+--tiny \
+--device cpu \
+--image_dir data/synthetic/images/ \
+--ann_path data/synthetic/annotation.json \
+--clip_features_path data/synthetic/clip_text_features.json \
+--bert_path data/synthetic/bert \
+--chexbert_path data/synthetic/chexbert/chexbert.pth \
+--chexbert_bert data/synthetic/chexbert \
+--dataset_name mimic_cxr \
+--gen_max_len 40 \
+--gen_min_len 10 \
+--batch_size 8 \
+--save_dir results/synthetic \
+--seed 456789 \
+--clip_k 21 \
+--beam_size 3 \
+--load_pretrained results/synthetic/model_best.pth
+
+python main_benchmark.py \
+--tiny \
+--bert_path data/synthetic/bert \
+--optimize fold \
+--batch_sizes 1 4 16 \
+--load_pretrained results/synthetic/model_best.pth